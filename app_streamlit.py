@@ -1,86 +1,84 @@
 
 # app_streamlit.py
 import streamlit as st
-import sqlite3
-from werkzeug.security import check_password_hash
-import pandas as pd # Will be needed for data display
-import plotly.express as px # Will be needed for graphs
+import contextlib # Needed for reporting_database_busy()
+import functools # Needed for the widget callback decorator
 import os # Needed for file path checks
-import time # Needed for time.strftime if pandas is not available
+import sqlite3 # Needed to catch writes that time out on the database lock
+import time # Needed for time.strftime and the login page timing
+import importlib # Needed to import pandas/plotly lazily
+import logging
+from datetime import datetime, timedelta
+
+# Database, import, export and aggregates live in the 'ilumina' package, shared with
+# the command line (python -m ilumina); this script is the Streamlit UI on top of it.
+from ilumina.archive import ARCHIVE_AFTER_DAYS
+from ilumina.attachments import (ATTACHMENT_EXTENSIONS, add_attachment, count_attachments, delete_os_attachments,
+                                 list_attachments, read_attachment, remove_unreferenced_objects, request_thumbnail,
+                                 thumbnail_failed)
+from ilumina.auth import (SESSION_TOKEN_TTL_S, authenticate, create_session_token, end_sessions, hash_password,
+                          resolve_client_ip, verify_session_token)
+from ilumina.db import (DATABASE_BUSY_MESSAGE, db_transaction, get_data_version, get_db_path, is_database_busy,
+                        run_query)
+from ilumina.diagnostics import (RerunProfiler, active_profiler, profile_section, record_rerun,
+                                 rerun_latency_summary, set_active_profiler)
+from ilumina.duplicates import find_duplicate_groups, merge_duplicates
+from ilumina.export import EXPORT_COLUMNS
+from ilumina.frames import rows_to_frame
+from ilumina.jobs import (JOB_ACTIVE_STATUSES, JOB_LABELS, has_active_jobs, list_jobs, read_job_file,
+                          request_sla_refresh, save_job_input, start_job_runner, submit_job)
+from ilumina.queries import (OS_PAGE_SIZE_OPTIONS, SLA_DIMENSIONS, SLA_METRICS, STATUS_TRANSITIONS,
+                             apply_status_transition, build_os_filter_clause, count_os, fetch_os_page,
+                             get_aberta_em_range, get_counts_by, get_counts_by_period, get_counts_by_weekday_hour,
+                             get_os_metrics, get_sla_summary, record_os_events, sla_pending_events,
+                             transitions_from)
+from ilumina.schema import reset_database, setup_database_once
+from ilumina.timeutil import LOCAL_TZ, local_date_to_epoch
+
+logger = logging.getLogger('ilumina')
+
+# Measured against LOGIN_PAGE_BUDGET_MS at the end of the script
+SCRIPT_STARTED_AT = time.perf_counter()
 
 # Define the database path relative to the app's directory in the deployment environment
 # This will create/look for database.db in the root of the deployed app's filesystem.
 # WARNING: Data will NOT be persistent across deployments/restarts on ephemeral filesystems like Streamlit Cloud.
-db_path = 'database.db' # Changed from '/content/database.db'
+# ILUMINA_DB_PATH points the app at another database (e.g. the generated benchmark databases)
+db_path = get_db_path() # Changed from '/content/database.db'
 
-# Function to get database connection
-def get_db_connection():
-    conn = sqlite3.connect(db_path)
-    return conn
 
-# Ensure the database and default admin user exist and has the correct schema
-# This function should be called every time the app starts to ensure the DB exists
-# and create it if necessary.
-def setup_database():
+def reopen_database():
+    """Reconnect and run the setup again, e.g. after the database file went missing."""
+    reset_database()
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        # Create users table if it doesn't exist
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL,
-                created_at TEXT
-            )
-        ''')
-        # Create ordens_servico table if it doesn't exist
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS ordens_servico (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                protocolo TEXT UNIQUE NOT NULL,
-                nome TEXT,
-                endereco TEXT,
-                zona TEXT,
-                status TEXT,
-                responsavel TEXT
-            )
-        ''')
-
-        # --- Add 'observacao' column if it doesn't exist ---
-        # Check if the column exists
-        c.execute("PRAGMA table_info(ordens_servico);")
-        cols = [column[1] for column in c.fetchall()]
-        if 'observacao' not in cols:
-            c.execute('ALTER TABLE ordens_servico ADD COLUMN observacao TEXT')
-            conn.commit()
-            st.sidebar.info("Coluna 'observacao' adicionada à tabela 'ordens_servico'.") # Use sidebar for setup messages
-        # --- End Add 'observacao' column ---
-
-
-        # Add default admin user if not exists
-        # Check if admin exists before inserting
-        c.execute('SELECT COUNT(*) FROM users WHERE username = "admin"')
-        if c.fetchone()[0] == 0:
-            # Generate password hash for 'ilumina2025'
-            from werkzeug.security import generate_password_hash
-            admin_password_hash = generate_password_hash('ilumina2025')
-            # Use time.strftime for date format consistency, less dependency on pandas
-            created_at = time.strftime('%d/%m/%Y')
-
-            c.execute('''INSERT INTO users (username, password, role, created_at) VALUES (?, ?, ?, ?)''',
-                      ('admin', admin_password_hash, 'Administrador', created_at))
-            conn.commit()
-            st.sidebar.success("Default admin user created (user: admin, pass: ilumina2025)") # Use Streamlit sidebar for messages
-        conn.close()
-        # st.sidebar.info("Database setup complete.") # Optional info message
+        setup_database_once()
     except Exception as e:
-        st.sidebar.error(f"Error during database setup: {e}")
+        st.error(f"Error during database setup: {e}")
 
 
-# Run database setup on every app startup
-setup_database()
+# Run migrations once per process (a failure is not remembered, so it is retried on the next rerun),
+# then start the background job runner (see ilumina.jobs)
+try:
+    setup_database_once()
+    start_job_runner()
+except Exception as e:
+    st.sidebar.error(f"Error during database setup: {e}")
+
+
+# --- Lazy imports ---
+# pandas and plotly account for most of this script's import time, and the login
+# page needs neither: they're imported on first use by the dashboard and charts.
+# LOGIN_PAGE_BUDGET_MS is the time the script may take to render the login page
+# (measured from its first line); going over it is logged as a warning.
+LOGIN_PAGE_BUDGET_MS = float(os.environ.get('ILUMINA_LOGIN_BUDGET_MS', '250'))
+
+def load_dashboard_library(name):
+    """Import a heavy library on first use; stop with a friendly message if it isn't installed."""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        st.error(f"Parece que as bibliotecas necessárias não estão instaladas. Erro: {e}")
+        st.stop()
 
 
 # --- Streamlit App ---
@@ -115,6 +113,38 @@ st.markdown("""
 
 
 # --- Login Page ---
+# Passwords are checked by ilumina.auth's worker pool, with rate limiting. A login
+# puts a signed session token in the page URL (?sessao=...): a new session for that
+# URL (a reload, or a reconnect after the server dropped the old session) resumes
+# from it without asking for the password again. The token is replaced by a new one
+# on every resume and, while the session is in use, every half of its lifetime, so
+# a URL copied out of the address bar stops working soon (see ilumina.auth).
+SESSION_TOKEN_PARAM = 'sessao'
+
+def start_session(user):
+    st.session_state['logged_in'] = True
+    st.session_state['username'] = user['username']
+    st.session_state['role'] = user['role']
+    issue_session_token()
+
+def issue_session_token():
+    st.query_params[SESSION_TOKEN_PARAM] = create_session_token(st.session_state['username'])
+    st.session_state['session_token_renew_at'] = time.time() + SESSION_TOKEN_TTL_S / 2
+
+def renew_session_token():
+    if time.time() >= st.session_state.get('session_token_renew_at', 0):
+        issue_session_token()
+
+def resume_session():
+    token = st.query_params.get(SESSION_TOKEN_PARAM)
+    if not token:
+        return
+    user = verify_session_token(token)
+    if user:
+        start_session(user)
+    else:
+        del st.query_params[SESSION_TOKEN_PARAM] # Expired, logged out or the password changed
+
 def login_page():
     st.title("Acesso Restrito - Ilumina Pedro II")
 
@@ -127,375 +157,715 @@ def login_page():
         # but a quick check before login attempt is safer.
         if not os.path.exists(db_path):
              st.error(f"Database file not found at {db_path}. Attempting setup now...")
-             setup_database() # Try setting up again just in case
+             reopen_database() # Try setting up again just in case
              if not os.path.exists(db_path):
                  st.error("Database file still not found after setup attempt.")
                  return # Stop if DB still not created
 
 
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE username = ?', (username,))
-        user_row = c.fetchone()
-        conn.close()
-
-        if user_row and check_password_hash(user_row[2], password):
-            st.session_state['logged_in'] = True
-            st.session_state['username'] = user_row[1]
-            st.session_state['role'] = user_row[3]
+        try:
+            client_ip = resolve_client_ip(st.context.ip_address, st.context.headers.get('X-Forwarded-For'))
+            user = authenticate(username, password, client_ip=client_ip)
+        except ValueError as e:
+            st.error(str(e)) # Too many attempts, or too many logins at once
+            return
+
+        if user:
+            start_session(user)
             st.success(f"Bem-vindo, {st.session_state['username']} ({st.session_state['role']})!")
             st.rerun() # Rerun the app to go to the main page
         else:
             st.error("Credenciais inválidas")
 
 # --- Main Dashboard Page ---
-def main_dashboard():
-    st.sidebar.title(f"Bem-vindo, {st.session_state['username']}")
-    st.sidebar.write(f"Função: {st.session_state['role']}")
-    if st.sidebar.button("Sair"):
-        st.session_state['logged_in'] = False
-        del st.session_state['username']
-        del st.session_state['role']
-        st.rerun()
-
-    st.title("Dashboard")
-
-    # Check if the database file exists before attempting connection
-    if not os.path.exists(db_path):
-        st.error(f"Database file not found at {db_path}. Please ensure database setup runs correctly on startup.")
-        st.stop() # Stop execution if DB is missing
-
-    conn = get_db_connection()
-    df_os = pd.read_sql_query('SELECT * FROM ordens_servico', conn)
-    conn.close()
+def diagnostics_panel(profiler, pd):
+    """Sidebar 'Diagnóstico' panel: this rerun's sections and SQL, and the rerun latency history."""
+    rerun_ms = (time.perf_counter() - SCRIPT_STARTED_AT) * 1000
+    with st.sidebar.expander("Diagnóstico", expanded=True):
+        st.metric("Rerun atual", f"{rerun_ms:.0f} ms")
+        st.caption(f"SQL: {profiler.statement_count} instruções, {profiler.sql_ms:.0f} ms")
+        sections = profiler.sections + [('Outros (início do script, widgets)',
+                                         max(rerun_ms - sum(ms for _, ms in profiler.sections), 0.0))]
+        st.dataframe(pd.DataFrame(sections, columns=['Seção', 'ms']).round(1), hide_index=True)
+        if profiler.statements:
+            df_sql = pd.DataFrame(profiler.statements).rename(columns={'sql': 'SQL', 'linhas': 'Linhas'})
+            st.dataframe(df_sql.round({'ms': 2}), hide_index=True)
+            if profiler.statement_count > len(profiler.statements):
+                st.caption(f"Mostrando as primeiras {len(profiler.statements)} instruções.")
+        else:
+            st.caption("Nenhuma consulta SQL neste rerun (resultados em cache).")
+        summary = rerun_latency_summary()
+        if summary:
+            desde = datetime.fromtimestamp(summary['desde'], LOCAL_TZ).strftime('%d/%m %H:%M')
+            col_p50, col_p95 = st.columns(2)
+            col_p50.metric("p50", f"{summary['p50_ms']:.0f} ms")
+            col_p95.metric("p95", f"{summary['p95_ms']:.0f} ms")
+            st.caption(f"Últimos {summary['reruns']} reruns do dashboard (todas as sessões), desde {desde}.")
+
+# --- Chart figures ---
+# Plotly figures are built once per data version and chart parameters and kept with
+# st.cache_resource, so reruns that don't change the data or the period skip pandas
+# and plotly entirely. The 'OS ao Longo do Tempo' series switches from daily to
+# weekly or monthly points when the period has more than CHART_MAX_POINTS days,
+# which keeps the figure sent to the browser small for long periods.
+CHART_CACHE_MAX_ENTRIES = 64
+CHART_MAX_POINTS = 370
+CHART_STATUS_COLORS = ['#FF6384', '#36A2EB', '#FFCE56']
+WEEKDAY_NAMES = ['Dom', 'Seg', 'Ter', 'Qua', 'Qui', 'Sex', 'Sáb']
+TIME_BUCKET_LABELS = {'dia': 'por dia', 'semana': 'por semana', 'mes': 'por mês'}
+# TIME_BUCKET_FORMATS labels parsed back into dates (a week is shown at its Monday)
+TIME_BUCKET_DATE_PARSERS = {
+    'dia': lambda label: datetime.strptime(label, '%Y-%m-%d'),
+    'semana': lambda label: datetime.strptime(f'{label}-1', '%Y-%W-%w'),
+    'mes': lambda label: datetime.strptime(label, '%Y-%m'),
+}
 
-    # --- Metrics ---
+def adaptive_time_bucket(start_epoch, end_epoch):
+    """'dia', 'semana' or 'mes': the finest bucket giving at most CHART_MAX_POINTS points."""
+    days = (end_epoch - start_epoch) / 86400
+    if days <= CHART_MAX_POINTS:
+        return 'dia'
+    if days / 7 <= CHART_MAX_POINTS:
+        return 'semana'
+    return 'mes'
+
+@st.cache_resource(max_entries=CHART_CACHE_MAX_ENTRIES, show_spinner=False)
+def status_pie_figure(data_version, include_archived=False):
+    # data_version is only part of the cache key (see ilumina.db.get_data_version())
+    px = load_dashboard_library('plotly.express')
+    status_counts = [(status, count) for status, count in get_counts_by('status', include_archived)
+                     if status is not None]
+    df_status_counts = rows_to_frame(status_counts, ['status', 'count'])
+    return px.pie(df_status_counts, names='status', values='count', title='Distribuição por Status',
+                  color_discrete_sequence=CHART_STATUS_COLORS)
+
+@st.cache_resource(max_entries=CHART_CACHE_MAX_ENTRIES, show_spinner=False)
+def zona_bar_figure(data_version, include_archived=False):
+    """'OS por Zona' bar chart, or None if no OS has a zona."""
+    zona_counts = [(zona, count) for zona, count in get_counts_by('zona', include_archived) if zona is not None]
+    if not zona_counts:
+        return None
+    px = load_dashboard_library('plotly.express')
+    df_zona_counts = rows_to_frame(zona_counts, ['zona', 'count'])
+    return px.bar(df_zona_counts, x='zona', y='count', title='OS por Zona', color_discrete_sequence=['#36A2EB'])
+
+@st.cache_resource(max_entries=CHART_CACHE_MAX_ENTRIES, show_spinner=False)
+def time_series_figure(start_epoch, end_epoch, data_version, include_archived=False):
+    """'OS ao Longo do Tempo' with adaptive_time_bucket() points, or None if no OS was opened in the period."""
+    bucket = adaptive_time_bucket(start_epoch, end_epoch)
+    counts = get_counts_by_period(start_epoch, end_epoch, bucket, include_archived=include_archived)
+    if not counts:
+        return None
+    pd = load_dashboard_library('pandas')
+    px = load_dashboard_library('plotly.express')
+    parse_label = TIME_BUCKET_DATE_PARSERS[bucket]
+    df_series = pd.DataFrame([(parse_label(period), count) for period, count in counts], columns=['date', 'count'])
+    # A week split by New Year comes back as two labels ('2024-53', '2025-00') for the same Monday
+    df_series = df_series.groupby('date', as_index=False)['count'].sum()
+    return px.line(df_series, x='date', y='count', title=f'OS ao Longo do Tempo ({TIME_BUCKET_LABELS[bucket]})',
+                   color_discrete_sequence=['#FF6384'])
+
+@st.cache_resource(max_entries=CHART_CACHE_MAX_ENTRIES, show_spinner=False)
+def weekly_activity_figure(start_epoch, end_epoch, data_version, include_archived=False):
+    # Weekly activity: OS opened per weekday and hour of the day (at most 7 x 24 cells)
+    pd = load_dashboard_library('pandas')
+    px = load_dashboard_library('plotly.express')
+    df_activity = rows_to_frame(get_counts_by_weekday_hour(start_epoch, end_epoch, include_archived),
+                                ['dia_semana', 'hora', 'count'])
+    # SQLite's weekday numbers (0 = domingo) are the category codes of WEEKDAY_NAMES
+    df_activity['dia'] = pd.Categorical.from_codes(df_activity['dia_semana'], WEEKDAY_NAMES)
+    return px.density_heatmap(df_activity, x='hora', y='dia', z='count', histfunc='sum',
+                              nbinsx=24, title='Atividade Semanal (OS abertas por dia e hora)',
+                              category_orders={'dia': WEEKDAY_NAMES}, color_continuous_scale='Blues')
+
+@st.cache_resource(max_entries=CHART_CACHE_MAX_ENTRIES, show_spinner=False)
+def monthly_trend_figure(start_epoch, end_epoch, data_version, include_archived=False):
+    # Monthly trend per status
+    px = load_dashboard_library('plotly.express')
+    df_monthly = rows_to_frame(get_counts_by_period(start_epoch, end_epoch, 'mes', by_status=True,
+                                                    include_archived=include_archived),
+                               ['mes', 'status', 'count'])
+    return px.bar(df_monthly, x='mes', y='count', color='status', title='Tendência Mensal',
+                  color_discrete_sequence=CHART_STATUS_COLORS)
+
+# --- Dashboard fragments ---
+# The metric cards, the filter bar + OS list, each OS card and the chart block are
+# fragments (st.fragment): a widget inside one reruns only that function, not the
+# whole script. An action on one OS card updates the card's row locally (see
+# os_card_row()) and reruns just that card and the metric cards, by their fragment
+# keys; the list and the charts pick the change up on their next rerun.
+# Archived OS (see ilumina.archive) are only read when the 'Incluir arquivadas'
+# sidebar toggle is on; toggling it reruns the whole script.
+METRICS_FRAGMENT_KEY = 'os_metricas'
+
+def include_archived():
+    return st.session_state.get('incluir_arquivadas', False)
+
+def os_card_key(row):
+    return f"os_card_{row['id']}"
+
+def os_card_row(row):
+    """The card's row as last fetched by the list, or as updated locally by the card's actions."""
+    return st.session_state.setdefault('os_card_rows', {}).get(row['id'], row)
+
+def update_os_card_row(row, message, **changes):
+    st.session_state.setdefault('os_card_rows', {})[row['id']] = {**os_card_row(row), **changes}
+    st.session_state.setdefault('os_card_messages', {})[row['id']] = message
+
+# A write waits up to SQLITE_BUSY_TIMEOUT_MS for the database's write lock (e.g.
+# behind an import batch); if it still times out, the user is told to try again
+# instead of seeing a traceback.
+@contextlib.contextmanager
+def reporting_database_busy():
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if not is_database_busy(e):
+            raise
+        st.toast(DATABASE_BUSY_MESSAGE, icon="⚠️")
+
+def busy_safe_callback(callback):
+    """Run a widget callback that writes inside reporting_database_busy()."""
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        with reporting_database_busy():
+            return callback(*args, **kwargs)
+    return wrapper
+
+@busy_safe_callback
+def on_os_transition(row, action):
+    transition = STATUS_TRANSITIONS[action]
+    # Need a way to select responsible user in Streamlit - for now, use logged-in user
+    username = st.session_state.get('username', 'Desconhecido')
+    if not apply_status_transition(action, protocolos=[row['protocolo']], responsavel=username, usuario=username):
+        # The OS changed meanwhile (another session or an import): show everything as it is now
+        st.session_state['bulk_result'] = f"OS {row['protocolo']} já não está com status '{row['status']}'."
+        st.rerun()
+    responsavel = {'usuario': username, 'manter': row['responsavel'], 'limpar': None}[transition['responsavel']]
+    update_os_card_row(row, f"OS {row['protocolo']} {transition['mensagem']}.",
+                       status=transition['para'], responsavel=responsavel)
+    st.rerun([os_card_key(row), METRICS_FRAGMENT_KEY])
+
+@busy_safe_callback
+def on_save_observacao(row):
+    new_observation = st.session_state[f"obs_{row['protocolo']}"]
+    with db_transaction() as conn:
+        conn.execute('UPDATE ordens_servico SET observacao = ? WHERE protocolo = ?', (new_observation, row['protocolo']))
+    # Only the card depends on it: the default rerun of the card's fragment is enough
+    update_os_card_row(row, f"Observação para {row['protocolo']} salva.", observacao=new_observation)
+
+@busy_safe_callback
+def on_delete_os(row):
+    with db_transaction() as conn:
+        record_os_events(conn, 'excluida', 'protocolo = ?', (row['protocolo'],), usuario=st.session_state.get('username'))
+        conn.execute('DELETE FROM ordens_servico WHERE protocolo = ?', (row['protocolo'],))
+        attachment_files = delete_os_attachments(conn, [row['protocolo']])
+    remove_unreferenced_objects(attachment_files)
+    update_os_card_row(row, f"OS {row['protocolo']} excluída.", excluida=True)
+    st.rerun([os_card_key(row), METRICS_FRAGMENT_KEY])
+
+def set_delete_confirmation(row, value):
+    st.session_state[f"confirm_delete_{row['protocolo']}"] = value
+
+# An OS's photos are only listed, and their thumbnails read, while the card's
+# 'Fotos' toggle is on; the full-size photo is only read when downloaded.
+ATTACHMENT_GRID_COLUMNS = 4
+
+def attachment_upload_key(row):
+    # A new key after each upload clears the files just sent from the uploader
+    uploads = st.session_state.get(f"anexos_envios_{row['id']}", 0)
+    return f"anexos_upload_{row['id']}_{uploads}"
+
+@busy_safe_callback
+def on_add_attachments(row):
+    uploaded_files = st.session_state.get(attachment_upload_key(row)) or []
+    added = 0
+    errors = []
+    for uploaded_file in uploaded_files:
+        try:
+            _, is_new = add_attachment(row['protocolo'], uploaded_file, nome_arquivo=uploaded_file.name,
+                                       usuario=st.session_state.get('username'))
+            added += is_new
+        except ValueError as e:
+            errors.append(f"{uploaded_file.name}: {e}")
+    st.session_state[f"anexos_envios_{row['id']}"] = st.session_state.get(f"anexos_envios_{row['id']}", 0) + 1
+    message = f"{added} foto(s) anexada(s) à OS {row['protocolo']}."
+    if errors:
+        message += " Não anexadas: " + " ".join(errors)
+    # Only the card depends on it: the default rerun of the card's fragment is enough
+    update_os_card_row(row, message, anexos=os_card_row(row).get('anexos', 0) + added)
+
+def os_attachments(row, editable):
+    """The 'Fotos' toggle of a card: thumbnails, downloads and (if editable) the upload."""
+    if not st.toggle(f"Fotos ({row.get('anexos', 0)})", key=f"anexos_mostrar_{row['id']}"):
+        return
+    attachments = list_attachments(row['protocolo'])
+    pending = False
+    grid = st.columns(ATTACHMENT_GRID_COLUMNS)
+    for index, attachment in enumerate(attachments):
+        file_name = attachment['nome_arquivo'] or attachment['sha256'][:12]
+        with grid[index % ATTACHMENT_GRID_COLUMNS]:
+            thumbnail = request_thumbnail(attachment['sha256'])
+            if thumbnail:
+                st.image(thumbnail, caption=file_name)
+            elif thumbnail_failed(attachment['sha256']):
+                st.caption(f"{file_name}: pré-visualização indisponível.")
+            else:
+                pending = True
+                st.caption(f"{file_name}: miniatura em preparação...")
+            st.download_button("Original", data=lambda sha256=attachment['sha256']: read_attachment(sha256),
+                               file_name=file_name, mime=attachment['tipo'], on_click='ignore',
+                               key=f"anexo_download_{attachment['id']}")
+    if pending:
+        st.button("Atualizar fotos", key=f"anexos_atualizar_{row['id']}") # Reruns the card only
+    if editable:
+        st.file_uploader("Adicionar fotos:", type=ATTACHMENT_EXTENSIONS, accept_multiple_files=True,
+                         key=attachment_upload_key(row))
+        st.button("Anexar fotos", key=f"anexos_enviar_{row['id']}", on_click=on_add_attachments, args=(row,),
+                  disabled=not st.session_state.get(attachment_upload_key(row)))
+
+@st.fragment(key=METRICS_FRAGMENT_KEY)
+def metrics_fragment():
+    # Aggregates only: the OS rows themselves are fetched page by page by the list
+    metrics = get_os_metrics(include_archived())
     st.subheader("Métricas")
-    total_os = len(df_os)
-    pendentes = len(df_os[df_os['status'] == 'pendente'])
-    em_andamento = len(df_os[df_os['status'] == 'em-andamento'])
-    concluidas = len(df_os[df_os['status'] == 'concluida'])
-
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric(label="Total de OS", value=total_os)
+        st.metric(label="Total de OS", value=metrics['total'])
     with col2:
-        st.metric(label="Pendentes", value=pendentes)
+        st.metric(label="Pendentes", value=metrics['pendentes'])
     with col3:
-        st.metric(label="Em Andamento", value=em_andamento)
+        st.metric(label="Em Andamento", value=metrics['em_andamento'])
     with col4:
-        st.metric(label="Concluídas", value=concluidas)
-
+        st.metric(label="Concluídas", value=metrics['concluidas'])
+
+def os_card(row):
+    """Details and actions of one OS (rendered as a fragment keyed by os_card_key())."""
+    row = os_card_row(row)
+    message = st.session_state.setdefault('os_card_messages', {}).pop(row['id'], None)
+    if row.get('excluida'):
+        st.success(message or f"OS {row['protocolo']} excluída.")
+        return
+    if message:
+        st.success(message)
+    st.write(f"**Protocolo:** {row['protocolo']}")
+    st.write(f"**Nome:** {row['nome']}")
+    st.write(f"**Endereço:** {row['endereco']}")
+    st.write(f"**Zona:** {row['zona']}")
+    st.write(f"**Status:** {row['status']}")
+    st.write(f"**Responsável:** {row['responsavel']}")
+    if row.get('duplicata_de'):
+        st.write(f"**Duplicata de:** {row['duplicata_de']}")
+    if row['descricao']:
+        st.write(f"**Descrição:** {row['descricao']}")
+    if row['telefone']:
+        st.write(f"**Telefone:** {row['telefone']}")
+    if row['data']:
+        st.write(f"**Data:** {row['data']} {row['hora'] or ''}")
+    if row.get('arquivada_em'):
+        # Archived OS are read-only
+        arquivada_em = datetime.fromtimestamp(row['arquivada_em'], LOCAL_TZ).strftime('%d/%m/%Y %H:%M')
+        st.write(f"**Arquivada em:** {arquivada_em}")
+        if row.get('observacao'):
+            st.write(f"**Observação:** {row['observacao']}")
+        os_attachments(row, editable=False)
+        return
+    os_attachments(row, editable=True)
+
+    # Add Observation field (editable)
+    # Use a unique key for each text_area based on the row index or protocol
+    current_observation = row.get('observacao') or '' # Get observation, default to empty string if NULL
+    new_observation = st.text_area(f"Observação (Protocolo {row['protocolo']}):", value=current_observation, key=f"obs_{row['protocolo']}")
+
+    # Action Buttons: Start, Complete, Revert, Delete
+    col_actions1, col_actions2, col_actions3, col_actions4 = st.columns(4)
+
+    # Update Observation Button (only if observation changed)
+    if new_observation != current_observation:
+        st.button("Salvar Observação", key=f"save_obs_{row['protocolo']}", on_click=on_save_observacao, args=(row,))
+    else:
+        # If observation didn't change, show a disabled or different button/message
+        st.write("Observação atualizada.") # Or a disabled button placeholder
+
+    # Status Change Buttons
+    for action, col_action in zip(transitions_from(row['status']), [col_actions1, col_actions2, col_actions3]):
+        transition = STATUS_TRANSITIONS[action]
+        col_action.button(transition['label'], key=f"{transition['key']}_{row['protocolo']}",
+                          on_click=on_os_transition, args=(row, action))
+
+    # Delete Button (Admin only), confirmed inside the card
+    if st.session_state.get('role') == 'Administrador':
+        if st.session_state.get(f"confirm_delete_{row['protocolo']}"):
+            st.warning(f"Confirmar exclusão da OS {row['protocolo']}?")
+            col_confirm, col_cancel = st.columns(2)
+            col_confirm.button("Sim, excluir", key=f"confirm_delete_yes_{row['protocolo']}",
+                               on_click=on_delete_os, args=(row,))
+            col_cancel.button("Cancelar", key=f"confirm_delete_no_{row['protocolo']}",
+                              on_click=set_delete_confirmation, args=(row, False))
+        else:
+            col_actions4.button("Excluir OS", key=f"delete_{row['protocolo']}",
+                                on_click=set_delete_confirmation, args=(row, True))
+
+@st.fragment(key='os_lista')
+def os_list_fragment():
+    """Filter bar, paginated OS list, bulk actions and the OS cards."""
+    # Rows are fetched fresh below, so the cards' local updates are no longer needed
+    st.session_state['os_card_rows'] = {}
+    archived = include_archived()
+    # NULL groups are left out, as value_counts() did before
+    status_counts = [(status, count) for status, count in get_counts_by('status', archived) if status is not None]
+    zona_counts = [(zona, count) for zona, count in get_counts_by('zona', archived) if zona is not None]
 
     # --- Filters ---
+    profile_section('Filtros')
     st.subheader("Filtros")
     col_filter1, col_filter2, col_filter3 = st.columns(3)
     with col_filter1:
-        all_zones = ['Todas as Zonas'] + list(df_os['zona'].unique()) if 'zona' in df_os.columns and not df_os['zona'].empty else ['Todas as Zonas']
-        zona_filter = st.selectbox('Zona:', all_zones)
+        all_zones = ['Todas as Zonas'] + [zona for zona, _ in zona_counts]
+        zona_filter = st.selectbox('Zona:', all_zones, key='os_filtro_zona')
     with col_filter2:
-        all_statuses = ['Todos'] + list(df_os['status'].unique()) if 'status' in df_os.columns and not df_os['status'].empty else ['Todos']
-        status_filter = st.selectbox('Status:', all_statuses)
+        all_statuses = ['Todos'] + [status for status, _ in status_counts]
+        status_filter = st.selectbox('Status:', all_statuses, key='os_filtro_status')
     with col_filter3:
-        search_term = st.text_input('Buscar por Protocolo ou Nome:')
+        search_term = st.text_input('Buscar por Protocolo, Nome, Endereço ou Observação:', key='os_busca')
 
-    filtered_df = df_os.copy()
-    if zona_filter != 'Todas as Zonas':
-        filtered_df = filtered_df[filtered_df['zona'] == zona_filter]
-    if status_filter != 'Todos':
-        filtered_df = filtered_df[filtered_df['status'] == status_filter]
-    if search_term:
-        filtered_df = filtered_df[
-            filtered_df['protocolo'].astype(str).str.contains(search_term, case=False, na=False) |
-            filtered_df['nome'].astype(str).str.contains(search_term, case=False, na=False)
-        ]
+    where_clause, where_params = build_os_filter_clause(zona_filter, status_filter, search_term, archived)
 
 
     # --- Display Filtered Data ---
+    profile_section('Lista de OS')
     st.subheader("Ordens de Serviço (Filtradas)")
-    # Include 'observacao' in the displayed columns
-    display_columns = ['protocolo', 'nome', 'endereco', 'zona', 'status', 'responsavel', 'observacao']
-    # Ensure columns exist in the filtered_df before selecting
-    display_columns = [col for col in display_columns if col in filtered_df.columns]
-
-    # --- Action Buttons (Implementing status change and delete) ---
-    # Since Streamlit re-runs the script on every interaction, managing state for
-    # individual row buttons requires a different pattern than Flask/Colab.
-    # We can add buttons/forms within the dataframe row using st.columns or iterate
-    # over rows and create inputs/buttons. Iterating is more flexible for actions.
+    total_filtered = count_os(where_clause, where_params, archived)
+
+    col_page1, col_page2 = st.columns([1, 3])
+    with col_page1:
+        page_size = st.selectbox('OS por página:', OS_PAGE_SIZE_OPTIONS, index=1, key='os_page_size')
+
+    # Keyset pagination state: a stack with the last id of every page already visited.
+    # Any change to the filters or to the page size starts again from the first page.
+    page_state_key = (zona_filter, status_filter, search_term, page_size, archived)
+    if st.session_state.get('os_page_state_key') != page_state_key:
+        st.session_state['os_page_state_key'] = page_state_key
+        st.session_state['os_page_cursors'] = [0]
+    page_cursors = st.session_state['os_page_cursors']
+
+    page_rows, has_next_page = fetch_os_page(where_clause, where_params, page_cursors[-1], page_size, archived)
+    page_number = len(page_cursors)
+    first_shown = (page_number - 1) * page_size + 1 if page_rows else 0
+    last_shown = (page_number - 1) * page_size + len(page_rows)
+    with col_page2:
+        st.write(f"Mostrando {first_shown}–{last_shown} de {total_filtered} OS (página {page_number}, {page_size} por página)")
+
+    # --- Bulk Actions ---
+    bulk_result = st.session_state.pop('bulk_result', None)
+    if bulk_result:
+        st.success(bulk_result)
+    with st.expander("Ações em Lote"):
+        bulk_scope = st.radio("Aplicar a:", ["OS selecionadas nesta página", f"Todas as {total_filtered} OS do filtro atual"],
+                              key="bulk_scope")
+        select_all_matching = bulk_scope != "OS selecionadas nesta página"
+        if not select_all_matching:
+            # One selection per page (the options are the OS shown on the page)
+            selected_protocolos = st.multiselect("OS selecionadas:", [row['protocolo'] for row in page_rows],
+                                                 key=f"bulk_selection_{page_cursors[-1]}")
+        bulk_action = st.selectbox("Ação:", list(STATUS_TRANSITIONS),
+                                   format_func=lambda action: STATUS_TRANSITIONS[action]['label'], key="bulk_action")
+        bulk_responsavel = None
+        if STATUS_TRANSITIONS[bulk_action]['responsavel'] == 'usuario':
+            usernames = [user[0] for user in run_query('SELECT username FROM users ORDER BY username')]
+            current_user = st.session_state.get('username')
+            bulk_responsavel = st.selectbox("Responsável:", usernames,
+                                            index=usernames.index(current_user) if current_user in usernames else 0,
+                                            key="bulk_responsavel")
+        st.caption("Só são alteradas as OS cujo status permite a ação: "
+                   + ", ".join(STATUS_TRANSITIONS[bulk_action]['de']) + f" → {STATUS_TRANSITIONS[bulk_action]['para']}."
+                   + (" OS arquivadas nunca são alteradas." if archived else ""))
+        if st.button("Aplicar Ação em Lote", key="bulk_apply"):
+            with reporting_database_busy():
+                usuario = st.session_state['username']
+                if select_all_matching:
+                    selected_count = total_filtered
+                    updated = apply_status_transition(bulk_action, where_clause=where_clause, params=where_params,
+                                                      responsavel=bulk_responsavel, usuario=usuario)
+                else:
+                    selected_count = len(selected_protocolos)
+                    updated = apply_status_transition(bulk_action, protocolos=selected_protocolos,
+                                                      responsavel=bulk_responsavel, usuario=usuario)
+                skipped = selected_count - updated
+                st.session_state['bulk_result'] = (
+                    f"{STATUS_TRANSITIONS[bulk_action]['label']}: {updated} OS alteradas"
+                    + (f", {skipped} ignoradas (status não permite a ação)." if skipped else "."))
+                st.rerun() # Full rerun: a batch changes the list, the counters and the charts
 
     st.write("---") # Separator
     st.subheader("Detalhes e Ações por Ordem de Serviço")
 
-    # Re-fetch data to ensure we have the latest state after potential actions
-    conn = get_db_connection()
-    df_os_actions = pd.read_sql_query('SELECT * FROM ordens_servico', conn)
-    conn.close()
-
-    # Ensure 'observacao' is a string and handle potential None values for display/editing
-    if 'observacao' in df_os_actions.columns:
-         df_os_actions['observacao'] = df_os_actions['observacao'].fillna('').astype(str)
+    # One fragment per OS on the current page
+    attachment_counts = count_attachments([row['protocolo'] for row in page_rows])
+    for row in page_rows:
+        row['anexos'] = attachment_counts.get(row['protocolo'], 0)
+    if page_rows:
+        for row in page_rows:
+            st.fragment(os_card, key=os_card_key(row))(row)
+            st.write("---") # Separator between OS entries
     else:
-         # If 'observacao' column was just added and DB was empty, it might not appear in df_os_actions.columns
-         # Add it with empty strings if missing.
-         df_os_actions['observacao'] = ''
-
-
-    # Iterate through filtered rows to display details and action buttons
-    if not filtered_df.empty:
-        for index, row in filtered_df.iterrows():
-            st.write(f"**Protocolo:** {row['protocolo']}")
-            st.write(f"**Nome:** {row['nome']}")
-            st.write(f"**Endereço:** {row['endereco']}")
-            st.write(f"**Zona:** {row['zona']}")
-            st.write(f"**Status:** {row['status']}")
-            st.write(f"**Responsável:** {row['responsavel']}")
-
-            # Add Observation field (editable)
-            # Use a unique key for each text_area based on the row index or protocol
-            current_observation = row.get('observacao', '') # Get observation, default to empty string if column missing
-            new_observation = st.text_area(f"Observação (Protocolo {row['protocolo']}):", value=current_observation, key=f"obs_{row['protocolo']}")
-
-            # Action Buttons: Start, Complete, Revert, Delete
-            col_actions1, col_actions2, col_actions3, col_actions4 = st.columns(4)
-            action_taken = False # Flag to trigger rerun after an action
-
-            # Update Observation Button (only if observation changed)
-            if new_observation != current_observation:
-                 if st.button("Salvar Observação", key=f"save_obs_{row['protocolo']}"):
-                     conn = get_db_connection()
-                     c = conn.cursor()
-                     c.execute('UPDATE ordens_servico SET observacao = ? WHERE protocolo = ?', (new_observation, row['protocolo']))
-                     conn.commit()
-                     conn.close()
-                     st.success(f"Observação para {row['protocolo']} salva.")
-                     action_taken = True # Trigger rerun
+        st.info("Nenhuma Ordem de Serviço encontrada com os filtros aplicados.")
+
+    # Page navigation (the callbacks move the keyset cursor before the list reruns)
+    col_nav1, col_nav2 = st.columns(2)
+    with col_nav1:
+        st.button("◀ Página Anterior", key="os_page_prev", disabled=page_number == 1, on_click=page_cursors.pop)
+    with col_nav2:
+        st.button("Próxima Página ▶", key="os_page_next", disabled=not has_next_page,
+                  on_click=page_cursors.append, args=(page_rows[-1]['id'] if page_rows else 0,))
+
+# Possible duplicates are only searched while the toggle is on; merging is a full
+# rerun, as it changes the list, the counters and the charts.
+DUPLICATE_GROUPS_SHOWN = 20
+
+@busy_safe_callback
+def on_merge_duplicates(group_key, protocolos):
+    principal = st.session_state[f"duplicatas_principal_{group_key}"]
+    merged = merge_duplicates(principal, protocolos, usuario=st.session_state.get('username'))
+    st.session_state['duplicatas_resultado'] = f"{merged} OS mescladas na OS {principal}."
+    st.rerun()
+
+@st.fragment(key='os_duplicatas')
+def duplicates_fragment():
+    """Open OS of the same zona with similar addresses, grouped, with a merge button per group."""
+    st.subheader("Possíveis Duplicatas")
+    merge_result = st.session_state.pop('duplicatas_resultado', None)
+    if merge_result:
+        st.success(merge_result)
+    if not st.toggle("Procurar OS abertas com endereço parecido na mesma zona", key="duplicatas_mostrar"):
+        return
+    groups = find_duplicate_groups()
+    if not groups:
+        st.info("Nenhuma possível duplicata entre as OS abertas.")
+        return
+    st.caption(f"{len(groups)} grupos encontrados" + (f", mostrando os {DUPLICATE_GROUPS_SHOWN} mais parecidos."
+                                                     if len(groups) > DUPLICATE_GROUPS_SHOWN else "."))
+    for group in groups[:DUPLICATE_GROUPS_SHOWN]:
+        protocolos = [row['protocolo'] for row in group['os']]
+        group_key = protocolos[0]
+        with st.container(border=True):
+            st.write(f"**Zona:** {group['zona']} · similaridade {group['similaridade']:.0%}")
+            df_group = rows_to_frame(group['os'], ['protocolo', 'nome', 'endereco', 'status'])
+            st.dataframe(df_group.rename(columns={'protocolo': 'Protocolo', 'nome': 'Nome', 'endereco': 'Endereço',
+                                                  'status': 'Status'}), hide_index=True, use_container_width=True)
+            # The oldest OS is the default principal: the others are merged into it
+            st.selectbox("OS principal:", protocolos, key=f"duplicatas_principal_{group_key}")
+            st.button("Mesclar as demais na principal", key=f"duplicatas_mesclar_{group_key}",
+                      on_click=on_merge_duplicates, args=(group_key, protocolos))
+
+def current_os_filter():
+    """(where_clause, params) for the filters currently selected in the OS list."""
+    return build_os_filter_clause(st.session_state.get('os_filtro_zona', 'Todas as Zonas'),
+                                  st.session_state.get('os_filtro_status', 'Todos'),
+                                  st.session_state.get('os_busca', ''), include_archived())
+
+@st.fragment(key='os_graficos')
+def charts_fragment():
+    """Status/zona distribution and time charts; changing the period reruns only this block."""
+    st.subheader("Gráficos")
+    archived = include_archived()
+    if get_os_metrics(archived)['total'] > 0:
+        # Figures come from the cache while the data version and the period are unchanged
+        data_version = get_data_version()
+        # Distribution by Status
+        st.plotly_chart(status_pie_figure(data_version, archived), use_container_width=True)
+
+        # OS by Zone
+        fig_zona = zona_bar_figure(data_version, archived)
+        if fig_zona is not None:
+            st.plotly_chart(fig_zona, use_container_width=True)
+        else:
+            st.info("Coluna 'zona' sem valores nos dados para gerar o gráfico por zona.")
+
+        # --- Time charts (OS ao Longo do Tempo, Atividade Semanal, Tendência Mensal) ---
+        # Bucketed by SQLite over the indexed 'aberta_em' column, see get_counts_by_period()
+        first_epoch, last_epoch = get_aberta_em_range(archived)
+        if first_epoch is None:
+            st.info("Nenhuma OS com data de abertura ('Data'/'Hora' do relatório) para os gráficos por data.")
+        else:
+            first_day = datetime.fromtimestamp(first_epoch, LOCAL_TZ).date()
+            last_day = datetime.fromtimestamp(last_epoch, LOCAL_TZ).date()
+            # The key includes the available range, so new data resets the selection to the full range
+            selected_range = st.date_input("Período dos gráficos:", value=(first_day, last_day),
+                                           key=f"chart_date_range_{first_day}_{last_day}")
+            # While the user is picking a range the widget briefly holds a single date
+            if isinstance(selected_range, (tuple, list)):
+                range_start = selected_range[0]
+                range_end = selected_range[1] if len(selected_range) > 1 else selected_range[0]
             else:
-                 # If observation didn't change, show a disabled or different button/message
-                 st.write("Observação atualizada.") # Or a disabled button placeholder
-
-            # Status Change Buttons
-            if row['status'] == 'pendente':
-                if col_actions1.button("Iniciar Tratamento", key=f"start_{row['protocolo']}"):
-                    # Need a way to select responsible user in Streamlit - for now, use logged-in user
-                    responsavel = st.session_state.get('username', 'Desconhecido') # Get logged-in username
-                    conn = get_db_connection()
-                    c = conn.cursor()
-                    c.execute('UPDATE ordens_servico SET status = ?, responsavel = ? WHERE protocolo = ?', ('em-andamento', responsavel, row['protocolo']))
-                    conn.commit()
-                    conn.close()
-                    st.success(f"OS {row['protocolo']} marcada como 'em-andamento'.")
-                    action_taken = True # Trigger rerun
-
-            elif row['status'] == 'em-andamento':
-                if col_actions1.button("Marcar como Concluída", key=f"complete_{row['protocolo']}"):
-                    conn = get_db_connection()
-                    c = conn.cursor()
-                    c.execute('UPDATE ordens_servico SET status = ? WHERE protocolo = ?', ('concluida', row['protocolo']))
-                    conn.commit()
-                    conn.close()
-                    st.success(f"OS {row['protocolo']} marcada como 'concluída'.")
-                    action_taken = True # Trigger rerun
-                if col_actions2.button("Reverter para Pendente", key=f"revert_pending_{row['protocolo']}"):
-                     conn = get_db_connection()
-                     c = conn.cursor()
-                     c.execute('UPDATE ordens_servico SET status = ?, responsavel = ? WHERE protocolo = ?', ('pendente', None, row['protocolo'])) # Clear responsible on revert
-                     conn.commit()
-                     conn.close()
-                     st.success(f"OS {row['protocolo']} revertida para 'pendente'.")
-                     action_taken = True # Trigger rerun
-
-
-            elif row['status'] == 'concluida':
-                 if col_actions1.button("Reverter para Em Andamento", key=f"revert_inprogress_{row['protocolo']}"):
-                      # Need responsible user if reverting to 'em-andamento' - use logged-in user
-                      responsavel = st.session_state.get('username', 'Desconhecido') # Get logged-in username
-                      conn = get_db_connection()
-                      c = conn.cursor()
-                      c.execute('UPDATE ordens_servico SET status = ?, responsavel = ? WHERE protocolo = ?', ('em-andamento', responsavel, row['protocolo']))
-                      conn.commit()
-                      conn.close()
-                      st.success(f"OS {row['protocolo']} revertida para 'em-andamento'.")
-                      action_taken = True # Trigger rerun
-
-
-            # Delete Button (Admin only)
-            if st.session_state.get('role') == 'Administrador':
-                if col_actions4.button("Excluir OS", key=f"delete_{row['protocolo']}"):
-                    # Add confirmation logic
-                    confirm_delete = st.sidebar.radio(f"Confirmar exclusão da OS {row['protocolo']}?", ('Não', 'Sim'), key=f"confirm_delete_{row['protocolo']}")
-                    if confirm_delete == 'Sim':
-                        conn = get_db_connection()
-                        c = conn.cursor()
-                        c.execute('DELETE FROM ordens_servico WHERE protocolo = ?', (row['protocolo'],))
-                        conn.commit()
-                        conn.close()
-                        st.success(f"OS {row['protocolo']} excluída.")
-                        action_taken = True # Trigger rerun
-                    else:
-                        st.sidebar.info("Exclusão cancelada.")
+                range_start = range_end = selected_range
+            start_epoch = local_date_to_epoch(range_start)
+            end_epoch = local_date_to_epoch(range_end + timedelta(days=1))
+
+            fig_date = time_series_figure(start_epoch, end_epoch, data_version, archived)
+            if fig_date is not None:
+                st.plotly_chart(fig_date, use_container_width=True)
+                st.plotly_chart(weekly_activity_figure(start_epoch, end_epoch, data_version, archived),
+                                use_container_width=True)
+                st.plotly_chart(monthly_trend_figure(start_epoch, end_epoch, data_version, archived),
+                                use_container_width=True)
+            else:
+                st.info("Nenhuma OS aberta no período selecionado.")
+    else:
+        st.info("Sem dados de Ordens de Serviço para exibir gráficos.")
 
+# --- Background jobs ---
+# Imports, reports and maintenance run as background jobs (ilumina.jobs), so the
+# script returns at once and a rerun can't interrupt them. The panel lists the
+# user's latest jobs and reruns itself every JOB_POLL_INTERVAL_S while any is
+# active; once a job this session was following finishes, the whole script reruns
+# so the metrics, list and charts show the new data.
+JOB_POLL_INTERVAL_S = 1.0
+JOBS_SHOWN = 5
 
-            st.write("---") # Separator between OS entries
+def enqueue_job(tipo, parametros):
+    try:
+        submit_job(tipo, parametros, usuario=st.session_state['username'])
+    except ValueError as e:
+        st.error(str(e)) # The database stayed busy: try again
+        return
+    st.rerun() # Full rerun, so the jobs panel starts polling
+
+def jobs_panel():
+    """The user's latest background jobs, with progress, summary and result download."""
+    jobs = list_jobs(st.session_state['username'], JOBS_SHOWN)
+    active = {job['id'] for job in jobs if job['status'] in JOB_ACTIVE_STATUSES}
+    finished = st.session_state.get('jobs_ativos', set()) - active
+    st.session_state['jobs_ativos'] = active
+    if finished:
+        st.rerun()
+    if not jobs:
+        return
+    st.subheader("Tarefas em Segundo Plano")
+    for job in jobs:
+        criada_em = datetime.fromtimestamp(job['criado_em'], LOCAL_TZ).strftime('%d/%m %H:%M')
+        title = f"**{JOB_LABELS.get(job['tipo'], job['tipo'])}** · {criada_em}"
+        if job['status'] in JOB_ACTIVE_STATUSES:
+            text = f"{title} · {job['mensagem'] or ('Na fila...' if job['status'] == 'na-fila' else 'Executando...')}"
+            st.progress(min(max(job['progresso'], 0.0), 1.0), text=text)
+        elif job['status'] == 'erro':
+            st.error(f"{title} · Erro: {job['mensagem']}")
+        else:
+            st.success(f"{title} · {job['mensagem']}")
+            resultado = job['resultado'] or {}
+            if job['tipo'] == 'importacao' and resultado.get('arquivadas'):
+                st.info(f"{resultado['arquivadas']} linhas ignoradas por serem de OS já arquivadas.")
+            if job['arquivo'] and os.path.exists(job['arquivo']):
+                file_name = resultado.get('nome_arquivo', os.path.basename(job['arquivo']))
+                # The file is only read when the button is clicked
+                st.download_button(f"Download {file_name}", data=lambda path=job['arquivo']: read_job_file(path),
+                                   file_name=file_name, key=f"job_download_{job['id']}", on_click='ignore',
+                                   mime='application/gzip' if file_name.endswith('.gz') else 'text/csv')
 
-        if action_taken:
-            st.rerun() # Rerun the script to show updated data and buttons
+def main_dashboard():
+    st.sidebar.title(f"Bem-vindo, {st.session_state['username']}")
+    st.sidebar.write(f"Função: {st.session_state['role']}")
+    if st.sidebar.button("Sair"):
+        with reporting_database_busy():
+            # Revokes the session token (and those of the user's other sessions)
+            end_sessions(st.session_state['username'])
+            st.session_state['logged_in'] = False
+            st.query_params.pop(SESSION_TOKEN_PARAM, None)
+            del st.session_state['username']
+            del st.session_state['role']
+            st.rerun()
+    st.sidebar.toggle("Incluir arquivadas", key="incluir_arquivadas",
+                      help="Inclui as OS concluídas arquivadas nas métricas, na lista, nos gráficos e nos relatórios.")
+    if st.session_state['role'] == 'Administrador':
+        st.sidebar.toggle("Diagnóstico", key="diagnostico",
+                          help="Mostra o tempo de cada seção e as consultas SQL de cada rerun.")
 
-    else:
-        st.info("Nenhuma Ordem de Serviço encontrada com os filtros aplicados.")
+    st.title("Dashboard")
+    profile_section('Bibliotecas')
+    pd = load_dashboard_library('pandas')
 
+    # Check if the database file exists before attempting connection
+    if not os.path.exists(db_path):
+        st.error(f"Database file not found at {db_path}. Please ensure database setup runs correctly on startup.")
+        st.stop() # Stop execution if DB is missing
+
+    profile_section('Métricas')
+    # --- Metrics ---
+    metrics_fragment()
+
+    # --- Background jobs ---
+    profile_section('Tarefas')
+    polling = has_active_jobs(st.session_state['username'])
+    st.fragment(jobs_panel, key='tarefas', run_every=JOB_POLL_INTERVAL_S if polling else None)()
+
+    # --- Filters and OS list ---
+    os_list_fragment()
+
+    # --- Possible duplicates ---
+    profile_section('Duplicatas')
+    duplicates_fragment()
 
     # --- Upload CSV ---
+    profile_section('Importação')
     st.subheader("Upload de Ordens de Serviço (CSV)")
     uploaded_file = st.file_uploader("Escolha um arquivo CSV", type="csv", key="csv_uploader") # Add key
     if uploaded_file is not None:
         try:
-            df_upload = pd.read_csv(uploaded_file)
+            # Preview only: the full file is streamed in chunks when it is processed
+            df_preview = pd.read_csv(uploaded_file, nrows=5, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+            uploaded_file.seek(0)
             st.write("Prévia do CSV uploaded:")
-            st.dataframe(df_upload.head())
+            st.dataframe(df_preview)
 
-            if st.button("Processar e Substituir Dados Existentes", key="process_csv_button"): # Add key
+            if st.button("Processar e Importar (atualiza OS existentes)", key="process_csv_button"): # Add key
                  # Check if the database file exists before attempting connection
                  if not os.path.exists(db_path):
                      st.error(f"Database file not found at {db_path}. Attempting setup now...")
-                     setup_database() # Try setting up again just in case
+                     reopen_database() # Try setting up again just in case
                      if not os.path.exists(db_path):
                          st.error("Database file still not found after setup attempt.")
                          # st.experimental_rerun() # Might be stuck in a loop, better to stop or return
                          return
 
-
-                 conn = get_db_connection()
-                 # Convert column names to lowercase for case-insensitive matching
-                 df_upload.columns = df_upload.columns.str.lower()
-                 # Add 'zona' column if missing, with a default value
-                 if 'zona' not in df_upload.columns:
-                    df_upload['zona'] = 'Não Especificada' # Default value for missing zona
-
-                 # Ensure only relevant columns are kept if there are extra columns in CSV
-                 required_columns = ['protocolo', 'nome', 'endereco', 'zona', 'status', 'responsavel']
-                 # Check if essential columns are present after lowercasing
-                 essential_columns_present = all(col in df_upload.columns for col in ['protocolo', 'nome', 'endereco', 'status', 'responsavel'])
-
-                 if not essential_columns_present:
-                     missing_essential = [col for col in ['protocolo', 'nome', 'endereco', 'status', 'responsavel'] if col not in df_upload.columns]
-                     st.error(f"Erro: Colunas essenciais faltando no CSV: {missing_essential}")
-                     conn.close()
-                     st.rerun() # Use st.rerun()
-                     return
-
-                 # If 'observacao' is in the uploaded CSV, include it. Otherwise, it will be None by default in the DB.
-                 optional_columns = ['observacao']
-                 for col in optional_columns:
-                      if col in df_upload.columns:
-                           required_columns.append(col)
-                           # Ensure the column exists in df_upload before selecting it
-                           if col not in df_upload.columns:
-                                df_upload[col] = None # Add column with None if it was missing initially but added to required_columns
-
-                 df_to_insert = df_upload[required_columns]
-
-
-                 try:
-                    df_to_insert.to_sql('ordens_servico', conn, if_exists='replace', index=False)
-                    conn.commit()
-                    st.success(f"{len(df_to_insert)} registros importados com sucesso!")
-                    st.rerun() # Use st.rerun() to refresh data display
-                 except Exception as e:
-                    st.error(f"Erro ao inserir dados no banco de dados: {e}")
-                 finally:
-                    conn.close()
+                 # Imported by a background job from a copy of the upload; progress and result show in 'Tarefas'
+                 enqueue_job('importacao', {'arquivo': save_job_input(uploaded_file)})
 
         except Exception as e:
             st.error(f"Erro ao ler o arquivo CSV: {e}")
 
 
     # --- Graphs ---
-    st.subheader("Gráficos")
-    if not df_os.empty:
-        # Distribution by Status
-        status_counts = df_os['status'].value_counts().reset_index()
-        status_counts.columns = ['status', 'count']
-        fig_status = px.pie(status_counts, names='status', values='count', title='Distribuição por Status',
-                            color_discrete_sequence=['#FF6384', '#36A2EB', '#FFCE56'])
-        st.plotly_chart(fig_status, use_container_width=True)
-
-        # OS by Zone
-        if 'zona' in df_os.columns:
-            zona_counts = df_os['zona'].value_counts().reset_index()
-            zona_counts.columns = ['zona', 'count']
-            fig_zona = px.bar(zona_counts, x='zona', y='count', title='OS por Zona',
-                              color_discrete_sequence=['#36A2EB'])
-            st.plotly_chart(fig_zona, use_container_width=True)
-        else:
-            st.info("Coluna 'zona' não encontrada nos dados para gerar o gráfico por zona.")
-
-        # --- New Graph: OS by Date ---
-        # This requires a date column in the 'ordens_servico' table.
-        # Assuming a column named 'created_at' or similar exists and contains dates.
-        # If your actual DB uses a different column name or format, adjust the query.
-        # We will try to get data and plot it if a suitable date column is found.
-
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('PRAGMA table_info(ordens_servico);')
-        cols = [col[1] for col in c.fetchall()]
-        date_column = None
-        for potential_col in ['created_at', 'data_registro', 'data_criacao', 'data']: # Add other potential date column names
-            if potential_col in cols:
-                date_column = potential_col
-                break
-        conn.close() # Close connection after checking schema
-
-        if date_column:
-            conn = get_db_connection()
-            # Read data specifically for the date graph
-            try:
-                # Ensure the date column is treated as datetime by pandas for plotting
-                df_date_graph = pd.read_sql_query(f'SELECT {date_column} FROM ordens_servico WHERE {date_column} IS NOT NULL', conn)
-                conn.close()
-
-                if not df_date_graph.empty:
-                    # Convert the date column to datetime objects
-                    # Use errors='coerce' to turn invalid date formats into NaT (Not a Time)
-                    df_date_graph['date'] = pd.to_datetime(df_date_graph[date_column], errors='coerce')
-                    # Drop rows where date conversion failed
-                    df_date_graph.dropna(subset=['date'], inplace=True)
-
-                    if not df_date_graph.empty:
-                        # Group by date and count
-                        date_counts = df_date_graph['date'].dt.date.value_counts().reset_index()
-                        date_counts.columns = ['date', 'count']
-                        # Sort by date for proper time series plotting
-                        date_counts['date'] = pd.to_datetime(date_counts['date'])
-                        date_counts = date_counts.sort_values('date')
-
-                        fig_date = px.line(date_counts, x='date', y='count', title='OS ao Longo do Tempo',
-                                           color_discrete_sequence=['#FF6384'])
-                        st.plotly_chart(fig_date, use_container_width=True)
-                    else:
-                         st.info(f"Nenhum dado válido na coluna '{date_column}' para exibir o gráfico por data após conversão para datetime.")
-
-                else:
-                    st.info(f"Nenhum dado com '{date_column}' encontrado na tabela para o gráfico por data.")
-
-            except Exception as e:
-                 st.error(f"Erro ao gerar gráfico por data usando a coluna '{date_column}': {e}")
-                 if conn: conn.close() # Ensure connection is closed on error
-
-        else:
-            st.warning("Nenhuma coluna de data adequada ('created_at', 'data_registro', etc.) encontrada na tabela 'ordens_servico' para gerar o gráfico por data.")
-
-
-        # Placeholder for Activity and Trend graphs (requires date/time columns and more complex logic)
-        # st.info("Gráficos de Atividade Semanal e Tendência Mensal requerem colunas de data/hora nos dados e lógica de agregação por período.")
-
-
+    profile_section('Gráficos')
+    charts_fragment()
+
+    # --- SLA (tempo até início e até conclusão) ---
+    profile_section('SLA')
+    st.subheader("SLA de Atendimento")
+    # New events are folded into the aggregates by a background job (see
+    # ilumina.queries.refresh_sla_aggregates); meanwhile the last computed ones are shown
+    if sla_pending_events():
+        try:
+            request_sla_refresh()
+            st.caption("Os agregados de SLA estão sendo atualizados com os eventos mais recentes.")
+        except ValueError: # Database busy: queued on a later rerun
+            st.caption("Os agregados de SLA serão atualizados no próximo rerun (banco de dados ocupado).")
+    sla_dimension = st.selectbox("Agrupar SLA por:", list(SLA_DIMENSIONS), format_func=SLA_DIMENSIONS.get,
+                                 key="sla_dimension")
+    sla_summary = get_sla_summary(sla_dimension)
+    if sla_summary:
+        df_sla = rows_to_frame(sla_summary, ['chave', 'metrica', 'os', 'mediana_horas', 'p90_horas'])
+        df_sla['chave'] = df_sla['chave'].fillna('Não informado')
+        df_sla['metrica'] = df_sla['metrica'].map(SLA_METRICS)
+        df_sla = df_sla.rename(columns={'chave': SLA_DIMENSIONS[sla_dimension], 'metrica': 'Etapa', 'os': 'OS',
+                                        'mediana_horas': 'Mediana (h)', 'p90_horas': 'P90 (h)'})
+        st.dataframe(df_sla.round(1), hide_index=True, use_container_width=True)
+        st.caption("Horas desde a abertura da OS; mediana e P90 estimados por faixas de duração.")
     else:
-        st.info("Sem dados de Ordens de Serviço para exibir gráficos.")
+        st.info("Nenhuma OS iniciada ou concluída pelo painel ou por importação desde o início do histórico.")
 
 
     # --- Admin Section ---
+    profile_section('Administração')
     if st.session_state['role'] == 'Administrador':
         st.subheader("Administração de Usuários")
         # Placeholder for user management UI
@@ -505,9 +875,8 @@ def main_dashboard():
         if not os.path.exists(db_path):
             st.error(f"Database file not found at {db_path}. Cannot display users.")
         else:
-            conn = get_db_connection()
-            df_users = pd.read_sql_query('SELECT username, role, created_at FROM users', conn)
-            conn.close()
+            df_users = rows_to_frame(run_query('SELECT username, role, created_at FROM users'),
+                                     ['username', 'role', 'created_at'])
             st.dataframe(df_users)
 
         # Placeholder for Create User form
@@ -522,27 +891,20 @@ def main_dashboard():
             elif not os.path.exists(db_path):
                  st.error(f"Database file not found at {db_path}. Cannot create user.")
             else:
-                conn = get_db_connection()
-                c = conn.cursor()
-                # Check if username already exists
-                c.execute('SELECT COUNT(*) FROM users WHERE username = ?', (new_username,))
-                if c.fetchone()[0] > 0:
-                    st.error("Nome de usuário já existe.")
-                    conn.close()
-                else:
-                    hashed_password = generate_password_hash(new_password)
-                    try:
-                        created_at = time.strftime('%d/%m/%Y')
-                    except:
-                         import time
-                         created_at = time.strftime('%d/%m/%Y')
-
-                    c.execute('''INSERT INTO users (username, password, role, created_at) VALUES (?, ?, ?, ?)''',
-                              (new_username, hashed_password, new_role, created_at))
-                    conn.commit()
-                    st.success(f"Usuário '{new_username}' criado com sucesso!")
-                    conn.close()
-                    st.rerun() # Use st.rerun() # Refresh user list
+                with reporting_database_busy():
+                    hashed_password = hash_password(new_password)
+                    created_at = time.strftime('%d/%m/%Y')
+                    with db_transaction() as conn:
+                        # Check if username already exists (inside the transaction, so two admins can't race)
+                        user_exists = conn.execute('SELECT COUNT(*) FROM users WHERE username = ?', (new_username,)).fetchone()[0] > 0
+                        if not user_exists:
+                            conn.execute('''INSERT INTO users (username, password, role, created_at) VALUES (?, ?, ?, ?)''',
+                                         (new_username, hashed_password, new_role, created_at))
+                    if user_exists:
+                        st.error("Nome de usuário já existe.")
+                    else:
+                        st.success(f"Usuário '{new_username}' criado com sucesso!")
+                        st.rerun() # Use st.rerun() # Refresh user list
 
 
         # Placeholder for Change Password form
@@ -556,20 +918,28 @@ def main_dashboard():
              elif not os.path.exists(db_path):
                  st.error(f"Database file not found at {db_path}. Cannot change password.")
              else:
-                 conn = get_db_connection()
-                 c = conn.cursor()
-                 # Verify target user exists
-                 c.execute('SELECT COUNT(*) FROM users WHERE username = ?', (target_username_change,))
-                 if c.fetchone()[0] == 0:
-                     st.error(f"Usuário '{target_username_change}' não encontrado.")
-                     conn.close()
-                 else:
-                     hashed_password = generate_password_hash(new_password_change)
-                     c.execute('UPDATE users SET password = ? WHERE username = ?', (hashed_password, target_username_change))
-                     conn.commit()
-                     st.success(f"Senha do usuário '{target_username_change}' alterada com sucesso!")
-                     conn.close()
-                     st.rerun() # Use st.rerun() # Refresh
+                 with reporting_database_busy():
+                     hashed_password = hash_password(new_password_change)
+                     with db_transaction() as conn:
+                         # The UPDATE's row count tells whether the target user exists
+                         user_found = conn.execute('UPDATE users SET password = ? WHERE username = ?',
+                                                   (hashed_password, target_username_change)).rowcount > 0
+                         end_sessions(target_username_change, conn) # Logged in elsewhere with the old password
+                     if not user_found:
+                         st.error(f"Usuário '{target_username_change}' não encontrado.")
+                     else:
+                         st.success(f"Senha do usuário '{target_username_change}' alterada com sucesso!")
+                         st.rerun() # Use st.rerun() # Refresh
+
+        # Counters behind the metric cards and status/zona charts
+        st.subheader("Manutenção")
+        if st.button("Recalcular Contadores", key="rebuild_counters"):
+            enqueue_job('contadores', {})
+        # Moves old concluded OS to the archive in short batches, see ilumina.archive
+        archive_days = st.number_input("Arquivar OS concluídas há mais de (dias):", min_value=0,
+                                       value=ARCHIVE_AFTER_DAYS, step=30, key="archive_days")
+        if st.button("Arquivar OS Concluídas", key="archive_concluded"):
+            enqueue_job('arquivamento', {'dias': int(archive_days)})
 
         # Placeholder for Delete OS button (Admin only) - requires more careful implementation
         # st.subheader("Excluir Ordem de Serviço")
@@ -580,51 +950,56 @@ def main_dashboard():
 
 
     # --- Report Generation ---
+    profile_section('Relatórios')
     st.subheader("Relatórios")
+    st.caption("O relatório usa os filtros atuais da lista de OS (e 'Incluir arquivadas').")
+    report_columns = st.multiselect("Colunas do relatório:", EXPORT_COLUMNS, default=EXPORT_COLUMNS, key="report_columns")
+    compress_report = st.checkbox("Compactar relatório (gzip)", key="report_gzip")
     if st.button("Gerar Relatório CSV"):
+         # The filters live in the OS list fragment, so they are read from its widget state
+         where_clause, where_params = current_os_filter()
          if not os.path.exists(db_path):
              st.error(f"Database file not found at {db_path}. Cannot generate report.")
+         elif not report_columns:
+             st.error("Selecione ao menos uma coluna para o relatório.")
+         elif count_os(where_clause, where_params, include_archived()) == 0:
+             st.info("Nenhum dado para gerar relatório.")
          else:
-            conn = get_db_connection()
-            df_report = pd.read_sql_query('SELECT * FROM ordens_servico', conn)
-            conn.close()
-
-            if not df_report.empty:
-                # Convert DataFrame to CSV bytes
-                csv_bytes = df_report.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="Download report.csv",
-                    data=csv_bytes,
-                    file_name='report.csv',
-                    mime='text/csv'
-                )
-            else:
-                st.info("Nenhum dado para gerar relatório.")
+            # Generated by a background job; the download shows in 'Tarefas' once it is ready
+            enqueue_job('relatorio', {'zona': st.session_state.get('os_filtro_zona', 'Todas as Zonas'),
+                                      'status': st.session_state.get('os_filtro_status', 'Todos'),
+                                      'busca': st.session_state.get('os_busca', ''),
+                                      'incluir_arquivadas': include_archived(), 'colunas': report_columns,
+                                      'gzip': compress_report})
+
+    profiler = active_profiler()
+    if profiler:
+        profiler.end_section()
+        diagnostics_panel(profiler, pd)
 
 
 # --- Navigation Logic ---
 # Initialize session state if not already present
 if 'logged_in' not in st.session_state:
     st.session_state['logged_in'] = False
-
-# Check if required libraries are installed (basic check for Streamlit)
-# Removed explicit sqlite3 check as it's built-in
-try:
-    import streamlit as st
-    import pandas as pd
-    import sqlite3
-    from werkzeug.security import check_password_hash
-    import plotly.express as px
-    import os # Ensure os is imported for path checks
-    import time # Ensure time is imported for date handling if needed
-except ImportError as e:
-    st.error(f"Parece que as bibliotecas necessárias não estão instaladas. Erro: {e}")
-    st.stop() # Stop the app if imports fail
-
+    resume_session()
 
 # Main application flow: Login or Dashboard
 if st.session_state['logged_in']:
-    main_dashboard()
+    # Profile this rerun if an administrator turned on 'Diagnóstico' (the toggle keeps its state between reruns)
+    profiling = st.session_state['role'] == 'Administrador' and st.session_state.get('diagnostico', False)
+    set_active_profiler(RerunProfiler() if profiling else None)
+    try:
+        renew_session_token()
+        main_dashboard()
+    finally:
+        set_active_profiler(None)
+    record_rerun((time.perf_counter() - SCRIPT_STARTED_AT) * 1000)
 else:
     login_page()
+    login_page_ms = (time.perf_counter() - SCRIPT_STARTED_AT) * 1000
+    if login_page_ms > LOGIN_PAGE_BUDGET_MS:
+        logger.warning(f"Login page took {login_page_ms:.0f} ms (budget {LOGIN_PAGE_BUDGET_MS:.0f} ms)")
+    else:
+        logger.debug(f"Login page took {login_page_ms:.0f} ms")
 
@@ -0,0 +1,179 @@
+"""Synthetic data for the benchmarks: OS in the shape of the 'relatorio_os' exports.
+
+    python benchmarks/generate_data.py --rows 100000 --output benchmarks/data/os_100000.db
+    python benchmarks/generate_data.py --rows 5000 --csv benchmarks/data/relatorio_os_5000.csv
+
+The database is created with the app's own setup (ilumina.schema, so it gets the
+current migrations) and then filled directly, triggers included, with OS,
+their 'criada' events and the start/conclusion events of the OS that moved on.
+"""
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import sys
+from datetime import datetime, timedelta, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_TZ = timezone(timedelta(hours=-3)) # Same as the app's LOCAL_TZ
+PERIOD_END = datetime(2025, 7, 31, 23, 59, 59, tzinfo=LOCAL_TZ)
+PERIOD_DAYS = 365
+INSERT_BATCH_SIZE = 10000
+
+CSV_HEADER = ['Protocolo', 'Data', 'Hora', 'Nome', 'Endereço', 'Descrição', 'Telefone', 'Status', 'Responsável']
+STATUS_WEIGHTS = {'pendente': 35, 'em-andamento': 25, 'concluida': 40}
+STATUS_LABELS = {'pendente': 'Pendente', 'em-andamento': 'Em Andamento', 'concluida': 'Concluída'}
+ZONA_WEIGHTS = {'Centro': 30, 'Norte': 20, 'Sul': 20, 'Leste': 12, 'Oeste': 12, 'Zona Rural': 6}
+FIRST_NAMES = ['Maria', 'José', 'Antônio', 'Francisca', 'João', 'Ana', 'Francisco', 'Raimunda', 'Luiz', 'Antônia',
+               'Paulo', 'Fabricio', 'Manuel', 'Luís Carlos', 'Josefa', 'Pedro', 'Rita', 'Sebastião', 'Lucas', 'Juliana']
+LAST_NAMES = ['da Silva', 'dos Santos', 'de Sousa', 'Oliveira', 'Pereira', 'Lima', 'Carvalho', 'Ferreira',
+              'Rodrigues', 'Almeida', 'Costa', 'Gomes', 'Brito', 'Alexandria', 'Freitas', 'Mourão']
+STREETS = ['Rua Tertuliano Filho', 'Rua Auto Freire', 'Avenida Pedro Ivo', 'Rua Coronel Cordeiro',
+           'Rua Padre Madeira', 'Rua Dr. Antenor Freitas', 'Praça Domingos Mourão', 'Rua 7 de Setembro',
+           'Rua Joaquim Nabuco', 'Travessa São José', 'Rua Tiradentes', 'Avenida Getúlio Vargas']
+NEIGHBORHOODS = ['Centro', 'Boa Esperança', 'Cidade Nova', 'Engenho', 'Lajinha', 'São Francisco',
+                 'Vila Operária', 'Mutirão', 'Santa Fé', 'Morro do Cruzeiro', 'Bairro Novo', 'Aeroporto']
+DESCRIPTIONS = ['Lâmpada queimada', 'Lâmpada apagada', 'Lâmpada acesa durante o dia', 'Poste danificado',
+                'Fiação exposta', 'Reator com defeito', 'Luminária quebrada', 'Oscilação na iluminação', 'Apagar']
+OBSERVATIONS = ['Equipe enviada', 'Aguardando material (reator)', 'Morador informa que o problema voltou',
+                'Necessita caminhão cesto', 'Poste da Equatorial, encaminhado', 'Trocada lâmpada LED 100W',
+                'Endereço não localizado, ligar para o solicitante']
+RESPONSAVEIS = ['admin', 'ilumina', 'operador', 'tecnico1', 'tecnico2', 'tecnico3']
+
+
+def weighted_choice(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def generate_records(rows, seed=42, first_protocolo=1):
+    """Yield rows dicts with the relatorio_os fields plus zona, observacao and the status timeline."""
+    rng = random.Random(seed)
+    period_start = PERIOD_END - timedelta(days=PERIOD_DAYS)
+    for number in range(first_protocolo, first_protocolo + rows):
+        opened = period_start + timedelta(days=rng.random() * PERIOD_DAYS)
+        opened = opened.replace(hour=int(rng.triangular(6, 23, 19)), microsecond=0)
+        status = weighted_choice(rng, STATUS_WEIGHTS)
+        aberta_em = int(opened.timestamp())
+        iniciada_em = concluida_em = None
+        responsavel = None
+        if status != 'pendente':
+            responsavel = rng.choice(RESPONSAVEIS)
+            iniciada_em = aberta_em + int(rng.lognormvariate(2.5, 1.0) * 3600)
+        if status == 'concluida':
+            concluida_em = iniciada_em + int(rng.lognormvariate(1.5, 1.0) * 3600)
+        yield {
+            'protocolo': f'OS-{number:07d}',
+            'data': opened.strftime('%d/%m/%Y'),
+            'hora': opened.strftime('%H:%M:%S'),
+            'nome': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'endereco': f'{rng.choice(STREETS)}, {rng.randint(1, 2500)} bairro {rng.choice(NEIGHBORHOODS)}',
+            'descricao': rng.choice(DESCRIPTIONS),
+            'telefone': f'86 9{rng.randint(8000, 9999)}-{rng.randint(0, 9999):04d}',
+            'status': status,
+            'responsavel': responsavel,
+            'zona': weighted_choice(rng, ZONA_WEIGHTS),
+            'observacao': rng.choice(OBSERVATIONS) if rng.random() < 0.3 else None,
+            'aberta_em': aberta_em,
+            'iniciada_em': iniciada_em,
+            'concluida_em': concluida_em,
+        }
+
+
+def write_csv(path, rows, seed=42, first_protocolo=1):
+    """Write a relatorio_os-style CSV upload with rows OS."""
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
+        writer.writerow(CSV_HEADER)
+        for record in generate_records(rows, seed, first_protocolo):
+            writer.writerow([record['protocolo'], record['data'], record['hora'], record['nome'], record['endereco'],
+                             record['descricao'], record['telefone'], STATUS_LABELS[record['status']],
+                             record['responsavel'] or ''])
+
+
+def create_schema(db_file):
+    """Create db_file with the app's current migrations."""
+    sys.path.insert(0, REPO_DIR)
+    from ilumina import db, schema
+    db.configure_database(os.path.abspath(db_file))
+    try:
+        schema.setup_database_once()
+    finally:
+        schema.reset_database()
+
+
+def create_database(db_file, rows, seed=42):
+    """Create db_file and fill it with rows synthetic OS and their events."""
+    if os.path.exists(db_file):
+        raise FileExistsError(f"{db_file} already exists")
+    os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+    create_schema(db_file)
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    timelines = []
+    conn.execute('BEGIN')
+    batch = []
+    for record in generate_records(rows, seed):
+        batch.append(record)
+        if len(batch) == INSERT_BATCH_SIZE:
+            timelines.extend(insert_batch(conn, batch))
+            batch = []
+    if batch:
+        timelines.extend(insert_batch(conn, batch))
+    insert_events(conn, timelines)
+    from ilumina.duplicates import index_os_enderecos # On sys.path since create_schema()
+    index_os_enderecos(conn)
+    conn.execute('COMMIT')
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def insert_batch(conn, records):
+    conn.executemany('''
+        INSERT INTO ordens_servico (protocolo, nome, endereco, zona, status, responsavel, observacao, descricao,
+                                    telefone, data, hora, aberta_em)
+        VALUES (:protocolo, :nome, :endereco, :zona, :status, :responsavel, :observacao, :descricao,
+                :telefone, :data, :hora, :aberta_em)
+    ''', records)
+    return [(r['protocolo'], r['zona'], r['responsavel'], r['aberta_em'], r['iniciada_em'], r['concluida_em'])
+            for r in records]
+
+
+def insert_events(conn, timelines):
+    """'criada' events for every OS, then the start and conclusion events (in the order they happened per OS)."""
+    ids = dict(conn.execute('SELECT protocolo, id FROM ordens_servico'))
+    event_sql = '''
+        INSERT INTO os_eventos (os_id, protocolo, tipo, status_de, status_para, responsavel, zona, usuario, ocorrido_em)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    conn.executemany(event_sql, ((ids[protocolo], protocolo, 'criada', None, 'pendente', None, zona, None, aberta_em)
+                                 for protocolo, zona, _, aberta_em, _, _ in timelines))
+    conn.executemany(event_sql, ((ids[protocolo], protocolo, 'status', 'pendente', 'em-andamento', responsavel, zona,
+                                  responsavel, iniciada_em)
+                                 for protocolo, zona, responsavel, _, iniciada_em, _ in timelines if iniciada_em))
+    conn.executemany(event_sql, ((ids[protocolo], protocolo, 'status', 'em-andamento', 'concluida', responsavel, zona,
+                                  responsavel, concluida_em)
+                                 for protocolo, zona, responsavel, _, _, concluida_em in timelines if concluida_em))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, required=True, help='number of OS to generate')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='SQLite database to create')
+    parser.add_argument('--csv', help='relatorio_os CSV to write')
+    parser.add_argument('--first-protocolo', type=int, default=1, help='number of the first protocolo in the CSV')
+    args = parser.parse_args(argv)
+    if not args.output and not args.csv:
+        parser.error('give --output and/or --csv')
+    if args.output:
+        create_database(args.output, args.rows, args.seed)
+        print(f"{args.rows} OS -> {args.output}")
+    if args.csv:
+        write_csv(args.csv, args.rows, args.seed, args.first_protocolo)
+        print(f"{args.rows} OS -> {args.csv}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""Headless benchmarks of the dashboard data paths, written to JSON for comparison across commits.
+
+    python benchmarks/run_benchmarks.py --sizes 10000,100000 --repeat 5
+    python benchmarks/run_benchmarks.py --sizes 10000 --compare benchmarks/results/<commit>.json
+
+For each size the generated database (benchmarks/data/os_<size>.db, created on first
+use) is copied to a temp dir and benchmarked in a fresh process, since the app keeps
+its connection and caches per process. The app is driven with
+streamlit.testing.v1.AppTest; the CSV import, which AppTest cannot upload, and the
+report, which the dashboard runs as a background job, call ilumina.importer.import_os_csv()
+and ilumina.export.export_os_csv() directly. Times are in milliseconds.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+APP_PATH = os.path.join(REPO_DIR, 'app_streamlit.py')
+DATA_DIR = os.path.join(BENCHMARKS_DIR, 'data')
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+DEFAULT_SIZES = [10000]
+IMPORT_ROWS = 10000
+SEARCH_TERM = 'rua tertuliano'
+APP_TIMEOUT_S = 600
+
+sys.path.insert(0, BENCHMARKS_DIR)
+import generate_data
+
+
+def timed(action):
+    started = time.perf_counter()
+    action()
+    return (time.perf_counter() - started) * 1000
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {'n': len(samples), 'min_ms': round(samples[0], 2), 'mediana_ms': round(statistics.median(samples), 2),
+            'max_ms': round(samples[-1], 2)}
+
+
+def widget(widgets, label):
+    """The AppTest widget with the given label (most dashboard widgets have no key)."""
+    for candidate in widgets:
+        if candidate.label == label:
+            return candidate
+    raise LookupError(f"Widget not found: {label!r}")
+
+
+def check(at, step):
+    if at.exception:
+        raise RuntimeError(f"{step}: {at.exception[0].value}")
+    return at
+
+
+def run_worker(db_file, csv_file, repeat):
+    """Benchmark one database in this process (ILUMINA_DB_PATH is already set). Returns {benchmark: summary}."""
+    from streamlit.testing.v1 import AppTest
+    results = {}
+    at = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT_S)
+    results['pagina_login'] = summarize([timed(lambda: check(at.run(), 'login page'))])
+
+    def log_in():
+        at.text_input[0].input('admin')
+        at.text_input[1].input('ilumina2025')
+        at.button[0].click()
+        check(at.run(), 'login')
+        check(at.run(), 'first dashboard render')
+    # Includes the first render, e.g. catching up with the SLA aggregates
+    results['login_e_primeira_carga'] = summarize([timed(log_in)])
+    results['dashboard_rerun'] = summarize([timed(lambda: check(at.run(), 'rerun')) for _ in range(repeat)])
+
+    samples = []
+    for _ in range(repeat):
+        zona = widget(at.selectbox, 'Zona:')
+        samples.append(timed(lambda: check(zona.set_value(zona.options[1]).run(), 'zona filter')))
+        widget(at.selectbox, 'Zona:').set_value('Todas as Zonas').run()
+    results['filtro_zona'] = summarize(samples)
+
+    samples = []
+    for _ in range(repeat):
+        status = widget(at.selectbox, 'Status:')
+        samples.append(timed(lambda: check(status.set_value('pendente').run(), 'status filter')))
+        widget(at.selectbox, 'Status:').set_value('Todos').run()
+    results['filtro_status'] = summarize(samples)
+
+    search_label = 'Buscar por Protocolo, Nome, Endereço ou Observação:'
+    samples = []
+    for _ in range(repeat):
+        search = widget(at.text_input, search_label)
+        samples.append(timed(lambda: check(search.input(SEARCH_TERM).run(), 'search')))
+        widget(at.text_input, search_label).input('').run()
+    results['busca'] = summarize(samples)
+
+    samples = []
+    for _ in range(repeat):
+        date_range = widget(at.date_input, 'Período dos gráficos:')
+        first_day, last_day = date_range.value
+        narrower = (first_day + (last_day - first_day) / 2, last_day)
+        samples.append(timed(lambda: check(date_range.set_value(narrower).run(), 'chart period')))
+        widget(at.date_input, 'Período dos gráficos:').set_value((first_day, last_day)).run()
+    results['graficos_periodo'] = summarize(samples)
+
+    # 'Gerar Relatório CSV' only queues a background job, so the export itself is timed directly
+    sys.path.insert(0, REPO_DIR)
+    from ilumina.export import EXPORT_COLUMNS, export_os_csv
+    from ilumina.importer import import_os_csv
+    results['relatorio_csv'] = summarize([timed(lambda: export_os_csv('', [], EXPORT_COLUMNS).close())
+                                          for _ in range(repeat)])
+
+    # The import mutates the database, so it runs last: once with new/changed rows, once unchanged
+    for name in ('importacao_csv', 'reimportacao_csv'):
+        with open(csv_file, 'rb') as csv_data:
+            upload = io.BytesIO(csv_data.read()) # Stands in for the UploadedFile of st.file_uploader
+        upload.size = len(upload.getvalue())
+        results[name] = summarize([timed(lambda: import_os_csv(upload))])
+    return results
+
+
+def ensure_database(size):
+    db_file = os.path.join(DATA_DIR, f'os_{size}.db')
+    if not os.path.exists(db_file):
+        print(f"Generating {db_file}...", file=sys.stderr)
+        subprocess.run([sys.executable, os.path.join(BENCHMARKS_DIR, 'generate_data.py'), '--rows', str(size),
+                        '--output', db_file], check=True)
+    return db_file
+
+
+def ensure_import_csv(size):
+    """A CSV overlapping the second half of the database (changed rows) plus as many new OS."""
+    csv_file = os.path.join(DATA_DIR, f'relatorio_os_{size}.csv')
+    if not os.path.exists(csv_file):
+        generate_data.write_csv(csv_file, IMPORT_ROWS, seed=7, first_protocolo=max(size - IMPORT_ROWS // 2, 1))
+    return csv_file
+
+
+def benchmark_size(size, repeat):
+    db_file = ensure_database(size)
+    csv_file = ensure_import_csv(size)
+    with tempfile.TemporaryDirectory() as work_dir:
+        work_db = os.path.join(work_dir, 'database.db')
+        shutil.copy(db_file, work_db)
+        env = dict(os.environ, ILUMINA_DB_PATH=work_db)
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', work_db,
+                                    '--csv', csv_file, '--repeat', str(repeat)],
+                                   env=env, cwd=REPO_DIR, check=True, capture_output=True, text=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', 'app_streamlit.py', 'ilumina'], cwd=REPO_DIR,
+                               check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconhecido'
+    return f'{commit}-dirty' if dirty else commit
+
+
+def print_comparison(current, baseline):
+    print(f"{'tamanho':>8}  {'benchmark':<24} {'antes (ms)':>11} {'agora (ms)':>11} {'razão':>7}")
+    for size, benchmarks in current['resultados'].items():
+        for name, summary in benchmarks.items():
+            before = baseline['resultados'].get(size, {}).get(name)
+            if not before:
+                continue
+            ratio = summary['mediana_ms'] / before['mediana_ms'] if before['mediana_ms'] else float('inf')
+            print(f"{size:>8}  {name:<24} {before['mediana_ms']:>11.1f} {summary['mediana_ms']:>11.1f} {ratio:>6.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma-separated OS counts, e.g. 10000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=5, help='samples per benchmark')
+    parser.add_argument('--output', help='JSON file to write (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--csv', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.csv, args.repeat)))
+        return 0
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'executado_em': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'repeticoes': args.repeat,
+        'resultados': {},
+    }
+    for size in (int(value) for value in args.sizes.split(',')):
+        print(f"Benchmarking {size} OS...", file=sys.stderr)
+        results['resultados'][str(size)] = benchmark_size(size, args.repeat)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as result_file:
+        json.dump(results, result_file, indent=2, ensure_ascii=False)
+    print(f"Results written to {output}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            print_comparison(results, json.load(baseline_file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
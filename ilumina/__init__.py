@@ -0,0 +1,5 @@
+"""Ilumina Pedro II: the OS database, CSV import, report export and aggregates.
+
+Shared by the Streamlit dashboard (app_streamlit.py) and the command line
+(python -m ilumina import|export|stats); nothing in this package imports Streamlit.
+"""
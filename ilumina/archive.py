@@ -0,0 +1,85 @@
+# ilumina/archive.py
+"""Moving old concluded OS out of 'ordens_servico' into 'ordens_servico_arquivo'."""
+import os
+import time
+
+from .db import bump_data_version, db_transaction
+
+# 'ordens_servico' is the hot set the dashboard works on: concluded OS older than
+# ARCHIVE_AFTER_DAYS are moved, with their ids, to 'ordens_servico_arquivo' in the
+# same database. The delete triggers of 'ordens_servico' take them out of the search
+# index, the zona/status counters and the duplicate keys; the archive has its own
+# search index and counters ('os_contagem_arquivo'). Reports, the list and the charts
+# read both tables (UNION ALL, see ilumina.queries.os_source()) only when asked to
+# include archived OS. Events and SLA aggregates are not moved. Concluded OS with
+# neither a conclusion event nor an opening date can't be aged and stay hot.
+#
+# Each batch of ARCHIVE_BATCH_SIZE OS is its own short transaction, followed by a
+# pause, so dashboard writes and imports wait at most one batch for the write lock.
+# Every column of 'ordens_servico' is moved, read from the table at archive time: a
+# column the archive lacks (added by a later migration, or a legacy one such as
+# 'created_at' kept from an old database) is added to it first, so nothing is lost.
+# ARCHIVE_COLUMNS are the ones the dashboard reads from both tables.
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ILUMINA_ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE_S = 0.05
+ARCHIVE_COLUMNS = ['id', 'protocolo', 'nome', 'endereco', 'zona', 'status', 'responsavel', 'observacao', 'descricao',
+                   'telefone', 'data', 'hora', 'content_hash', 'aberta_em', 'endereco_normalizado', 'duplicata_de']
+# Concluded OS whose conclusion (or opening, if no event records it) is before the cutoff
+ARCHIVE_CANDIDATES_SQL = '''
+    SELECT o.id FROM ordens_servico o
+    WHERE o.status = 'concluida'
+      AND COALESCE((SELECT MAX(e.ocorrido_em) FROM os_eventos e
+                    WHERE e.os_id = o.id AND e.status_para = 'concluida'), o.aberta_em) < ?
+    ORDER BY o.id LIMIT ?
+'''
+
+
+def archive_concluded_os(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                         pause=ARCHIVE_BATCH_PAUSE_S, progress_callback=None):
+    """Move the OS concluded more than older_than_days ago to the archive, batch by batch.
+
+    progress_callback, if given, receives the number of OS archived so far after each
+    batch. Returns the total number of OS archived.
+    """
+    cutoff = int(time.time()) - older_than_days * 86400
+    archived = 0
+    while True:
+        with db_transaction() as conn:
+            ids = [os_id for (os_id,) in conn.execute(ARCHIVE_CANDIDATES_SQL, (cutoff, batch_size))]
+            if ids:
+                columns = ', '.join(f'"{column}"' for column in sync_archive_columns(conn))
+                placeholders = ', '.join('?' for _ in ids)
+                conn.execute(f'''
+                    INSERT INTO ordens_servico_arquivo ({columns}, arquivada_em)
+                    SELECT {columns}, ? FROM ordens_servico WHERE id IN ({placeholders})
+                ''', [int(time.time())] + ids)
+                conn.execute(f'DELETE FROM ordens_servico WHERE id IN ({placeholders})', ids)
+        archived += len(ids)
+        if progress_callback and ids:
+            progress_callback(archived)
+        if len(ids) < batch_size:
+            return archived
+        time.sleep(pause) # Let other writers in between batches
+
+
+def sync_archive_columns(conn):
+    """The columns of 'ordens_servico', after adding those it lacks to 'ordens_servico_arquivo'."""
+    archive_columns = {row[1] for row in conn.execute('PRAGMA table_info(ordens_servico_arquivo)')}
+    columns = []
+    for _, name, declared_type, *_ in conn.execute('PRAGMA table_info(ordens_servico)').fetchall():
+        if name not in archive_columns:
+            conn.execute(f'ALTER TABLE ordens_servico_arquivo ADD COLUMN "{name}" {declared_type}')
+            bump_data_version() # Schema changed: cached results (e.g. PRAGMA table_info) are stale
+        columns.append(name)
+    return columns
+
+
+def fetch_archived_protocolos(conn, protocolos):
+    """The protocolos among the given ones that are in the archive."""
+    if not protocolos:
+        return set()
+    protocolos = list(protocolos)
+    placeholders = ', '.join('?' for _ in protocolos)
+    return {protocolo for (protocolo,) in conn.execute(
+        f'SELECT protocolo FROM ordens_servico_arquivo WHERE protocolo IN ({placeholders})', protocolos)}
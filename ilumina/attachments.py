@@ -0,0 +1,231 @@
+# ilumina/attachments.py
+"""Photo attachments of OS: content-addressed files on disk, metadata in 'anexos'."""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .db import db_transaction, get_db_path, run_query
+
+logger = logging.getLogger('ilumina')
+
+# Each uploaded file is stored once, under the SHA-256 of its content
+# (objetos/ab/abcdef...), however many times or to however many OS it is attached;
+# 'anexos' has one row per OS (protocolo) and file. Rows are keyed by protocolo, so
+# attachments stay with an OS when it is archived or re-imported. A file is removed
+# from disk when the last row pointing at it is deleted. Files are moved into the
+# store and removed from it inside write transactions that also check 'anexos', so
+# an upload and a deletion of the same file can't interleave.
+#
+# Thumbnails (miniaturas/ab/abcdef....jpg) are made once per file by a background
+# thread, from a reduced-scale decode of the photo, and then read from disk. The
+# dashboard only asks for them when an OS's photos are opened, so listing OS never
+# reads a photo; the full-size file is only read when downloaded. A file whose
+# thumbnail can't be made (corrupt, or too large) is remembered, per process, and not
+# decoded again: the dashboard shows a placeholder for it instead.
+ATTACHMENT_MAX_BYTES = 15 * 1024 * 1024
+# Decoding needs about 3-4 bytes per pixel: larger images (such as a small PNG that
+# declares 20000x20000 pixels) are refused before anything decodes them. Well below
+# Pillow's own decompression bomb limit, and above any phone camera.
+ATTACHMENT_MAX_PIXELS = 64_000_000
+ATTACHMENT_FORMATS = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+ATTACHMENT_EXTENSIONS = ['jpg', 'jpeg', 'png', 'webp']
+ATTACHMENT_COLUMNS = ['id', 'protocolo', 'sha256', 'nome_arquivo', 'tipo', 'tamanho', 'largura', 'altura', 'usuario',
+                      'criado_em']
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = 1
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_thumbnail_executor = None
+_thumbnail_pending = set() # SHA-256 of the thumbnails being made
+_thumbnail_failed = set() # SHA-256 of the files whose thumbnail failed
+_thumbnail_lock = threading.Lock()
+
+
+def get_attachments_dir():
+    """Where attachments are kept: $ILUMINA_ANEXOS_DIR, or 'anexos' next to the database."""
+    path = (os.environ.get('ILUMINA_ANEXOS_DIR')
+            or os.path.join(os.path.dirname(os.path.abspath(get_db_path())), 'anexos'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def object_path(sha256):
+    return os.path.join(get_attachments_dir(), 'objetos', sha256[:2], sha256)
+
+
+def thumbnail_path(sha256):
+    return os.path.join(get_attachments_dir(), 'miniaturas', sha256[:2], f'{sha256}.jpg')
+
+
+def read_attachment(sha256):
+    with open(object_path(sha256), 'rb') as attachment_file:
+        return attachment_file.read()
+
+
+def receive_upload(file_obj):
+    """Copy file_obj to a temporary file in the store. Returns (temporary path, sha256, size)."""
+    digest = hashlib.sha256()
+    size = 0
+    objects_dir = os.path.join(get_attachments_dir(), 'objetos')
+    os.makedirs(objects_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='envio-', dir=objects_dir)
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            while chunk := file_obj.read(COPY_BUFFER_SIZE):
+                size += len(chunk)
+                if size > ATTACHMENT_MAX_BYTES:
+                    raise ValueError(f"Arquivo maior que {ATTACHMENT_MAX_BYTES // (1024 * 1024)} MB.")
+                digest.update(chunk)
+                output.write(chunk)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+
+def read_image_info(path):
+    """(mime type, width, height) of an image in one of ATTACHMENT_FORMATS; ValueError otherwise."""
+    from PIL import Image, UnidentifiedImageError # Imported lazily: only needed for attachments
+    try:
+        with Image.open(path) as image:
+            image_format, (width, height) = image.format, image.size
+    except Image.DecompressionBombError: # Neither a ValueError nor an OSError
+        width = height = ATTACHMENT_MAX_PIXELS
+        image_format = None
+    except (UnidentifiedImageError, OSError):
+        width = height = 0
+        image_format = None
+    if width * height > ATTACHMENT_MAX_PIXELS:
+        raise ValueError(f"Imagem grande demais (máximo de {ATTACHMENT_MAX_PIXELS // 1_000_000} megapixels).")
+    if image_format not in ATTACHMENT_FORMATS:
+        raise ValueError("O arquivo não é uma imagem JPEG, PNG ou WebP.")
+    return ATTACHMENT_FORMATS[image_format], width, height
+
+
+def add_attachment(protocolo, file_obj, nome_arquivo=None, usuario=None):
+    """Attach an uploaded photo to the OS protocolo. Returns (sha256, added): False if already attached."""
+    if not run_query('SELECT 1 FROM ordens_servico WHERE protocolo = ?', (protocolo,)):
+        raise ValueError(f"OS {protocolo} não encontrada (OS arquivadas não recebem anexos).")
+    temp_path, sha256, size = receive_upload(file_obj)
+    try:
+        tipo, largura, altura = read_image_info(temp_path)
+        with db_transaction() as conn:
+            added = conn.execute('''
+                INSERT OR IGNORE INTO anexos (protocolo, sha256, nome_arquivo, tipo, tamanho, largura, altura,
+                                              usuario, criado_em)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (protocolo, sha256, nome_arquivo, tipo, size, largura, altura, usuario,
+                  int(time.time()))).rowcount == 1
+            # Under the write lock, so remove_unreferenced_objects() can't delete the file meanwhile
+            path = object_path(sha256)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    request_thumbnail(sha256)
+    return sha256, added
+
+
+def list_attachments(protocolo):
+    """The attachments of an OS, oldest first."""
+    return run_query(f'SELECT {", ".join(ATTACHMENT_COLUMNS)} FROM anexos WHERE protocolo = ? ORDER BY id',
+                     (protocolo,), as_dict=True)
+
+
+def count_attachments(protocolos):
+    """{protocolo: number of attachments} for the given OS (those without any are left out)."""
+    if not protocolos:
+        return {}
+    placeholders = ', '.join('?' for _ in protocolos)
+    return dict(run_query(f'SELECT protocolo, COUNT(*) FROM anexos WHERE protocolo IN ({placeholders}) '
+                          f'GROUP BY protocolo', list(protocolos)))
+
+
+def delete_os_attachments(conn, protocolos):
+    """Delete the 'anexos' rows of the given OS in the caller's transaction.
+
+    Returns the SHA-256 of their files; pass them to remove_unreferenced_objects()
+    after the transaction commits.
+    """
+    placeholders = ', '.join('?' for _ in protocolos)
+    rows = conn.execute(f'SELECT DISTINCT sha256 FROM anexos WHERE protocolo IN ({placeholders})',
+                        list(protocolos)).fetchall()
+    conn.execute(f'DELETE FROM anexos WHERE protocolo IN ({placeholders})', list(protocolos))
+    return [sha256 for (sha256,) in rows]
+
+
+def remove_unreferenced_objects(sha256s):
+    """Remove the files (and thumbnails) of the given SHA-256 that no 'anexos' row points at."""
+    # Checked and removed under the write lock, see add_attachment()
+    with db_transaction() as conn:
+        for sha256 in sha256s:
+            if conn.execute('SELECT 1 FROM anexos WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone():
+                continue
+            for path in (object_path(sha256), thumbnail_path(sha256)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+# --- Thumbnails ---
+def build_thumbnail(sha256):
+    """Make the thumbnail of a stored file (if missing). Returns its path."""
+    from PIL import Image, ImageOps # Imported lazily: only needed for attachments
+    path = thumbnail_path(sha256)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with Image.open(object_path(sha256)) as image:
+        if image.width * image.height > ATTACHMENT_MAX_PIXELS: # Stored before the limit existed
+            raise ValueError(f"{sha256}: {image.width}x{image.height} pixels")
+        # JPEG photos are decoded directly at a fraction (1/2 to 1/8) of their size
+        image.draft('RGB', THUMBNAIL_SIZE)
+        thumbnail = ImageOps.exif_transpose(image).convert('RGB')
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    fd, temp_path = tempfile.mkstemp(prefix='miniatura-', suffix='.jpg', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as output:
+        thumbnail.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    os.replace(temp_path, path)
+    return path
+
+
+def request_thumbnail(sha256):
+    """Path of the thumbnail if it exists; otherwise queue it (once) and return None.
+
+    Also None, without queuing anything, once making it failed (see thumbnail_failed()).
+    """
+    global _thumbnail_executor
+    path = thumbnail_path(sha256)
+    if os.path.exists(path):
+        return path
+    with _thumbnail_lock:
+        if sha256 in _thumbnail_pending or sha256 in _thumbnail_failed:
+            return None
+        if _thumbnail_executor is None:
+            _thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='ilumina-thumb')
+        _thumbnail_pending.add(sha256)
+    _thumbnail_executor.submit(_make_thumbnail, sha256)
+    return None
+
+
+def thumbnail_failed(sha256):
+    with _thumbnail_lock:
+        return sha256 in _thumbnail_failed
+
+
+def _make_thumbnail(sha256):
+    try:
+        build_thumbnail(sha256)
+    except Exception:
+        logger.exception(f"Thumbnail of {sha256} failed")
+        with _thumbnail_lock:
+            _thumbnail_failed.add(sha256)
+    finally:
+        with _thumbnail_lock:
+            _thumbnail_pending.discard(sha256)
@@ -0,0 +1,295 @@
+# ilumina/auth.py
+"""Password checks off the script thread, login rate limiting and signed session tokens."""
+import base64
+import functools
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from .db import db_connection, db_transaction, run_query
+
+# Password hashes are deliberately slow (werkzeug's scrypt takes tens of ms of CPU),
+# so they are checked by a small pool of AUTH_WORKERS threads instead of the script
+# thread of each login: a burst of logins at shift change (or a brute-force attempt)
+# queues there and uses at most AUTH_WORKERS cores, while the other sessions keep
+# rerunning. Logins beyond AUTH_MAX_PENDING checks queued or running (including ones
+# whose login stopped waiting) are turned away at once. An unknown username is
+# checked against a dummy hash, in the pool like any other, so it takes as long to
+# refuse as a wrong password and the response time doesn't tell which users exist.
+#
+# Failed logins are counted per user and client IP, and per client IP, over
+# LOGIN_FAILURE_WINDOW_S; past those limits, further attempts are refused without
+# hashing anything until the oldest failure leaves the window. Counting per user and
+# IP (not per user alone) means nobody can lock a user out by failing on purpose from
+# elsewhere. Across all IPs, a username with LOGIN_THROTTLE_AFTER_FAILURES recent
+# failures is slowed down instead: its attempts are spaced LOGIN_THROTTLE_INTERVAL_S
+# apart (waiting up to LOGIN_THROTTLE_MAX_WAIT_S for a turn), which bounds guessing
+# from many IPs while the real user can still log in. The counts are kept in memory,
+# per process.
+#
+# Behind a reverse proxy every client reaches the app from the proxy's address, so
+# the per-IP counts would lump all users together: set ILUMINA_PROXY_HOPS to the
+# number of proxies in front of the app to take the client IP from the
+# X-Forwarded-For header they add instead (see resolve_client_ip). Only set it when
+# the app can't be reached bypassing the proxies, or clients can pick their IP.
+#
+# PASSWORD_HASH_METHOD (any werkzeug method, e.g. 'scrypt:32768:8:1' or
+# 'pbkdf2:sha256:600000') is used for new passwords, and a stored hash made with
+# other parameters is replaced by a new one on the user's next successful login.
+AUTH_WORKERS = int(os.environ.get('ILUMINA_AUTH_WORKERS', '2'))
+AUTH_MAX_PENDING = int(os.environ.get('ILUMINA_AUTH_MAX_PENDING', '32'))
+AUTH_TIMEOUT_S = 15
+PASSWORD_HASH_METHOD = os.environ.get('ILUMINA_PASSWORD_HASH', 'scrypt:32768:8:1')
+LOGIN_FAILURE_WINDOW_S = 300
+LOGIN_MAX_FAILURES_PER_USER_IP = 5
+LOGIN_MAX_FAILURES_PER_IP = 20
+LOGIN_THROTTLE_AFTER_FAILURES = 10
+LOGIN_THROTTLE_INTERVAL_S = 2.0
+LOGIN_THROTTLE_MAX_WAIT_S = 10.0
+TRUSTED_PROXY_HOPS = int(os.environ.get('ILUMINA_PROXY_HOPS', '0'))
+LOGIN_FAILURE_KEYS_MAX = 10000 # Past this, keys whose failures all left the window are dropped
+
+# A successful login gets a session token (username, expiry and an HMAC signature)
+# that the dashboard keeps in the page URL, so a reconnect or a reload resumes the
+# session without the password (and its hash). The signature also covers the
+# user's session version (users.sessao_versao), which end_sessions() bumps on logout
+# and on a password change: that invalidates every token issued to the user before.
+# The key is $ILUMINA_SESSION_SECRET or a random one stored in the database
+# ('configuracao').
+#
+# Being in the URL, a token also ends up in the browser history, in bookmarks, in
+# links copied from the address bar and in proxy access logs, and whoever has it is
+# logged in as the user. So tokens are short-lived: the dashboard replaces the token
+# with a new one when it resumes a session and, while the session is in use, once
+# half of SESSION_TOKEN_TTL_S has passed (see app_streamlit). A leaked URL is
+# useless after at most SESSION_TOKEN_TTL_S, or at once after the user logs out.
+SESSION_TOKEN_TTL_S = int(float(os.environ.get('ILUMINA_SESSION_HOURS', '2')) * 3600)
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(AUTH_MAX_PENDING)
+_dummy_hash = None
+_dummy_hash_lock = threading.Lock()
+_failures = {} # ('usuario_ip', username, ip), ('ip', ip) or ('usuario', username) -> deque of failure times
+_next_attempt = {} # Throttled username -> when its next attempt may be checked
+_failures_lock = threading.Lock()
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+@functools.lru_cache(maxsize=None)
+def current_hash_prefix():
+    """The 'method:parameters' part of hashes made now (werkzeug fills in the defaults of a short method)."""
+    return hash_password('').split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != current_hash_prefix()
+
+
+def _dummy_password_hash():
+    """Checked instead of a real hash for unknown usernames; made once, in the pool."""
+    global _dummy_hash
+    if _dummy_hash is None:
+        with _dummy_hash_lock: # A burst of unknown usernames makes it once
+            if _dummy_hash is None:
+                _dummy_hash = hash_password(secrets.token_hex(16))
+    return _dummy_hash
+
+
+def get_auth_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix='ilumina-auth')
+                _executor.submit(_dummy_password_hash) # Usually ready before the first unknown username
+    return _executor
+
+
+def _check_password(password_hash, password):
+    """(valid, new hash or None), run in the pool. password_hash None: an unknown user (never valid)."""
+    if password_hash is None:
+        check_password_hash(_dummy_password_hash(), password)
+        return False, None
+    if not check_password_hash(password_hash, password):
+        return False, None
+    return True, hash_password(password) if needs_rehash(password_hash) else None
+
+
+# --- Rate limiting ---
+def resolve_client_ip(remote_ip, forwarded_for=None):
+    """The client's IP: remote_ip, or the address the TRUSTED_PROXY_HOPS proxies put in X-Forwarded-For."""
+    if TRUSTED_PROXY_HOPS and forwarded_for:
+        # Each proxy appends the address it got the request from; earlier entries are the client's to make up
+        addresses = [address.strip() for address in forwarded_for.split(',') if address.strip()]
+        if len(addresses) >= TRUSTED_PROXY_HOPS:
+            return addresses[-TRUSTED_PROXY_HOPS]
+    return remote_ip
+
+
+def _lockout_keys(username, client_ip):
+    """(key, limit) of the failure counts that refuse a login attempt once at their limit."""
+    keys = [(('usuario_ip', username.strip().lower(), client_ip), LOGIN_MAX_FAILURES_PER_USER_IP)]
+    if client_ip:
+        keys.append((('ip', client_ip), LOGIN_MAX_FAILURES_PER_IP))
+    return keys
+
+
+def _recent_failures(key, now):
+    """The failures of key still in the window (with _failures_lock held)."""
+    failures = _failures.get(key)
+    while failures and failures[0] <= now - LOGIN_FAILURE_WINDOW_S:
+        failures.popleft()
+    return failures or ()
+
+
+def login_retry_after(username, client_ip=None, now=None):
+    """Seconds until username (from client_ip) may try to log in again; 0 if it may now."""
+    now = time.time() if now is None else now
+    wait = 0.0
+    with _failures_lock:
+        for key, limit in _lockout_keys(username, client_ip):
+            failures = _recent_failures(key, now)
+            if len(failures) >= limit:
+                wait = max(wait, failures[0] + LOGIN_FAILURE_WINDOW_S - now)
+    return wait
+
+
+def reserve_login_turn(username, now=None):
+    """Seconds username's attempt must wait for its turn (0 unless throttled), or None if over the maximum."""
+    now = time.time() if now is None else now
+    username = username.strip().lower()
+    with _failures_lock:
+        if len(_recent_failures(('usuario', username), now)) < LOGIN_THROTTLE_AFTER_FAILURES:
+            return 0.0
+        turn = max(now, _next_attempt.get(username, 0.0))
+        if turn - now > LOGIN_THROTTLE_MAX_WAIT_S:
+            return None
+        _next_attempt[username] = turn + LOGIN_THROTTLE_INTERVAL_S
+    return turn - now
+
+
+def record_login_failure(username, client_ip=None):
+    now = time.time()
+    with _failures_lock:
+        if len(_failures) > LOGIN_FAILURE_KEYS_MAX:
+            for key in [key for key, failures in _failures.items() if failures[-1] <= now - LOGIN_FAILURE_WINDOW_S]:
+                del _failures[key]
+            for username in [username for username, turn in _next_attempt.items() if turn <= now]:
+                del _next_attempt[username]
+        keys = _lockout_keys(username, client_ip)
+        keys.append((('usuario', username.strip().lower()), LOGIN_THROTTLE_AFTER_FAILURES))
+        for key, limit in keys:
+            # Only the last 'limit' failures matter for the limit
+            _failures.setdefault(key, deque(maxlen=limit)).append(now)
+
+
+def clear_login_failures(username, client_ip=None):
+    """Forget the failures of username from client_ip (the throttle across IPs stays until they expire)."""
+    with _failures_lock:
+        _failures.pop(('usuario_ip', username.strip().lower(), client_ip), None)
+
+
+def authenticate(username, password, client_ip=None):
+    """{username, role} if the password is right, None if not.
+
+    Raises ValueError (with a message for the user) when the login is refused
+    without checking the password: too many failures, or too many logins queued.
+    client_ip is the one from resolve_client_ip().
+    """
+    retry_after = login_retry_after(username, client_ip)
+    if retry_after > 0:
+        raise ValueError(f"Muitas tentativas de login. Tente novamente em {int(retry_after) + 1} s.")
+    wait = reserve_login_turn(username)
+    if wait is None:
+        raise ValueError("Muitas tentativas de login para este usuário. Tente novamente em instantes.")
+    time.sleep(wait)
+    with db_connection() as conn:
+        user_row = conn.execute('SELECT username, password, role FROM users WHERE username = ?',
+                                (username,)).fetchone()
+    if not _pending.acquire(blocking=False):
+        raise ValueError("Muitos logins ao mesmo tempo. Tente novamente em instantes.")
+    try:
+        future = get_auth_executor().submit(_check_password, user_row[1] if user_row else None, password)
+    except BaseException:
+        _pending.release()
+        raise
+    # Released when the check is done or cancelled, not when this login stops waiting for it
+    future.add_done_callback(lambda _: _pending.release())
+    try:
+        # The script thread only waits here (without holding the GIL) while a pool thread hashes
+        valid, new_hash = future.result(timeout=AUTH_TIMEOUT_S)
+    except FutureTimeoutError:
+        future.cancel() # Dropped if it hasn't started
+        raise ValueError("O servidor está ocupado. Tente novamente em instantes.") from None
+    if user_row is None or not valid:
+        record_login_failure(username, client_ip)
+        return None
+    clear_login_failures(username, client_ip)
+    if new_hash is not None:
+        with db_transaction() as conn:
+            # Unless the password changed meanwhile
+            conn.execute('UPDATE users SET password = ? WHERE username = ? AND password = ?',
+                         (new_hash, user_row[0], user_row[1]))
+    return {'username': user_row[0], 'role': user_row[2]}
+
+
+# --- Session tokens ---
+def get_session_secret():
+    secret = os.environ.get('ILUMINA_SESSION_SECRET')
+    if secret:
+        return secret.encode()
+    return run_query("SELECT valor FROM configuracao WHERE nome = 'segredo_sessao'")[0][0].encode()
+
+
+def _sign(username, expires, session_version):
+    message = f'{username}\n{expires}\n{session_version}'.encode()
+    return hmac.new(get_session_secret(), message, hashlib.sha256).hexdigest()
+
+
+def _user_for_token(username):
+    rows = run_query('SELECT sessao_versao, role FROM users WHERE username = ?', (username,))
+    return rows[0] if rows else None
+
+
+def create_session_token(username, ttl=SESSION_TOKEN_TTL_S):
+    """A signed token that resumes username's session until it expires (or end_sessions(username))."""
+    session_version, _ = _user_for_token(username)
+    expires = int(time.time()) + ttl
+    encoded_username = base64.urlsafe_b64encode(username.encode()).decode().rstrip('=')
+    return f'{encoded_username}.{expires}.{_sign(username, expires, session_version)}'
+
+
+def end_sessions(username, conn=None):
+    """Invalidate every session token of username (in conn's transaction, if given)."""
+    if conn is None:
+        with db_transaction() as conn:
+            return end_sessions(username, conn)
+    conn.execute('UPDATE users SET sessao_versao = sessao_versao + 1 WHERE username = ?', (username,))
+
+
+def verify_session_token(token):
+    """{username, role} of a valid, unexpired session token, else None."""
+    try:
+        encoded_username, expires, signature = token.split('.')
+        username = base64.urlsafe_b64decode(encoded_username + '=' * (-len(encoded_username) % 4)).decode()
+        expires = int(expires)
+    except ValueError: # Also binascii.Error and UnicodeDecodeError
+        return None
+    if expires < time.time():
+        return None
+    user = _user_for_token(username)
+    if user is None or not hmac.compare_digest(signature, _sign(username, expires, user[0])):
+        return None
+    return {'username': username, 'role': user[1]}
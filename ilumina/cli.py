@@ -0,0 +1,159 @@
+# ilumina/cli.py
+"""Command line: python -m ilumina import|export|stats|archive.
+
+Runs the same import, export and aggregate code as the dashboard, without
+Streamlit, so bulk loads and scheduled jobs (cron) don't go through the browser.
+"""
+import argparse
+import json
+import logging
+import shutil
+import sys
+import time
+
+from . import db, queries, schema
+from .archive import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, archive_concluded_os
+from .export import EXPORT_COLUMNS, export_os_csv
+from .importer import import_os_files, new_import_summary
+
+
+def prewarm_aggregates():
+    """Fold pending events into the SLA aggregates and refresh the planner statistics.
+
+    Run after bulk loads, so the first dashboard rerun doesn't pay for them.
+    Returns the number of events folded in.
+    """
+    processed = queries.refresh_sla_aggregates()
+    with db.db_connection() as conn:
+        conn.execute('PRAGMA optimize')
+    return processed
+
+
+def command_import(args):
+    started = time.perf_counter()
+    totals = new_import_summary()
+    failed = 0
+    files = 0
+    for path, summary, error in import_os_files(args.paths, workers=args.workers, usuario=args.usuario):
+        files += 1
+        if error is not None:
+            failed += 1
+            print(f"{path}: ERRO: {error}", file=sys.stderr)
+            continue
+        for key, value in summary.items():
+            totals[key] += value
+        print(f"{path}: {summary['inseridas']} inseridas, {summary['atualizadas']} atualizadas, "
+              f"{summary['inalteradas']} inalteradas, {summary['arquivadas']} arquivadas, "
+              f"{summary['rejeitadas']} rejeitadas")
+    if not files:
+        print("Nenhum arquivo CSV encontrado.", file=sys.stderr)
+        return 1
+    print(f"Total ({files - failed} de {files} arquivos, {time.perf_counter() - started:.1f} s): "
+          f"{totals['inseridas']} inseridas, {totals['atualizadas']} atualizadas, "
+          f"{totals['inalteradas']} inalteradas, {totals['arquivadas']} arquivadas, {totals['rejeitadas']} rejeitadas")
+    if not args.no_prewarm:
+        print(f"Agregados de SLA atualizados ({prewarm_aggregates()} eventos).")
+    return 1 if failed else 0
+
+
+def command_export(args):
+    columns = args.columns.split(',') if args.columns else EXPORT_COLUMNS
+    where_clause, params = queries.build_os_filter_clause(args.zona or 'Todas as Zonas', args.status or 'Todos',
+                                                          args.busca or '', include_archived=args.arquivadas)
+    report_file = export_os_csv(where_clause, params, columns, compress=args.gzip, include_archived=args.arquivadas)
+    with report_file:
+        if args.output == '-':
+            shutil.copyfileobj(report_file, sys.stdout.buffer)
+        else:
+            with open(args.output, 'wb') as output:
+                shutil.copyfileobj(report_file, output)
+            print(f"{queries.count_os(where_clause, params, include_archived=args.arquivadas)} OS -> {args.output}",
+                  file=sys.stderr)
+    return 0
+
+
+def command_stats(args):
+    if args.prewarm:
+        print(f"Agregados de SLA atualizados ({prewarm_aggregates()} eventos).", file=sys.stderr)
+    stats = {
+        'metricas': queries.get_os_metrics(include_archived=args.arquivadas),
+        'por_status': dict(queries.get_counts_by('status', include_archived=args.arquivadas)),
+        'por_zona': dict(queries.get_counts_by('zona', include_archived=args.arquivadas)),
+        'sla_eventos_pendentes': queries.sla_pending_events(),
+    }
+    if args.json:
+        print(json.dumps(stats, ensure_ascii=False, indent=2))
+        return 0
+    metrics = stats['metricas']
+    print(f"Total de OS: {metrics['total']} (pendentes {metrics['pendentes']}, "
+          f"em andamento {metrics['em_andamento']}, concluídas {metrics['concluidas']})")
+    for title, counts in (('Status', stats['por_status']), ('Zona', stats['por_zona'])):
+        print(f"\n{title}:")
+        for value, count in counts.items():
+            print(f"  {value if value is not None else '(vazio)':<30} {count:>8}")
+    if stats['sla_eventos_pendentes']:
+        print("\nHá eventos ainda fora dos agregados de SLA (use --prewarm).")
+    return 0
+
+
+def command_archive(args):
+    started = time.perf_counter()
+    archived = archive_concluded_os(args.days, batch_size=args.batch_size,
+                                    progress_callback=lambda total: logging.info("%d OS arquivadas...", total))
+    print(f"{archived} OS concluídas há mais de {args.days} dias arquivadas ({time.perf_counter() - started:.1f} s).")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m ilumina', description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='SQLite database (default: $ILUMINA_DB_PATH or database.db)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log migrations and other details')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='import relatorio_os CSV files or directories of them')
+    import_parser.add_argument('paths', nargs='+', help='CSV files or directories (searched recursively)')
+    import_parser.add_argument('--workers', type=int, help='files parsed in parallel (default: number of CPUs)')
+    import_parser.add_argument('--usuario', help="user recorded in 'os_eventos' for the import")
+    import_parser.add_argument('--no-prewarm', action='store_true', help="don't refresh the SLA aggregates afterwards")
+    import_parser.set_defaults(handler=command_import)
+
+    export_parser = commands.add_parser('export', help='write a CSV report')
+    export_parser.add_argument('output', help="output file, or '-' for stdout")
+    export_parser.add_argument('--zona')
+    export_parser.add_argument('--status', help='e.g. pendente, em-andamento, concluida')
+    export_parser.add_argument('--busca', help='search protocolo, nome, endereço and observação')
+    export_parser.add_argument('--columns', help=f'comma-separated, any of: {",".join(EXPORT_COLUMNS)}')
+    export_parser.add_argument('--gzip', action='store_true', help='gzip-compress the report')
+    export_parser.add_argument('--arquivadas', action='store_true', help='include archived OS')
+    export_parser.set_defaults(handler=command_export)
+
+    stats_parser = commands.add_parser('stats', help='print OS counts (and pre-warm the aggregates)')
+    stats_parser.add_argument('--prewarm', action='store_true',
+                              help='refresh the SLA aggregates and planner statistics first')
+    stats_parser.add_argument('--json', action='store_true')
+    stats_parser.add_argument('--arquivadas', action='store_true', help='include archived OS')
+    stats_parser.set_defaults(handler=command_stats)
+
+    archive_parser = commands.add_parser('archive', help='move old concluded OS to the archive table')
+    archive_parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                                help=f'archive OS concluded more than this many days ago '
+                                     f'(default: {ARCHIVE_AFTER_DAYS})')
+    archive_parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                                help=f'OS moved per transaction (default: {ARCHIVE_BATCH_SIZE})')
+    archive_parser.set_defaults(handler=command_archive)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    if args.db:
+        db.configure_database(args.db)
+    try:
+        schema.setup_database_once()
+        return args.handler(args)
+    except ValueError as e:
+        print(f"Erro: {e}", file=sys.stderr)
+        return 2
+    finally:
+        db.close_connection_manager()
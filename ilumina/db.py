@@ -0,0 +1,258 @@
+# ilumina/db.py
+"""The shared SQLite connection, write transactions and the cached read path."""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .diagnostics import active_profiler, trace_statements
+
+# The database file, relative to the working directory unless absolute.
+# WARNING: Data will NOT be persistent across deployments/restarts on ephemeral filesystems like Streamlit Cloud.
+# ILUMINA_DB_PATH points the app and the command line at another database
+# (e.g. the generated benchmark databases); configure_database() overrides both.
+_db_path = os.environ.get('ILUMINA_DB_PATH', 'database.db')
+
+
+# --- Database connection ---
+# One read connection and one write connection are opened per process (see
+# get_connection_manager) and shared by every Streamlit session, instead of
+# connecting/closing per statement. WAL mode lets reads proceed while a write is in
+# progress, and keeping writes on their own connection means a transaction waiting
+# for the SQLite write lock (held by a background import or another process) never
+# holds up the sessions that only read. busy_timeout makes concurrent writers wait
+# instead of failing at once; a write that still times out raises
+# sqlite3.OperationalError ("database is locked", see is_database_busy()). The
+# statement caches reuse the prepared statements the dashboard runs on every rerun.
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_CACHED_STATEMENTS = 256
+DATABASE_BUSY_MESSAGE = "O banco de dados está ocupado no momento. Tente novamente em instantes."
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class ConnectionManager:
+    """Process-wide SQLite connection with thread-safe access and transactions."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock() # The read connection
+        self._write_lock = threading.Lock() # The write connection
+        self._conn = self._connect()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._write_conn = self._connect()
+
+    def _connect(self):
+        # isolation_level=None: no implicit transactions, transaction() issues BEGIN/COMMIT itself
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                               check_same_thread=False, cached_statements=SQLITE_CACHED_STATEMENTS)
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Exclusive use of the shared read connection (autocommit)."""
+        with self._lock, trace_statements(self._conn):
+            yield self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in a write transaction: committed on success, rolled back on error.
+
+        The data version is bumped only if the block changed rows; schema changes
+        must call bump_data_version() themselves.
+        """
+        with self._write_lock, trace_statements(self._write_conn):
+            changes_before = self._write_conn.total_changes
+            # IMMEDIATE takes the write lock up front, so a concurrent writer waits
+            # (busy_timeout) here instead of failing halfway through the block.
+            self._write_conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._write_conn
+            except BaseException:
+                self._write_conn.execute('ROLLBACK')
+                raise
+            self._write_conn.execute('COMMIT')
+            changed = self._write_conn.total_changes != changes_before
+        if changed:
+            bump_data_version()
+
+    @contextmanager
+    def writer(self):
+        """A write transaction on a separate connection, for long writes in background jobs.
+
+        The shared connection (and every session reading through it) stays free while
+        the block runs; other writers wait for the write lock as usual (busy_timeout).
+        """
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                               check_same_thread=False)
+        try:
+            conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with trace_statements(conn):
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield conn
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                conn.execute('COMMIT')
+        finally:
+            conn.close()
+        bump_data_version()
+
+    @contextmanager
+    def reader(self):
+        """A separate read-only connection for long scans (e.g. reports).
+
+        It reads from its own WAL snapshot, so it doesn't hold the shared connection
+        (and every other session) while it runs.
+        """
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False)
+        try:
+            with trace_statements(conn):
+                yield conn
+        finally:
+            conn.close()
+
+    def data_version(self):
+        """PRAGMA data_version changes whenever another connection (or process) commits."""
+        with self._lock, trace_statements(self._conn):
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self):
+        with self._lock, self._write_lock:
+            self._conn.close()
+            self._write_conn.close()
+
+
+def get_db_path():
+    return _db_path
+
+
+def configure_database(path):
+    """Use the database at path from now on (closes the current connection, if any)."""
+    global _db_path
+    close_connection_manager()
+    _db_path = path
+
+
+def get_connection_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ConnectionManager(_db_path)
+    return _manager
+
+
+def close_connection_manager():
+    """Close the shared connection; the next get_connection_manager() opens a new one."""
+    global _manager
+    with _manager_lock:
+        manager, _manager = _manager, None
+    if manager is not None:
+        manager.close()
+        bump_data_version() # Results cached from the old connection may belong to another database
+
+
+def db_connection():
+    return get_connection_manager().connection()
+
+
+def db_transaction():
+    return get_connection_manager().transaction()
+
+
+def is_database_busy(error):
+    """True for the sqlite3.OperationalError of a write that timed out waiting for the write lock."""
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+# --- Cached reads ---
+# Streamlit re-executes the whole script on every interaction, so every read made
+# while rendering the dashboard goes through run_query(), which is cached by SQL,
+# parameters and a data version token. The token combines a process-wide counter,
+# bumped after every db_transaction() commit, with PRAGMA data_version of the
+# shared connection, which changes when any other connection commits. Either
+# change makes all previously cached results unreachable: unchanged data is never
+# re-read, and changed data is never stale.
+QUERY_CACHE_MAX_ENTRIES = 512
+
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+
+def get_data_version():
+    return (_data_version, get_connection_manager().data_version())
+
+
+def bump_data_version():
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+
+
+class QueryCache:
+    """Least-recently-used query results of the current data version.
+
+    Results of an older version can never be hit again, so a new version simply
+    empties the cache. Rows are kept as tuples or sqlite3.Row (both immutable) and
+    shared by every session.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+                return None
+            rows = self._entries.get(key)
+            if rows is not None:
+                self._entries.move_to_end(key)
+            return rows
+
+    def put(self, key, version, rows):
+        with self._lock:
+            if version != self._version:
+                return # Read under a version that is already outdated
+            self._entries[key] = rows
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_query_cache = QueryCache(QUERY_CACHE_MAX_ENTRIES)
+
+
+def run_query(sql, params=(), as_dict=False):
+    """Run a read-only query through the cache. Returns a list of tuples (or dicts if as_dict)."""
+    key = (sql, tuple(params), as_dict)
+    version = get_data_version()
+    rows = _query_cache.get(key, version)
+    if rows is None:
+        with db_connection() as conn:
+            c = conn.cursor()
+            if as_dict:
+                c.row_factory = sqlite3.Row
+            c.execute(sql, key[1])
+            rows = c.fetchall()
+            profiler = active_profiler()
+            if profiler:
+                profiler.statement_finished(conn, rows=len(rows))
+        _query_cache.put(key, version, rows)
+    # A fresh list (of fresh dicts) on every call, so callers may change it without touching the cache
+    return [dict(row) for row in rows] if as_dict else list(rows)
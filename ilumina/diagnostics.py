@@ -0,0 +1,110 @@
+# ilumina/diagnostics.py
+"""Rerun profiling and latency history behind the dashboard's 'Diagnóstico' panel."""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# The time of every dashboard rerun goes into a small process-wide history, so p50/p95
+# latency can be watched over a shift. Administrators can also turn on profiling of
+# their own reruns ('Diagnóstico' in the sidebar): the time of each main_dashboard()
+# section and every SQL statement run while rendering it, captured with sqlite3's
+# set_trace_callback(). A statement's time runs from its trace callback to the next
+# one (or to the release of the connection), so it includes fetching its rows. The
+# profiler is thread-local, as each session's script runs in its own thread.
+DIAGNOSTICS_HISTORY_SIZE = 2000
+DIAGNOSTICS_MAX_STATEMENTS = 300
+
+_profiling = threading.local()
+_rerun_history = deque(maxlen=DIAGNOSTICS_HISTORY_SIZE)
+_rerun_history_lock = threading.Lock()
+
+
+class RerunProfiler:
+    """Section timings and SQL statements of one rerun."""
+
+    def __init__(self):
+        self.sections = [] # [(name, ms)]
+        self.statements = [] # [{'sql', 'ms', 'linhas'}], up to DIAGNOSTICS_MAX_STATEMENTS
+        self.statement_count = 0
+        self.sql_ms = 0.0
+        self.tracing = False
+        self._section = None
+        self._statement = None
+
+    def start_section(self, name):
+        self.end_section()
+        self._section = (name, time.perf_counter())
+
+    def end_section(self):
+        if self._section:
+            name, started = self._section
+            self.sections.append((name, (time.perf_counter() - started) * 1000))
+            self._section = None
+
+    def statement_started(self, conn, sql):
+        if sql.startswith('--'):
+            return # Run by a trigger or virtual table: timed as part of the enclosing statement
+        self.statement_finished(conn)
+        self._statement = (sql, time.perf_counter(), conn.total_changes)
+
+    def statement_finished(self, conn, rows=None):
+        """Close the statement in progress; rows defaults to the rows it changed."""
+        if self._statement is None:
+            return
+        sql, started, changes_before = self._statement
+        self._statement = None
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.statement_count += 1
+        self.sql_ms += elapsed_ms
+        if len(self.statements) < DIAGNOSTICS_MAX_STATEMENTS:
+            self.statements.append({'sql': ' '.join(sql.split()), 'ms': elapsed_ms,
+                                    'linhas': rows if rows is not None else conn.total_changes - changes_before})
+
+
+def active_profiler():
+    return getattr(_profiling, 'profiler', None)
+
+
+def set_active_profiler(profiler):
+    _profiling.profiler = profiler
+
+
+def profile_section(name):
+    """Start timing a main_dashboard() section (ends the previous one); no-op unless profiling."""
+    profiler = active_profiler()
+    if profiler:
+        profiler.start_section(name)
+
+
+@contextmanager
+def trace_statements(conn):
+    """Record the statements run on conn in the block, if this thread's rerun is being profiled."""
+    profiler = active_profiler()
+    if profiler is None or profiler.tracing: # Nested use of the (reentrant) connection lock
+        yield conn
+        return
+    profiler.tracing = True
+    conn.set_trace_callback(lambda sql: profiler.statement_started(conn, sql))
+    try:
+        yield conn
+    finally:
+        conn.set_trace_callback(None)
+        profiler.statement_finished(conn)
+        profiler.tracing = False
+
+
+def record_rerun(elapsed_ms):
+    with _rerun_history_lock:
+        _rerun_history.append((time.time(), elapsed_ms))
+
+
+def rerun_latency_summary():
+    """{'reruns', 'desde', 'p50_ms', 'p95_ms'} over the rerun history, or None if it is empty."""
+    with _rerun_history_lock:
+        reruns = list(_rerun_history)
+    if not reruns:
+        return None
+    durations = sorted(elapsed_ms for _, elapsed_ms in reruns)
+    percentile = lambda fraction: durations[min(int(fraction * len(durations)), len(durations) - 1)]
+    return {'reruns': len(reruns), 'desde': reruns[0][0], 'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95)}
@@ -0,0 +1,256 @@
+# ilumina/duplicates.py
+"""Address normalization and detection/merging of duplicate complaints among open OS."""
+import re
+import unicodedata
+
+from .db import db_transaction, run_query
+from .queries import record_os_events
+
+# --- Address normalization ---
+# Citizens type the address freely ("R. Tertuliano Filho, nº 219", "Na avenida Pedro
+# Ivo penal"), so every OS also stores 'endereco_normalizado': lower case, no accents
+# or punctuation, abbreviations expanded, filler words dropped and house numbers moved
+# to the end ('rua tertuliano filho 219'). It is computed in Python when OS are
+# imported (index_os_enderecos()), never by triggers, so plain sqlite3 connections
+# can still write to the database.
+ENDERECO_ABBREVIATIONS = {
+    'r': 'rua', 'av': 'avenida', 'ave': 'avenida', 'tv': 'travessa', 'trav': 'travessa', 'pc': 'praca',
+    'pca': 'praca', 'al': 'alameda', 'rod': 'rodovia', 'est': 'estrada', 'bc': 'beco', 'lot': 'loteamento',
+    'conj': 'conjunto', 'res': 'residencial', 'pov': 'povoado', 'com': 'comunidade', 'vl': 'vila',
+    'jd': 'jardim', 'b': 'bairro', 'sta': 'santa', 'sto': 'santo', 'dr': 'doutor', 'prof': 'professor',
+    'pe': 'padre', 'ver': 'vereador', 'pres': 'presidente', 'gov': 'governador', 'sen': 'senador',
+    'cel': 'coronel', 'mal': 'marechal',
+}
+ENDERECO_STOPWORDS = {'a', 'o', 'as', 'os', 'da', 'de', 'do', 'das', 'dos', 'e', 'na', 'no', 'nas', 'nos', 'em',
+                      'ao', 'n', 'num', 'numero', 's', 'sn', 'perto', 'proximo', 'frente', 'lado'}
+# Words that come before a number that is part of the name, not a house number ('BR 343', 'km 12')
+ENDERECO_NUMBERED_NAMES = {'br', 'pi', 'km', 'quadra', 'lote'}
+# Street types and locality words shared by too many addresses to tell them apart:
+# kept in 'endereco_normalizado' but not used for blocking or similarity
+ENDERECO_GENERIC_WORDS = {'rua', 'avenida', 'travessa', 'praca', 'alameda', 'rodovia', 'estrada', 'beco',
+                          'loteamento', 'conjunto', 'residencial', 'povoado', 'comunidade', 'vila', 'jardim',
+                          'bairro', 'zona', 'rural', 'urbana', 'interior', 'cidade', 'centro', 'pedro', 'ii',
+                          'localidade', 'll', 'segundo', 'piaui'}
+ENDERECO_INDEX_BATCH_SIZE = 500
+
+
+def parse_endereco(endereco):
+    """(words, numbers) of a free-text address: normalized words in order, and the house numbers."""
+    text = ''.join(ch for ch in unicodedata.normalize('NFKD', endereco or '') if not unicodedata.combining(ch))
+    words = []
+    numbers = []
+    for token in re.findall(r'[a-z]+|\d+', text.lower()):
+        if token.isdigit():
+            if words and words[-1] in ENDERECO_NUMBERED_NAMES:
+                words[-1] += token
+            else:
+                numbers.append(int(token))
+            continue
+        token = ENDERECO_ABBREVIATIONS.get(token, token)
+        if token not in ENDERECO_STOPWORDS:
+            words.append(token)
+    return words, numbers
+
+
+def normalize_endereco(endereco):
+    """'R. Tertuliano Filho, nº 219' -> 'rua tertuliano filho 219' (None if nothing is left)."""
+    words, numbers = parse_endereco(endereco)
+    return ' '.join(words + [str(number) for number in numbers]) or None
+
+
+def endereco_keys(endereco_normalizado):
+    """Distinctive words of a normalized address: its blocking keys, also compared for similarity."""
+    return [word for word in (endereco_normalizado or '').split()
+            if not word.isdigit() and len(word) >= 3 and word not in ENDERECO_GENERIC_WORDS]
+
+
+def index_os_enderecos(conn, protocolos=None):
+    """Recompute 'endereco_normalizado' and the blocking keys of the given OS (all OS if protocolos is None).
+
+    Runs on conn, inside the caller's transaction, after the OS were written.
+    """
+    if protocolos is None:
+        batches = [None]
+    else:
+        protocolos = list(protocolos)
+        batches = [protocolos[start:start + ENDERECO_INDEX_BATCH_SIZE]
+                   for start in range(0, len(protocolos), ENDERECO_INDEX_BATCH_SIZE)]
+    for batch in batches:
+        selection = '' if batch is None else f' WHERE protocolo IN ({", ".join("?" for _ in batch)})'
+        rows = conn.execute(f'SELECT id, endereco, zona FROM ordens_servico{selection}', batch or []).fetchall()
+        normalized = [(normalize_endereco(endereco), os_id, zona) for os_id, endereco, zona in rows]
+        if batch is None:
+            conn.execute('DELETE FROM os_endereco_chaves')
+        else:
+            conn.executemany('DELETE FROM os_endereco_chaves WHERE os_id = ?', [(os_id,) for os_id, _, _ in rows])
+        conn.executemany('UPDATE ordens_servico SET endereco_normalizado = ? WHERE id = ?',
+                         [(endereco_normalizado, os_id) for endereco_normalizado, os_id, _ in normalized])
+        conn.executemany('INSERT OR IGNORE INTO os_endereco_chaves (zona, chave, os_id) VALUES (?, ?, ?)',
+                         [(zona or '', key, os_id) for endereco_normalizado, os_id, zona in normalized
+                          for key in endereco_keys(endereco_normalizado)])
+
+
+# --- Possible duplicates ---
+# Candidates are only looked for among open OS of the same zona that share a blocking
+# key ('os_endereco_chaves', indexed on zona + chave), so the work grows with the size
+# of the blocks, not with the square of the number of OS. Keys shared by more than
+# DUPLICATE_MAX_BLOCK_SIZE open OS of a zona are too common to tell anything and are
+# skipped. Each candidate pair is then scored by the trigram similarity of the
+# distinctive words; pairs whose house numbers are far apart are different places.
+# One shared word is not enough ('rua auto freire boa esperanca' and 'comunidade
+# esperanca interior' share only 'esperanca'): a pair must share
+# DUPLICATE_MIN_SHARED_WORDS distinctive words (typos allowed), unless both have the
+# same words or close house numbers, and then must reach the higher
+# DUPLICATE_MIN_SIMILARITY_FEW_WORDS.
+OPEN_STATUSES = ('pendente', 'em-andamento')
+MERGED_STATUS = 'duplicada'
+DUPLICATE_MAX_BLOCK_SIZE = 100
+DUPLICATE_MIN_SIMILARITY = 0.7
+DUPLICATE_MIN_SIMILARITY_FEW_WORDS = 0.85
+DUPLICATE_MIN_SHARED_WORDS = 2
+DUPLICATE_WORD_MIN_SIMILARITY = 0.6 # Trigram Dice coefficient of two spellings of the same word
+DUPLICATE_MAX_NUMBER_DISTANCE = 20 # Houses this close usually share the same lamp post
+
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def endereco_features(endereco_normalizado):
+    """(house numbers, trigrams, distinctive words) of a normalized address, for endereco_similarity()."""
+    words = (endereco_normalizado or '').split()
+    keys = endereco_keys(endereco_normalizado)
+    return [int(word) for word in words if word.isdigit()], trigrams(' '.join(keys)) if keys else set(), keys
+
+
+def shared_word_count(words_a, words_b):
+    """How many words of the shorter list have the same word (or a misspelling of it) in the other."""
+    if len(words_a) > len(words_b):
+        words_a, words_b = words_b, words_a
+    trigrams_b = [trigrams(word) for word in words_b]
+    shared = 0
+    for word in words_a:
+        trigrams_a = trigrams(word)
+        if any(word == other or 2 * len(trigrams_a & other_trigrams) / (len(trigrams_a) + len(other_trigrams))
+               >= DUPLICATE_WORD_MIN_SIMILARITY for other, other_trigrams in zip(words_b, trigrams_b)):
+            shared += 1
+    return shared
+
+
+def endereco_similarity(features_a, features_b):
+    """0..1 similarity of two endereco_features(); 0 if they can't be the same place.
+
+    Mean of the trigram overlap coefficient and Dice coefficient of the distinctive
+    words: a short address contained in a longer one ('joao mendes' in 'travessa joao
+    mendes 166 cristo rei') still scores high, one shared word out of four doesn't.
+    House numbers far apart, or too few shared words (see DUPLICATE_MIN_SHARED_WORDS),
+    give 0.
+    """
+    numbers_a, trigrams_a, words_a = features_a
+    numbers_b, trigrams_b, words_b = features_b
+    close_numbers = False
+    if numbers_a and numbers_b:
+        if min(abs(a - b) for a in numbers_a for b in numbers_b) > DUPLICATE_MAX_NUMBER_DISTANCE:
+            return 0.0
+        close_numbers = True
+    if not trigrams_a or not trigrams_b:
+        return 0.0
+    shared = len(trigrams_a & trigrams_b)
+    overlap = shared / min(len(trigrams_a), len(trigrams_b))
+    dice = 2 * shared / (len(trigrams_a) + len(trigrams_b))
+    similarity = (overlap + dice) / 2
+    if shared_word_count(words_a, words_b) < DUPLICATE_MIN_SHARED_WORDS:
+        if not (close_numbers or set(words_a) == set(words_b)) or similarity < DUPLICATE_MIN_SIMILARITY_FEW_WORDS:
+            return 0.0
+    return similarity
+
+
+def find_duplicate_groups(zona=None):
+    """Groups of open OS that are probably the same complaint, most similar first.
+
+    Each group is {'zona', 'similaridade', 'os': [OS dicts, oldest first]}; pairs above
+    DUPLICATE_MIN_SIMILARITY are chained into groups.
+    """
+    open_placeholders = ', '.join('?' for _ in OPEN_STATUSES)
+    zona_condition = ' AND k.zona = ?' if zona is not None else ''
+    pairs = run_query(f'''
+        WITH abertas AS (
+            SELECT k.zona, k.chave, k.os_id FROM os_endereco_chaves k
+            JOIN ordens_servico o ON o.id = k.os_id
+            WHERE o.status IN ({open_placeholders}){zona_condition}
+        ), blocos AS (
+            SELECT zona, chave FROM abertas GROUP BY zona, chave HAVING COUNT(*) BETWEEN 2 AND ?
+        )
+        SELECT DISTINCT a.os_id, b.os_id FROM blocos
+        JOIN abertas a ON a.zona = blocos.zona AND a.chave = blocos.chave
+        JOIN abertas b ON b.zona = blocos.zona AND b.chave = blocos.chave AND b.os_id > a.os_id
+    ''', list(OPEN_STATUSES) + ([zona] if zona is not None else []) + [DUPLICATE_MAX_BLOCK_SIZE])
+    if not pairs:
+        return []
+    os_ids = sorted({os_id for pair in pairs for os_id in pair})
+    details = {}
+    for start in range(0, len(os_ids), ENDERECO_INDEX_BATCH_SIZE):
+        batch = os_ids[start:start + ENDERECO_INDEX_BATCH_SIZE]
+        for row in run_query(f'''
+                SELECT id, protocolo, nome, endereco, endereco_normalizado, zona, status, aberta_em
+                FROM ordens_servico WHERE id IN ({", ".join("?" for _ in batch)})
+            ''', batch, as_dict=True):
+            details[row['id']] = row
+    features = {os_id: endereco_features(row['endereco_normalizado']) for os_id, row in details.items()}
+
+    # Union-find over the similar pairs
+    parent = {}
+    def root(os_id):
+        while parent.get(os_id, os_id) != os_id:
+            os_id = parent[os_id]
+        return os_id
+    best = {}
+    for id_a, id_b in pairs:
+        similarity = endereco_similarity(features[id_a], features[id_b])
+        if similarity < DUPLICATE_MIN_SIMILARITY:
+            continue
+        root_a, root_b = root(id_a), root(id_b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+        best[id_a] = max(best.get(id_a, 0.0), similarity)
+        best[id_b] = max(best.get(id_b, 0.0), similarity)
+    groups = {}
+    for os_id in best:
+        groups.setdefault(root(os_id), []).append(details[os_id])
+    result = []
+    for members in groups.values():
+        members.sort(key=lambda row: (row['aberta_em'] is None, row['aberta_em'] or 0, row['id']))
+        result.append({'zona': members[0]['zona'], 'similaridade': max(best[row['id']] for row in members),
+                       'os': members})
+    result.sort(key=lambda group: (-group['similaridade'], group['zona'] or '', group['os'][0]['id']))
+    return result
+
+
+def merge_duplicates(principal, duplicatas, usuario=None):
+    """Merge the open OS duplicatas (protocolos) into the OS principal, in one transaction.
+
+    The duplicates get status MERGED_STATUS and 'duplicata_de' = principal, and an
+    'os_eventos' row of tipo 'mesclada'; the principal's observação lists them.
+    They stay in the table, so a later import of the same export doesn't bring
+    them back as new OS. Returns the number of OS merged.
+    """
+    duplicatas = [protocolo for protocolo in duplicatas if protocolo != principal]
+    if not duplicatas:
+        return 0
+    selection = (f'protocolo IN ({", ".join("?" for _ in duplicatas)}) '
+                 f'AND status IN ({", ".join("?" for _ in OPEN_STATUSES)})')
+    params = duplicatas + list(OPEN_STATUSES)
+    with db_transaction() as conn:
+        merged = [protocolo for (protocolo,) in
+                  conn.execute(f'SELECT protocolo FROM ordens_servico WHERE {selection} ORDER BY id', params)]
+        if not merged:
+            return 0
+        record_os_events(conn, 'mesclada', selection, params, status_para=MERGED_STATUS, usuario=usuario)
+        conn.execute(f'UPDATE ordens_servico SET status = ?, duplicata_de = ? WHERE {selection}',
+                     [MERGED_STATUS, principal] + params)
+        conn.execute('''
+            UPDATE ordens_servico SET observacao = COALESCE(observacao || char(10), '') || ?
+            WHERE protocolo = ?
+        ''', (f"Duplicatas mescladas: {', '.join(merged)}", principal))
+    return len(merged)
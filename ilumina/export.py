@@ -0,0 +1,50 @@
+# ilumina/export.py
+"""Streaming CSV reports of 'ordens_servico' (and, if asked, of the archive)."""
+import csv
+import gzip
+import io
+import tempfile
+
+from .db import get_connection_manager
+from .queries import os_source
+
+
+# --- Report export ---
+# Reports are streamed: rows are fetched in batches with fetchmany() from a dedicated
+# read-only connection and written through csv.writer (optionally gzip-compressed)
+# into a spooled temp file, which moves to disk once it grows past
+# EXPORT_SPOOL_MAX_SIZE. Only the final file is ever read back into memory.
+EXPORT_FETCH_SIZE = 1000
+EXPORT_SPOOL_MAX_SIZE = 5 * 1024 * 1024
+EXPORT_COLUMNS = ['protocolo', 'nome', 'endereco', 'zona', 'status', 'responsavel', 'observacao',
+                  'descricao', 'telefone', 'data', 'hora']
+
+
+def export_os_csv(where_clause, params, columns, compress=False, include_archived=False):
+    """Write the OS matching where_clause as CSV into a spooled temp file, returned rewound to the start.
+
+    With include_archived archived OS are exported too (where_clause from
+    build_os_filter_clause(..., include_archived=True)).
+    """
+    invalid = [col for col in columns if col not in EXPORT_COLUMNS]
+    if invalid:
+        raise ValueError(f"Colunas inválidas para o relatório: {invalid}")
+    report_file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
+    binary_stream = gzip.GzipFile(fileobj=report_file, mode='wb') if compress else report_file
+    text_stream = io.TextIOWrapper(binary_stream, encoding='utf-8', newline='')
+    writer = csv.writer(text_stream, lineterminator='\n') # Same line endings as DataFrame.to_csv
+    writer.writerow(columns)
+    with get_connection_manager().reader() as conn:
+        cursor = conn.execute(f'SELECT {", ".join(columns)} FROM {os_source(include_archived)}{where_clause} '
+                              f'ORDER BY id', params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            writer.writerows(rows)
+    text_stream.flush()
+    text_stream.detach() # Keep the underlying streams open
+    if compress:
+        binary_stream.close() # Writes the gzip trailer; report_file stays open
+    report_file.seek(0)
+    return report_file
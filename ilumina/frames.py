@@ -0,0 +1,30 @@
+# ilumina/frames.py
+"""Compact pandas DataFrames from query rows, for the dashboard's tables and charts."""
+
+# The dashboard never loads 'ordens_servico' into a DataFrame: each table or chart
+# selects the few columns it shows (an aggregate, a page, a duplicate group) and
+# rows_to_frame() builds the frame from those rows column by column, without an
+# object-dtype frame in between. Columns with few distinct values are stored as
+# 'category' (small integer codes plus one copy of each label) instead of one
+# Python string per row, and integer columns are downcast. pandas' copy-on-write
+# makes the frames derived from them (filters, renames) views until written to.
+FRAME_CATEGORY_COLUMNS = frozenset({'status', 'zona', 'responsavel', 'role', 'metrica', 'dia'})
+
+
+def rows_to_frame(rows, columns, categories=FRAME_CATEGORY_COLUMNS):
+    """DataFrame of the given columns of rows (tuples in the order of columns, or dicts), compactly typed."""
+    import pandas as pd # Imported lazily: the login page and the command line don't need it
+    if rows and isinstance(rows[0], dict):
+        values = [[row[col] for row in rows] for col in columns]
+    else:
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+    data = {}
+    for col, column_values in zip(columns, values):
+        if col in categories:
+            data[col] = pd.Categorical(column_values)
+            continue
+        series = pd.Series(column_values)
+        if pd.api.types.is_integer_dtype(series.dtype):
+            series = pd.to_numeric(series, downcast='integer')
+        data[col] = series
+    return pd.DataFrame(data, columns=columns, copy=False)
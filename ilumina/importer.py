@@ -0,0 +1,338 @@
+# ilumina/importer.py
+"""Import of relatorio_os CSV exports into 'ordens_servico', one upload or many files at once."""
+import hashlib # Needed for the per-row content hash of CSV imports
+import os
+import re # Needed to normalize CSV headers and status values
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .archive import fetch_archived_protocolos
+from .db import db_transaction, get_connection_manager
+from .duplicates import MERGED_STATUS, index_os_enderecos
+from .queries import record_os_events
+from .timeutil import parse_data_hora
+
+
+# --- CSV import ---
+# Uploads are read in chunks and upserted on 'protocolo', so memory stays bounded
+# for large monthly exports and existing rows (with their observações and the
+# progress made in the dashboard) are updated, never dropped. Each OS stores a hash
+# of the content it was last imported with ('content_hash'), so re-importing an
+# overlapping export only writes the rows that are new or changed.
+#
+# Background imports (and the command line) parse IMPORT_COMMIT_EVERY_CHUNKS chunks
+# outside any transaction and then write them in one short transaction, so the
+# SQLite write lock is never held for a whole file: the dashboard's writes wait at
+# most one batch instead of timing out (busy_timeout) behind a large export. A file
+# that fails halfway keeps the batches already written; importing it again skips
+# them as unchanged.
+IMPORT_CHUNK_SIZE = 500
+IMPORT_COMMIT_EVERY_CHUNKS = 10
+IMPORT_ESSENTIAL_COLUMNS = ['protocolo', 'nome', 'endereco', 'status', 'responsavel']
+IMPORT_OPTIONAL_COLUMNS = ['zona', 'observacao', 'descricao', 'telefone', 'data', 'hora']
+IMPORT_DEFAULT_ZONA = 'Não Especificada' # Default value for missing zona
+# Only the imported columns are read from the CSV (usecols), and chunks are turned
+# into rows column by column. Status, zona and responsável repeat a handful of
+# values, so they are stripped and normalized once per distinct value and expanded
+# through their factorize() codes instead of once per row.
+IMPORT_CATEGORY_COLUMNS = ('status', 'zona', 'responsavel')
+
+
+def strip_accents(text):
+    return ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+
+
+def normalize_csv_header(header):
+    """'Endereço' -> 'endereco', 'Responsável' -> 'responsavel', ' Descrição ' -> 'descricao'."""
+    return re.sub(r'\s+', '_', strip_accents(str(header)).strip().lower())
+
+
+def normalize_status(value):
+    """'Pendente' -> 'pendente', 'Em Andamento' -> 'em-andamento', 'Concluída' -> 'concluida'."""
+    if not value:
+        return 'pendente'
+    return re.sub(r'[\s_]+', '-', strip_accents(value).strip().lower())
+
+
+def build_upsert_sql(columns):
+    """INSERT ... ON CONFLICT(protocolo) DO UPDATE for the columns present in the upload.
+
+    Blank values never erase what is already stored, a file that still reports
+    an OS as 'pendente' does not undo a status change made in the dashboard, and an
+    OS merged as a duplicate stays merged.
+    """
+    updates = []
+    for col in columns:
+        if col == 'protocolo':
+            continue
+        if col == 'content_hash':
+            updates.append('content_hash = excluded.content_hash')
+            continue
+        if col == 'status':
+            updates.append(f"status = CASE WHEN excluded.status = 'pendente' OR ordens_servico.status = "
+                           f"'{MERGED_STATUS}' THEN ordens_servico.status ELSE excluded.status END")
+        else:
+            updates.append(f'{col} = COALESCE(excluded.{col}, ordens_servico.{col})')
+    return (f'INSERT INTO ordens_servico ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)}) '
+            f'ON CONFLICT(protocolo) DO UPDATE SET {", ".join(updates)}')
+
+
+def read_csv_chunks(csv_file, chunk_size=IMPORT_CHUNK_SIZE):
+    """Yield DataFrame chunks of the imported columns of the upload, with normalized headers, values as str."""
+    import pandas as pd # Imported lazily: the dashboard's login page doesn't need it
+    imported = set(IMPORT_ESSENTIAL_COLUMNS + IMPORT_OPTIONAL_COLUMNS)
+    reader = pd.read_csv(csv_file, chunksize=chunk_size, dtype=str, keep_default_na=False, encoding='utf-8-sig',
+                         usecols=lambda col: normalize_csv_header(col) in imported)
+    for chunk in reader:
+        chunk.columns = [normalize_csv_header(col) for col in chunk.columns]
+        yield chunk
+
+
+def chunk_to_rows(chunk, columns):
+    """Convert a normalized chunk into parameter tuples for build_upsert_sql(columns), skipping rows without protocolo."""
+    values = {}
+    for col in columns:
+        if col == 'aberta_em':
+            continue # Derived from data + hora below
+        if col not in chunk.columns:
+            values[col] = [IMPORT_DEFAULT_ZONA if col == 'zona' else None] * len(chunk)
+            continue
+        column = chunk[col].fillna('') # Fields missing at the end of a short line
+        if col in IMPORT_CATEGORY_COLUMNS:
+            codes, distinct = column.factorize()
+            normalized = [value.strip() or None for value in distinct]
+            if col == 'status':
+                normalized = [normalize_status(value) for value in normalized]
+            values[col] = [normalized[code] for code in codes]
+        else:
+            values[col] = [value or None for value in column.str.strip()]
+    if 'aberta_em' in columns:
+        values['aberta_em'] = [parse_data_hora(data, hora) for data, hora in
+                               zip(values['data'], values.get('hora') or [None] * len(chunk))]
+    rows = [row for row in zip(*(values[col] for col in columns)) if row[0]]
+    return rows, len(chunk) - len(rows)
+
+
+def row_content_hash(columns, row):
+    """Hash of the imported columns and values of one row (None and '' hash the same)."""
+    payload = '\x1f'.join(f'{col}={value or ""}' for col, value in zip(columns, row))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def fetch_import_state(conn, protocolos):
+    """{protocolo: (content_hash, status)} for the protocolos of a chunk that already exist."""
+    if not protocolos:
+        return {}
+    placeholders = ', '.join('?' for _ in protocolos)
+    rows = conn.execute(f'SELECT protocolo, content_hash, status FROM ordens_servico WHERE protocolo IN ({placeholders})',
+                        list(protocolos)).fetchall()
+    return {protocolo: (content_hash, status) for protocolo, content_hash, status in rows}
+
+
+def parse_os_csv(csv_file):
+    """Yield (columns, rows, rejected) per chunk of a CSV upload.
+
+    Each row holds the values of columns followed by its row_content_hash().
+    Raises ValueError if essential columns are missing.
+    """
+    columns = None
+    for chunk in read_csv_chunks(csv_file):
+        if columns is None:
+            missing = [col for col in IMPORT_ESSENTIAL_COLUMNS if col not in chunk.columns]
+            if missing:
+                raise ValueError(f"Colunas essenciais faltando no CSV: {missing}")
+            columns = IMPORT_ESSENTIAL_COLUMNS + [col for col in IMPORT_OPTIONAL_COLUMNS
+                                                  if col in chunk.columns or col == 'zona']
+            if 'data' in columns:
+                columns.append('aberta_em') # Derived from data + hora in chunk_to_rows()
+        rows, rejected = chunk_to_rows(chunk, columns)
+        yield columns, [row + (row_content_hash(columns, row),) for row in rows], rejected
+
+
+def new_import_summary():
+    return {'inseridas': 0, 'atualizadas': 0, 'inalteradas': 0, 'arquivadas': 0, 'rejeitadas': 0}
+
+
+def write_os_rows(conn, columns, rows, summary, usuario=None):
+    """Upsert the new and changed rows of one parse_os_csv() chunk on conn and log their events.
+
+    Adds the chunk's counts to summary. Rows of archived OS are skipped (counted as
+    'arquivadas'): an export that still lists them must not bring them back as new OS.
+    Must run inside a write transaction.
+    """
+    upsert_sql = build_upsert_sql(columns + ['content_hash'])
+    status_index = columns.index('status')
+    # Compare against the stored hashes; 'known' also catches repeated protocolos within the file
+    known = fetch_import_state(conn, {row[0] for row in rows})
+    archived = fetch_archived_protocolos(conn, {row[0] for row in rows} - known.keys())
+    to_write = []
+    created = []
+    status_changes = []
+    for row in rows:
+        content_hash = row[-1]
+        protocolo = row[0]
+        status = row[status_index]
+        if protocolo in archived:
+            summary['arquivadas'] += 1
+            continue
+        if protocolo not in known:
+            summary['inseridas'] += 1
+            created.append(protocolo)
+        elif known[protocolo][0] != content_hash:
+            summary['atualizadas'] += 1
+            # Same rule as build_upsert_sql(): 'pendente' in the file keeps the stored status
+            old_status = known[protocolo][1]
+            if status == 'pendente' or old_status == MERGED_STATUS:
+                status = old_status
+            if status != old_status and protocolo not in created:
+                status_changes.append((old_status, status, protocolo))
+        else:
+            summary['inalteradas'] += 1
+            continue
+        known[protocolo] = (content_hash, status)
+        to_write.append(row)
+    if to_write:
+        conn.executemany(upsert_sql, to_write)
+        index_os_enderecos(conn, [row[0] for row in to_write])
+    # Events are written after the upsert so they carry the imported responsável/zona
+    now = int(time.time())
+    for start in range(0, len(created), IMPORT_CHUNK_SIZE):
+        batch = created[start:start + IMPORT_CHUNK_SIZE]
+        record_os_events(conn, 'criada', f'protocolo IN ({", ".join("?" for _ in batch)})', batch,
+                         usuario=usuario, ocorrido_em=now)
+    conn.executemany('''
+        INSERT INTO os_eventos (os_id, protocolo, tipo, status_de, status_para, responsavel, zona, usuario, ocorrido_em)
+        SELECT id, protocolo, 'status', ?, ?, responsavel, zona, ?, ? FROM ordens_servico WHERE protocolo = ?
+    ''', [(old_status, status, usuario, now, protocolo) for old_status, status, protocolo in status_changes])
+
+
+def batched(chunks, size=IMPORT_COMMIT_EVERY_CHUNKS):
+    """Lists of up to size items of chunks."""
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_os_csv(csv_file, progress_callback=None, usuario=None, own_connection=False):
+    """Upsert the new and changed rows of a CSV upload into 'ordens_servico'.
+
+    New OS and status changes are logged in 'os_eventos' as done by usuario.
+    progress_callback, if given, receives a fraction between 0 and 1 after each chunk.
+    Without own_connection the whole file is one transaction on the shared
+    connection. With it, as background jobs do, every IMPORT_COMMIT_EVERY_CHUNKS
+    parsed chunks are written in their own transaction on a separate connection
+    (see ConnectionManager.writer()).
+    Returns {'inseridas': n, 'atualizadas': n, 'inalteradas': n, 'arquivadas': n, 'rejeitadas': n}.
+    Raises ValueError if essential columns are missing.
+    """
+    file_size = getattr(csv_file, 'size', None)
+    if file_size is None and hasattr(csv_file, 'fileno'):
+        file_size = os.fstat(csv_file.fileno()).st_size
+    summary = new_import_summary()
+
+    def report_progress():
+        if progress_callback and file_size:
+            progress_callback(min(csv_file.tell() / file_size, 1.0))
+
+    if own_connection:
+        # Parsed before the write transaction starts (batched() reads ahead)
+        for batch in batched(parse_os_csv(csv_file)):
+            with get_connection_manager().writer() as conn:
+                for columns, rows, rejected in batch:
+                    summary['rejeitadas'] += rejected
+                    write_os_rows(conn, columns, rows, summary, usuario)
+            report_progress()
+    else:
+        with db_transaction() as conn:
+            for columns, rows, rejected in parse_os_csv(csv_file):
+                summary['rejeitadas'] += rejected
+                write_os_rows(conn, columns, rows, summary, usuario)
+                report_progress()
+    if progress_callback:
+        progress_callback(1.0)
+    return summary
+
+
+# --- Bulk import (many files) ---
+# Reading, normalizing and hashing the CSV is the CPU-bound part of an import and
+# runs in worker processes, one file each; SQLite takes one writer at a time, so
+# the parsed files are written by the calling process, in batches of chunks (see
+# IMPORT_COMMIT_EVERY_CHUNKS), in the order given (a later export of the same OS wins). At most
+# IMPORT_PARSED_AHEAD parsed files per worker wait in memory for the writer.
+IMPORT_PARSED_AHEAD = 2
+
+
+def find_csv_files(paths):
+    """The CSV files among paths, with directories expanded (recursively, sorted by path)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for directory, _, names in os.walk(path):
+                found.extend(os.path.join(directory, name) for name in names if name.lower().endswith('.csv'))
+            files.extend(sorted(found))
+        else:
+            files.append(path)
+    return files
+
+
+def parse_os_csv_file(path):
+    """All parse_os_csv() chunks of a file (run in a worker process by import_os_files())."""
+    with open(path, 'rb') as csv_file:
+        return list(parse_os_csv(csv_file))
+
+
+def write_parsed_file(chunks, usuario=None):
+    """Write the parse_os_csv_file() chunks of one file, IMPORT_COMMIT_EVERY_CHUNKS per transaction.
+
+    Returns its summary.
+    """
+    summary = new_import_summary()
+    for batch in batched(chunks):
+        with db_transaction() as conn:
+            for columns, rows, rejected in batch:
+                summary['rejeitadas'] += rejected
+                write_os_rows(conn, columns, rows, summary, usuario)
+    return summary
+
+
+def import_os_files(paths, workers=None, usuario=None):
+    """Import many CSV files (or directories of them), parsing up to workers files in parallel.
+
+    Yields (path, summary, error) per file in the order of find_csv_files(paths) as soon
+    as it is written; error is the exception that made the file fail (summary is then
+    None). A failed file keeps the batches already written and the others are still imported.
+    """
+    files = find_csv_files(paths)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(files) or 1))
+    if workers == 1:
+        for path in files:
+            try:
+                yield path, write_parsed_file(parse_os_csv_file(path), usuario), None
+            except (OSError, ValueError) as e:
+                yield path, None, e
+        return
+    import pandas # noqa: F401 -- imported before the pool starts, so forked workers inherit it
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        remaining = iter(files)
+        for path in remaining:
+            pending.append((path, executor.submit(parse_os_csv_file, path)))
+            if len(pending) >= workers * IMPORT_PARSED_AHEAD:
+                break
+        while pending:
+            path, future = pending.popleft()
+            next_path = next(remaining, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(parse_os_csv_file, next_path)))
+            try:
+                yield path, write_parsed_file(future.result(), usuario), None
+            except (OSError, ValueError) as e:
+                yield path, None, e
@@ -0,0 +1,313 @@
+# ilumina/jobs.py
+"""Background jobs: CSV imports, reports and maintenance run off the Streamlit script thread."""
+import json
+import logging
+import os
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .archive import archive_concluded_os
+from .db import DATABASE_BUSY_MESSAGE, db_transaction, get_db_path, is_database_busy, run_query
+from .export import export_os_csv
+from .importer import import_os_csv
+from .queries import build_os_filter_clause, refresh_sla_aggregates
+from .schema import rebuild_os_counters
+
+logger = logging.getLogger('ilumina')
+
+# Long work is submitted as a job: a row in 'jobs' run by a small thread pool of the
+# process that submitted it. The script that submits it returns at once, so a rerun
+# or a closed tab no longer interrupts an import halfway, and the dashboard polls
+# the job's row. Progress changes too often to be written to the database (and an
+# import holds the write lock meanwhile), so the running process keeps it in memory
+# and only status changes are written. Result files (reports) stay in the jobs
+# directory and can be downloaded after any rerun or reconnect, until the job is
+# older than JOB_RETENTION_DAYS.
+#
+# Several processes (app servers, the command line) may run jobs on the same
+# database, so each job records the runner that queued it ('executor'). While a
+# runner has jobs queued or running, it refreshes its row in 'job_runners' every
+# JOB_HEARTBEAT_S from a background thread (an idle one doesn't write, so it doesn't
+# invalidate the query cache for nothing). The same thread marks as failed the jobs
+# whose runner stopped refreshing (JOB_RUNNER_TIMEOUT_S: the process was stopped or
+# crashed) and, every JOB_PURGE_INTERVAL_S, purges old jobs.
+# Imports and the SLA refresh are the long writers: they run one at a time on a pool
+# of their own (JOB_SERIAL_TYPES), so they never compete for the SQLite write lock
+# and reports and maintenance jobs don't wait behind them. The SLA refresh is queued
+# by the dashboard itself (request_sla_refresh), without a user, so it isn't listed
+# in anyone's jobs.
+JOB_WORKERS = int(os.environ.get('ILUMINA_JOB_WORKERS', '2'))
+JOB_SERIAL_TYPES = ('importacao', 'sla')
+JOB_RETENTION_DAYS = 7
+JOB_HEARTBEAT_S = 30
+JOB_RUNNER_TIMEOUT_S = 3 * JOB_HEARTBEAT_S
+JOB_PURGE_INTERVAL_S = 3600
+JOB_ACTIVE_STATUSES = ('na-fila', 'executando')
+JOB_LABELS = {'importacao': 'Importação de CSV', 'relatorio': 'Relatório CSV',
+              'contadores': 'Recálculo dos contadores', 'arquivamento': 'Arquivamento de OS concluídas',
+              'sla': 'Atualização dos agregados de SLA'}
+JOB_COLUMNS = ['id', 'tipo', 'status', 'usuario', 'parametros', 'progresso', 'mensagem', 'resultado', 'arquivo',
+               'criado_em', 'iniciado_em', 'concluido_em']
+
+_executor = None
+_serial_executor = None
+_executor_lock = threading.Lock()
+RUNNER_ID = f'{os.getpid()}-{secrets.token_hex(4)}' # This process's runner in 'job_runners'
+_progress = {} # Job id -> (fraction, mensagem) of the jobs running in this process
+_progress_lock = threading.Lock()
+_owned_jobs = set() # Ids of the jobs queued or running in this process (guarded by _progress_lock)
+
+
+def get_jobs_dir():
+    """Where job inputs and results are kept: $ILUMINA_JOBS_DIR, or 'jobs' next to the database."""
+    path = os.environ.get('ILUMINA_JOBS_DIR') or os.path.join(os.path.dirname(os.path.abspath(get_db_path())), 'jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def save_job_input(file_obj, suffix='.csv'):
+    """Copy an upload into the jobs directory, so a job can still read it after the script returns."""
+    fd, path = tempfile.mkstemp(prefix='entrada-', suffix=suffix, dir=get_jobs_dir())
+    with os.fdopen(fd, 'wb') as output:
+        shutil.copyfileobj(file_obj, output)
+    return path
+
+
+def read_job_file(path):
+    with open(path, 'rb') as result_file:
+        return result_file.read()
+
+
+# --- Job types ---
+# Each handler runs in a pool thread as handler(job_id, parametros, usuario,
+# report_progress) and returns (resultado, mensagem, arquivo): a JSON-serializable
+# result, a summary for the user and the path of a result file (or None).
+def run_import_job(job_id, parametros, usuario, report_progress):
+    try:
+        with open(parametros['arquivo'], 'rb') as csv_file:
+            # Own connection: the dashboard keeps reading through the shared one meanwhile
+            summary = import_os_csv(csv_file, progress_callback=report_progress, usuario=usuario, own_connection=True)
+    finally:
+        os.remove(parametros['arquivo'])
+    mensagem = (f"{summary['inseridas']} inseridas, {summary['atualizadas']} atualizadas, "
+                f"{summary['inalteradas']} inalteradas, {summary['rejeitadas']} rejeitadas.")
+    return summary, mensagem, None
+
+
+def run_report_job(job_id, parametros, usuario, report_progress):
+    where_clause, params = build_os_filter_clause(parametros['zona'], parametros['status'], parametros['busca'],
+                                                  parametros['incluir_arquivadas'])
+    report_progress(0.0, "Gerando relatório...")
+    file_name = 'report.csv.gz' if parametros['gzip'] else 'report.csv'
+    path = os.path.join(get_jobs_dir(), f'{job_id}-{file_name}')
+    with export_os_csv(where_clause, params, parametros['colunas'], compress=parametros['gzip'],
+                       include_archived=parametros['incluir_arquivadas']) as report_file, open(path, 'wb') as output:
+        shutil.copyfileobj(report_file, output)
+    return {'nome_arquivo': file_name}, "Relatório pronto para download.", path
+
+
+def run_counters_job(job_id, parametros, usuario, report_progress):
+    with db_transaction() as conn:
+        rebuild_os_counters(conn)
+    return None, "Contadores de OS recalculados.", None
+
+
+def run_archive_job(job_id, parametros, usuario, report_progress):
+    archived = archive_concluded_os(parametros['dias'],
+                                    progress_callback=lambda total: report_progress(None, f"{total} OS arquivadas..."))
+    mensagem = f"{archived} OS concluídas há mais de {parametros['dias']} dias arquivadas."
+    return {'arquivadas': archived}, mensagem, None
+
+
+def run_sla_job(job_id, parametros, usuario, report_progress):
+    processed = refresh_sla_aggregates(
+        progress_callback=lambda total: report_progress(None, f"{total} eventos processados..."))
+    return {'eventos': processed}, f"{processed} eventos incluídos nos agregados de SLA.", None
+
+
+JOB_HANDLERS = {
+    'importacao': run_import_job,
+    'relatorio': run_report_job,
+    'contadores': run_counters_job,
+    'arquivamento': run_archive_job,
+    'sla': run_sla_job,
+}
+
+
+# --- Runner ---
+def start_job_runner():
+    """The process's job thread pools, created (with the heartbeat thread) on first use.
+
+    Returns (pool, serial pool): the second runs JOB_SERIAL_TYPES one at a time.
+    """
+    global _executor, _serial_executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                fail_interrupted_jobs()
+                purge_old_jobs()
+                threading.Thread(target=_heartbeat_loop, name='ilumina-job-heartbeat', daemon=True).start()
+                _serial_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ilumina-job-serial')
+                _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='ilumina-job')
+    return _executor, _serial_executor
+
+
+def submit_job(tipo, parametros, usuario=None):
+    """Record a job of one of JOB_HANDLERS and queue it on the runner. Returns its id.
+
+    Raises ValueError if the job can't be recorded because the database stayed busy.
+    """
+    if tipo not in JOB_HANDLERS:
+        raise ValueError(f"Tipo de tarefa desconhecido: {tipo}")
+    executor, serial_executor = start_job_runner()
+    try:
+        with db_transaction() as conn:
+            job_id = conn.execute('''
+                INSERT INTO jobs (tipo, status, usuario, parametros, criado_em, executor)
+                VALUES (?, 'na-fila', ?, ?, ?, ?)
+            ''', (tipo, usuario, json.dumps(parametros), int(time.time()), RUNNER_ID)).lastrowid
+            record_heartbeat(conn)
+    except sqlite3.OperationalError as e:
+        if is_database_busy(e):
+            raise ValueError(DATABASE_BUSY_MESSAGE) from e
+        raise
+    with _progress_lock:
+        _owned_jobs.add(job_id)
+    (serial_executor if tipo in JOB_SERIAL_TYPES else executor).submit(run_job, job_id, tipo, parametros, usuario)
+    return job_id
+
+
+def request_sla_refresh():
+    """Queue an 'sla' job unless one is already queued or running. Returns whether one was queued."""
+    if has_active_jobs_of_type('sla'):
+        return False
+    submit_job('sla', {})
+    return True
+
+
+def run_job(job_id, tipo, parametros, usuario):
+    def report_progress(fraction=None, mensagem=None):
+        with _progress_lock:
+            last_fraction, last_mensagem = _progress.get(job_id, (0.0, None))
+            _progress[job_id] = (last_fraction if fraction is None else fraction, mensagem or last_mensagem)
+
+    try:
+        with db_transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'executando', iniciado_em = ? WHERE id = ?",
+                         (int(time.time()), job_id))
+        resultado, mensagem, arquivo = JOB_HANDLERS[tipo](job_id, parametros, usuario, report_progress)
+    except Exception as e:
+        logger.exception(f"Job {job_id} ({tipo}) failed")
+        # ValueError carries a message meant for the user (e.g. missing CSV columns)
+        if isinstance(e, ValueError):
+            mensagem = str(e)
+        elif is_database_busy(e):
+            mensagem = DATABASE_BUSY_MESSAGE
+        else:
+            mensagem = f"{type(e).__name__}: {e}"
+        with db_transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'erro', mensagem = ?, concluido_em = ? WHERE id = ?",
+                         (mensagem, int(time.time()), job_id))
+    else:
+        with db_transaction() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = 'concluida', progresso = 1, mensagem = ?, resultado = ?, arquivo = ?,
+                    concluido_em = ?
+                WHERE id = ?
+            ''', (mensagem, json.dumps(resultado), arquivo, int(time.time()), job_id))
+    finally:
+        with _progress_lock:
+            _progress.pop(job_id, None)
+            _owned_jobs.discard(job_id)
+
+
+def record_heartbeat(conn):
+    """Mark this process's runner as alive, in conn's transaction."""
+    conn.execute('''
+        INSERT INTO job_runners (id, pid, heartbeat_em) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET heartbeat_em = excluded.heartbeat_em
+    ''', (RUNNER_ID, os.getpid(), int(time.time())))
+
+
+def fail_interrupted_jobs():
+    """Mark the jobs left queued or running by a runner that stopped (no recent heartbeat) as failed."""
+    now = int(time.time())
+    with db_transaction() as conn:
+        conn.execute('DELETE FROM job_runners WHERE heartbeat_em < ?', (now - JOB_RUNNER_TIMEOUT_S,))
+        conn.execute(f'''
+            UPDATE jobs SET status = 'erro', mensagem = 'Interrompida: o servidor foi reiniciado.', concluido_em = ?
+            WHERE status IN ({", ".join("?" for _ in JOB_ACTIVE_STATUSES)})
+                AND (executor IS NULL OR executor NOT IN (SELECT id FROM job_runners))
+        ''', [now] + list(JOB_ACTIVE_STATUSES))
+
+
+def _heartbeat_loop():
+    last_purge = time.monotonic()
+    while True:
+        time.sleep(JOB_HEARTBEAT_S)
+        try:
+            with _progress_lock:
+                busy = bool(_owned_jobs)
+            if busy:
+                with db_transaction() as conn:
+                    record_heartbeat(conn)
+            fail_interrupted_jobs()
+            if time.monotonic() - last_purge >= JOB_PURGE_INTERVAL_S:
+                purge_old_jobs()
+                last_purge = time.monotonic()
+        except Exception:
+            # Busy database or the like: the next beat retries (well within JOB_RUNNER_TIMEOUT_S)
+            logger.exception("Job runner heartbeat failed")
+
+
+def purge_old_jobs(older_than_days=JOB_RETENTION_DAYS):
+    """Delete finished jobs older than older_than_days, with their input and result files."""
+    cutoff = int(time.time()) - older_than_days * 86400
+    with db_transaction() as conn:
+        old_jobs = conn.execute(f'''
+            SELECT id, parametros, arquivo FROM jobs
+            WHERE concluido_em < ? AND status NOT IN ({", ".join("?" for _ in JOB_ACTIVE_STATUSES)})
+        ''', [cutoff] + list(JOB_ACTIVE_STATUSES)).fetchall()
+        conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id, _, _ in old_jobs])
+    for _, parametros, arquivo in old_jobs:
+        for path in (arquivo, json.loads(parametros or '{}').get('arquivo')):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+# --- Job status ---
+def with_live_progress(job):
+    """Decode a 'jobs' row; a job running in this process gets its in-memory progress."""
+    job['parametros'] = json.loads(job['parametros'] or 'null')
+    job['resultado'] = json.loads(job['resultado'] or 'null')
+    with _progress_lock:
+        live = _progress.get(job['id'])
+    if live is not None and job['status'] == 'executando':
+        job['progresso'], job['mensagem'] = live[0], live[1] or job['mensagem']
+    return job
+
+
+def list_jobs(usuario, limit=10):
+    """The latest jobs submitted by usuario, newest first."""
+    rows = run_query(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE usuario = ? ORDER BY id DESC LIMIT ?',
+                     (usuario, limit), as_dict=True)
+    return [with_live_progress(row) for row in rows]
+
+
+def has_active_jobs(usuario):
+    return run_query(f'''
+        SELECT EXISTS (SELECT 1 FROM jobs
+                       WHERE usuario = ? AND status IN ({", ".join("?" for _ in JOB_ACTIVE_STATUSES)}))
+    ''', [usuario] + list(JOB_ACTIVE_STATUSES))[0][0] == 1
+
+
+def has_active_jobs_of_type(tipo):
+    return run_query(f'''
+        SELECT EXISTS (SELECT 1 FROM jobs
+                       WHERE tipo = ? AND status IN ({", ".join("?" for _ in JOB_ACTIVE_STATUSES)}))
+    ''', [tipo] + list(JOB_ACTIVE_STATUSES))[0][0] == 1
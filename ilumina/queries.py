@@ -0,0 +1,386 @@
+# ilumina/queries.py
+"""Reads and writes of the OS list, dashboard aggregates, status transitions, events and SLA."""
+import bisect # Needed to place SLA durations in histogram buckets
+import re # Needed to split search terms into words
+import time
+from datetime import datetime
+
+from .archive import ARCHIVE_COLUMNS
+from .db import db_transaction, run_query
+from .timeutil import LOCAL_TZ, SQL_LOCAL_TIME_MODIFIER, TIME_BUCKET_FORMATS
+
+
+# --- OS list queries (pagination) ---
+# The details/actions list only ever fetches one page of 'ordens_servico'.
+# Filters are translated into a SQL WHERE clause and pages are walked with a
+# keyset on 'id' (id > last id of the previous page), so the cost of a rerun
+# does not depend on how many OS exist in the table.
+OS_PAGE_SIZE_OPTIONS = [10, 25, 50, 100]
+OS_LIST_COLUMNS = ['id', 'protocolo', 'nome', 'endereco', 'zona', 'status', 'responsavel', 'observacao',
+                   'descricao', 'telefone', 'data', 'hora', 'duplicata_de']
+# Hot and archived OS together, for the views asked to include archived OS (see
+# ilumina.archive). Ids are kept when an OS is archived, so they stay unique and
+# the keyset pagination works over both; 'arquivada_em' is NULL for hot OS.
+OS_WITH_ARCHIVE_SQL = f'''(
+    SELECT {", ".join(ARCHIVE_COLUMNS)}, NULL AS arquivada_em FROM ordens_servico
+    UNION ALL
+    SELECT {", ".join(ARCHIVE_COLUMNS)}, arquivada_em FROM ordens_servico_arquivo
+)'''
+
+
+def os_source(include_archived=False):
+    """FROM target of the OS views: the hot table, or hot and archived OS together."""
+    return OS_WITH_ARCHIVE_SQL if include_archived else 'ordens_servico'
+
+
+def build_fts_query(search_term):
+    """Turn free text into an FTS5 query: every word must match as a prefix, e.g. 'rua tert' -> '"rua"* "tert"*'."""
+    words = re.findall(r'\w+', search_term)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def build_os_filter_clause(zona_filter, status_filter, search_term, include_archived=False):
+    """Return (where_clause, params) for the zona/status/search filters of the dashboard.
+
+    With include_archived the search also looks in the archive's index; the clause is
+    then meant for os_source(include_archived=True).
+    """
+    conditions = []
+    params = []
+    if zona_filter != 'Todas as Zonas':
+        conditions.append('zona = ?')
+        params.append(zona_filter)
+    if status_filter != 'Todos':
+        conditions.append('status = ?')
+        params.append(status_filter)
+    fts_query = build_fts_query(search_term) if search_term else ''
+    if fts_query:
+        # Indexed lookup on protocolo/nome/endereco/observacao (prefix, case and accent insensitive)
+        search = 'id IN (SELECT rowid FROM ordens_servico_fts WHERE ordens_servico_fts MATCH ?)'
+        params.append(fts_query)
+        if include_archived:
+            search = (f'({search} OR id IN (SELECT rowid FROM ordens_servico_arquivo_fts '
+                      f'WHERE ordens_servico_arquivo_fts MATCH ?))')
+            params.append(fts_query)
+        conditions.append(search)
+    where_clause = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    return where_clause, params
+
+
+def count_os(where_clause, params, include_archived=False):
+    return run_query(f'SELECT COUNT(*) FROM {os_source(include_archived)}{where_clause}', params)[0][0]
+
+
+def fetch_os_page(where_clause, params, after_id, page_size, include_archived=False):
+    """Fetch up to page_size + 1 rows with id > after_id (the extra row tells if there is a next page).
+
+    With include_archived the rows also have 'arquivada_em' (None for OS that are not archived).
+    """
+    keyset = 'id > ?'
+    where_clause = f'{where_clause} AND {keyset}' if where_clause else f' WHERE {keyset}'
+    columns = OS_LIST_COLUMNS + ['arquivada_em'] if include_archived else OS_LIST_COLUMNS
+    rows = run_query(f'SELECT {", ".join(columns)} FROM {os_source(include_archived)}{where_clause} '
+                     f'ORDER BY id LIMIT ?', list(params) + [after_id, page_size + 1], as_dict=True)
+    return rows[:page_size], len(rows) > page_size
+
+
+# --- Dashboard aggregate queries ---
+# Metric cards, filter options and the status/zona charts only need counts, so they
+# are read from the trigger-maintained 'os_contagem' table (one row per zona/status)
+# instead of loading or scanning 'ordens_servico'. Archived OS have their own
+# counters, 'os_contagem_arquivo'.
+OS_COUNTERS_WITH_ARCHIVE_SQL = '''(
+    SELECT zona, status, total FROM os_contagem
+    UNION ALL
+    SELECT zona, status, total FROM os_contagem_arquivo
+)'''
+
+
+def os_counters_source(include_archived=False):
+    return OS_COUNTERS_WITH_ARCHIVE_SQL if include_archived else 'os_contagem'
+
+
+def get_os_metrics(include_archived=False):
+    """Total, pendentes, em andamento and concluídas in a single query."""
+    total, pendentes, em_andamento, concluidas = run_query(f'''
+        SELECT COALESCE(SUM(total), 0),
+               COALESCE(SUM(CASE WHEN status = 'pendente' THEN total END), 0),
+               COALESCE(SUM(CASE WHEN status = 'em-andamento' THEN total END), 0),
+               COALESCE(SUM(CASE WHEN status = 'concluida' THEN total END), 0)
+        FROM {os_counters_source(include_archived)}
+    ''')[0]
+    return {'total': total, 'pendentes': pendentes, 'em_andamento': em_andamento, 'concluidas': concluidas}
+
+
+def get_counts_by(column, include_archived=False):
+    """Return [(value, count), ...] per 'status' or 'zona', most frequent first (None for NULL)."""
+    if column not in ('status', 'zona'):
+        raise ValueError(f"Unsupported group-by column: {column}")
+    return run_query(f'''
+        SELECT NULLIF({column}, ''), SUM(total) FROM {os_counters_source(include_archived)}
+        GROUP BY {column} HAVING SUM(total) > 0
+        ORDER BY SUM(total) DESC, {column}
+    ''')
+
+
+# --- Status transitions ---
+# The transitions offered by the OS action buttons, shared by the per-OS buttons and
+# the bulk actions. 'de' lists the statuses an OS may be in for the action to apply;
+# 'responsavel' says what happens to the responsável: set to the chosen user
+# ('usuario'), kept ('manter') or cleared ('limpar', a pendente OS has no responsável).
+STATUS_TRANSITIONS = {
+    'iniciar': {'label': 'Iniciar Tratamento', 'key': 'start', 'de': ('pendente',), 'para': 'em-andamento',
+                'responsavel': 'usuario', 'mensagem': "marcada como 'em-andamento'"},
+    'concluir': {'label': 'Marcar como Concluída', 'key': 'complete', 'de': ('em-andamento',), 'para': 'concluida',
+                 'responsavel': 'manter', 'mensagem': "marcada como 'concluída'"},
+    'reverter_pendente': {'label': 'Reverter para Pendente', 'key': 'revert_pending', 'de': ('em-andamento',),
+                          'para': 'pendente', 'responsavel': 'limpar', 'mensagem': "revertida para 'pendente'"},
+    'reverter_andamento': {'label': 'Reverter para Em Andamento', 'key': 'revert_inprogress', 'de': ('concluida',),
+                           'para': 'em-andamento', 'responsavel': 'usuario', 'mensagem': "revertida para 'em-andamento'"},
+    # Bulk only: (re)assign a responsável to open OS, which puts them in treatment
+    'atribuir': {'label': 'Atribuir Responsável', 'key': 'assign', 'de': ('pendente', 'em-andamento'),
+                 'para': 'em-andamento', 'responsavel': 'usuario', 'mensagem': 'atribuída', 'somente_lote': True},
+}
+
+
+def transitions_from(status):
+    """Per-OS button actions available for an OS in the given status, in display order."""
+    return [action for action, transition in STATUS_TRANSITIONS.items()
+            if status in transition['de'] and not transition.get('somente_lote')]
+
+
+def apply_status_transition(action, protocolos=None, where_clause='', params=(), responsavel=None, usuario=None):
+    """Apply a STATUS_TRANSITIONS action to many OS with one set-based UPDATE in one transaction.
+
+    The OS are either the given protocolos or, if protocolos is None, every OS matching
+    where_clause/params (a clause from build_os_filter_clause()). OS whose status does
+    not allow the action are left untouched. Each updated OS gets an 'os_eventos' row
+    in the same transaction, recorded as done by usuario. Returns the number of OS updated.
+    """
+    transition = STATUS_TRANSITIONS[action]
+    assignments = ['status = ?']
+    values = [transition['para']]
+    if transition['responsavel'] == 'usuario':
+        assignments.append('responsavel = ?')
+        values.append(responsavel)
+        new_responsavel, new_responsavel_params = '?', [responsavel]
+    elif transition['responsavel'] == 'limpar':
+        assignments.append('responsavel = NULL')
+        new_responsavel, new_responsavel_params = 'NULL', []
+    else:
+        new_responsavel, new_responsavel_params = 'responsavel', []
+    if protocolos is not None:
+        if not protocolos:
+            return 0
+        selection = f'protocolo IN ({", ".join("?" for _ in protocolos)})'
+        selection_params = list(protocolos)
+    else:
+        selection = f'id IN (SELECT id FROM ordens_servico{where_clause})'
+        selection_params = list(params)
+    allowed = f'status IN ({", ".join("?" for _ in transition["de"])})'
+    with db_transaction() as conn:
+        # Log first, while the rows still hold the status they are leaving
+        record_os_events(conn, 'status', f'{allowed} AND {selection}', list(transition['de']) + selection_params,
+                         status_para=transition['para'], responsavel=(new_responsavel, new_responsavel_params),
+                         usuario=usuario)
+        updated = conn.execute(f'UPDATE ordens_servico SET {", ".join(assignments)} WHERE {allowed} AND {selection}',
+                               values + list(transition['de']) + selection_params).rowcount
+    return updated
+
+
+# --- Event log ---
+# 'os_eventos' is append-only: rows are inserted with INSERT ... SELECT from the
+# 'ordens_servico' rows being changed, in the same transaction as the change itself.
+# tipo is 'criada', 'status' or 'excluida'.
+def record_os_events(conn, tipo, condition, params, status_para=None, responsavel=None, usuario=None,
+                     ocorrido_em=None):
+    """Append one event per 'ordens_servico' row matching condition/params.
+
+    status_de is the row's current status; status_para defaults to it as well. responsavel
+    is an optional (sql_expression, params) pair for the responsável after the change.
+    ocorrido_em defaults to now; 'criada' events use the OS's 'aberta_em' when it is known.
+    Returns the number of events written.
+    """
+    status_para_sql, status_para_params = ('?', [status_para]) if status_para is not None else ('status', [])
+    responsavel_sql, responsavel_params = responsavel or ('responsavel', [])
+    status_de_sql = 'NULL' if tipo == 'criada' else 'status'
+    ocorrido_em_sql = 'COALESCE(aberta_em, ?)' if tipo == 'criada' else '?'
+    return conn.execute(f'''
+        INSERT INTO os_eventos (os_id, protocolo, tipo, status_de, status_para, responsavel, zona, usuario, ocorrido_em)
+        SELECT id, protocolo, ?, {status_de_sql}, {status_para_sql}, {responsavel_sql}, zona, ?, {ocorrido_em_sql}
+        FROM ordens_servico WHERE {condition}
+    ''', [tipo] + status_para_params + list(responsavel_params) + [usuario, ocorrido_em or int(time.time())]
+        + list(params)).rowcount
+
+
+# --- SLA analytics ---
+# Durations (hours) from opening to the first 'em-andamento' ('inicio') and to the
+# first 'concluida' ('resolucao') are kept as histograms per zona, responsável and
+# week of the event in 'sla_histograma'. refresh_sla_aggregates() only reads the
+# events after the 'sla_checkpoint', so its cost depends on what happened since the
+# last refresh, not on the size of the history; median and p90 are estimated from
+# the histogram buckets.
+SLA_BUCKET_EDGES_HOURS = [0, 1, 2, 4, 8, 12, 24, 36, 48, 72, 96, 120, 168, 240, 336, 504, 720, 1440]
+SLA_DIMENSIONS = {'zona': 'Zona', 'responsavel': 'Responsável', 'semana': 'Semana'}
+SLA_METRICS = {'inicio': 'Pendente → Em Andamento', 'resolucao': 'Pendente → Concluída'}
+SLA_REFRESH_BATCH_SIZE = 5000
+SLA_STATE_FETCH_SIZE = 500 # os_ids per 'sla_estado_os' lookup
+
+
+def sla_bucket(hours):
+    """Index of the SLA_BUCKET_EDGES_HOURS bucket holding a duration (the last one is open-ended)."""
+    return max(bisect.bisect_right(SLA_BUCKET_EDGES_HOURS, hours) - 1, 0)
+
+
+def sla_percentile(histogram, fraction):
+    """Estimate a percentile (in hours) from {bucket: count}, interpolating linearly inside the bucket."""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    target = fraction * total
+    seen = 0
+    for bucket in sorted(histogram):
+        count = histogram[bucket]
+        if seen + count >= target:
+            low = SLA_BUCKET_EDGES_HOURS[bucket]
+            if bucket + 1 >= len(SLA_BUCKET_EDGES_HOURS):
+                return float(low) # Open-ended last bucket: report its lower edge
+            high = SLA_BUCKET_EDGES_HOURS[bucket + 1]
+            return low + (high - low) * (target - seen) / count
+        seen += count
+    return float(SLA_BUCKET_EDGES_HOURS[max(histogram)])
+
+
+def sla_pending_events():
+    """True if 'os_eventos' has events the SLA aggregates have not seen yet."""
+    return run_query('''
+        SELECT EXISTS (SELECT 1 FROM os_eventos
+                       WHERE id > COALESCE((SELECT ultimo_evento_id FROM sla_checkpoint WHERE nome = 'sla'), 0))
+    ''')[0][0] == 1
+
+
+def refresh_sla_aggregates(max_batches=None, progress_callback=None):
+    """Fold the events after the checkpoint into 'sla_estado_os' and 'sla_histograma'. Returns how many were read.
+
+    Each batch of SLA_REFRESH_BATCH_SIZE events is a write transaction of its own
+    that advances the checkpoint, so a large backlog never holds the write lock for
+    long; at most max_batches are folded (all pending events if None).
+    progress_callback, if given, gets the number of events read so far after each batch.
+    """
+    processed = batches = 0
+    while max_batches is None or batches < max_batches:
+        with db_transaction() as conn:
+            read = _fold_sla_batch(conn)
+        if not read:
+            break
+        processed += read
+        batches += 1
+        if progress_callback:
+            progress_callback(processed)
+    return processed
+
+
+def _fold_sla_batch(conn):
+    """Fold the next batch of events after the checkpoint and advance it. Returns how many were read."""
+    # Re-read inside the write transaction, so concurrent refreshes never count an event twice
+    row = conn.execute("SELECT ultimo_evento_id FROM sla_checkpoint WHERE nome = 'sla'").fetchone()
+    last_id = row[0] if row else 0
+    events = conn.execute('''
+        SELECT id, os_id, tipo, status_para, responsavel, zona, ocorrido_em FROM os_eventos
+        WHERE id > ? ORDER BY id LIMIT ?
+    ''', (last_id, SLA_REFRESH_BATCH_SIZE)).fetchall()
+    if not events:
+        return 0
+    os_ids = sorted({event[1] for event in events})
+    state = {}
+    for start in range(0, len(os_ids), SLA_STATE_FETCH_SIZE):
+        batch = os_ids[start:start + SLA_STATE_FETCH_SIZE]
+        for os_id, aberta_em, iniciada_em, concluida_em in conn.execute(
+                f'SELECT os_id, aberta_em, iniciada_em, concluida_em FROM sla_estado_os '
+                f'WHERE os_id IN ({", ".join("?" for _ in batch)})', batch):
+            state[os_id] = [aberta_em, iniciada_em, concluida_em]
+    increments = {}
+    for event_id, os_id, tipo, status_para, responsavel, zona, ocorrido_em in events:
+        last_id = event_id
+        if tipo == 'criada':
+            state.setdefault(os_id, [ocorrido_em, None, None])
+            continue
+        if tipo != 'status' or os_id not in state or state[os_id][0] is None:
+            continue
+        if status_para == 'em-andamento' and state[os_id][1] is None:
+            metric, slot = 'inicio', 1
+        elif status_para == 'concluida' and state[os_id][2] is None:
+            metric, slot = 'resolucao', 2
+        else:
+            continue # Only the first start and the first conclusion of an OS count
+        state[os_id][slot] = ocorrido_em
+        bucket = sla_bucket(max(ocorrido_em - state[os_id][0], 0) / 3600)
+        semana = datetime.fromtimestamp(ocorrido_em, LOCAL_TZ).strftime(TIME_BUCKET_FORMATS['semana'])
+        for dimension, key in (('zona', zona or ''), ('responsavel', responsavel or ''), ('semana', semana)):
+            increment_key = (metric, dimension, key, bucket)
+            increments[increment_key] = increments.get(increment_key, 0) + 1
+    conn.executemany('''
+        INSERT INTO sla_estado_os (os_id, aberta_em, iniciada_em, concluida_em) VALUES (?, ?, ?, ?)
+        ON CONFLICT(os_id) DO UPDATE SET aberta_em = excluded.aberta_em,
+            iniciada_em = excluded.iniciada_em, concluida_em = excluded.concluida_em
+    ''', [(os_id, *values) for os_id, values in state.items()])
+    conn.executemany('''
+        INSERT INTO sla_histograma (metrica, dimensao, chave, faixa, total) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(metrica, dimensao, chave, faixa) DO UPDATE SET total = total + excluded.total
+    ''', [key + (count,) for key, count in increments.items()])
+    conn.execute('''
+        INSERT INTO sla_checkpoint (nome, ultimo_evento_id) VALUES ('sla', ?)
+        ON CONFLICT(nome) DO UPDATE SET ultimo_evento_id = excluded.ultimo_evento_id
+    ''', (last_id,))
+    return len(events)
+
+
+def get_sla_summary(dimension):
+    """[{chave, metrica, os, mediana_horas, p90_horas}] per key and metric of one of SLA_DIMENSIONS."""
+    histograms = {}
+    for metric, key, bucket, count in run_query(
+            'SELECT metrica, chave, faixa, total FROM sla_histograma WHERE dimensao = ?', (dimension,)):
+        histograms.setdefault((key, metric), {})[bucket] = count
+    summary = []
+    for (key, metric), histogram in sorted(histograms.items()):
+        summary.append({'chave': key or None, 'metrica': metric, 'os': sum(histogram.values()),
+                        'mediana_horas': sla_percentile(histogram, 0.5), 'p90_horas': sla_percentile(histogram, 0.9)})
+    return summary
+
+
+# --- Time-bucketed queries ---
+# The time charts are computed by SQLite with strftime() buckets over the indexed
+# 'aberta_em' column (indexed in the archive as well); only the bucketed series is
+# moved into Python.
+def get_aberta_em_range(include_archived=False):
+    """(min, max) of 'aberta_em' as epoch seconds, or (None, None) if no OS has a date."""
+    # One query per table, so each MIN/MAX is a single index lookup
+    tables = ['ordens_servico'] + (['ordens_servico_arquivo'] if include_archived else [])
+    bounds = [run_query(f'SELECT MIN(aberta_em), MAX(aberta_em) FROM {table}')[0] for table in tables]
+    starts = [start for start, _ in bounds if start is not None]
+    ends = [end for _, end in bounds if end is not None]
+    return (min(starts) if starts else None, max(ends) if ends else None)
+
+
+def get_counts_by_period(start_epoch, end_epoch, bucket='dia', by_status=False, include_archived=False):
+    """[(period, count)] or [(period, status, count)] for OS opened in [start_epoch, end_epoch)."""
+    period = f"strftime('{TIME_BUCKET_FORMATS[bucket]}', aberta_em, 'unixepoch', '{SQL_LOCAL_TIME_MODIFIER}')"
+    group_by = 'periodo, status' if by_status else 'periodo'
+    return run_query(f'''
+        SELECT {period} AS periodo{', status' if by_status else ''}, COUNT(*)
+        FROM {os_source(include_archived)}
+        WHERE aberta_em >= ? AND aberta_em < ?
+        GROUP BY {group_by} ORDER BY {group_by}
+    ''', (start_epoch, end_epoch))
+
+
+def get_counts_by_weekday_hour(start_epoch, end_epoch, include_archived=False):
+    """[(weekday 0=domingo..6, hour 0..23, count)] for OS opened in [start_epoch, end_epoch)."""
+    return run_query(f'''
+        SELECT CAST(strftime('%w', aberta_em, 'unixepoch', '{SQL_LOCAL_TIME_MODIFIER}') AS INTEGER) AS dia_semana,
+               CAST(strftime('%H', aberta_em, 'unixepoch', '{SQL_LOCAL_TIME_MODIFIER}') AS INTEGER) AS hora,
+               COUNT(*)
+        FROM {os_source(include_archived)}
+        WHERE aberta_em >= ? AND aberta_em < ?
+        GROUP BY dia_semana, hora
+    ''', (start_epoch, end_epoch))
@@ -0,0 +1,505 @@
+# ilumina/schema.py
+"""Versioned schema migrations and the one-time database setup."""
+import logging
+import secrets
+import threading
+import time
+
+from .auth import hash_password
+from .db import bump_data_version, close_connection_manager, db_transaction
+from .duplicates import index_os_enderecos
+from .timeutil import parse_data_hora
+
+logger = logging.getLogger('ilumina')
+
+
+# The schema is versioned with PRAGMA user_version: MIGRATIONS is an ordered list
+# and migration N runs only on databases whose user_version is below N. Databases
+# created before versioning (user_version 0) may already have part of the schema,
+# so every migration is idempotent. New schema changes are appended to the list,
+# never inserted in the middle.
+def _add_column_if_missing(conn, table, column, declaration):
+    cols = [col[1] for col in conn.execute(f'PRAGMA table_info({table});').fetchall()]
+    if column not in cols:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+
+# The canonical 'ordens_servico' of _migration_base_tables
+OS_BASE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS ordens_servico (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        protocolo TEXT UNIQUE NOT NULL,
+        nome TEXT,
+        endereco TEXT,
+        zona TEXT,
+        status TEXT,
+        responsavel TEXT
+    )
+'''
+
+
+def _has_unique_protocolo(conn):
+    for _, name, unique, _, _ in conn.execute('PRAGMA index_list(ordens_servico)').fetchall():
+        if unique and [col[2] for col in conn.execute(f'PRAGMA index_info("{name}")').fetchall()] == ['protocolo']:
+            return True
+    return False
+
+
+def _rebuild_legacy_os_table(conn):
+    """Recreate an 'ordens_servico' written by DataFrame.to_sql() (no id, no UNIQUE protocolo).
+
+    The old "Processar e Substituir" upload replaced the table that way. Its rows are
+    copied into the canonical table, one per protocolo (the last one, as the upload
+    upserts do), keeping every other column (e.g. 'observacao'); rows without
+    protocolo are dropped.
+    """
+    old_columns = [(col[1], col[2] or 'TEXT') for col in conn.execute('PRAGMA table_info(ordens_servico)')]
+    conn.execute('ALTER TABLE ordens_servico RENAME TO ordens_servico_legado')
+    conn.execute(OS_BASE_TABLE_SQL)
+    base_columns = [col[1] for col in conn.execute('PRAGMA table_info(ordens_servico)')]
+    for column, declaration in old_columns:
+        if column not in base_columns:
+            conn.execute(f'ALTER TABLE ordens_servico ADD COLUMN "{column}" {declaration}')
+    copied = ', '.join(f'"{column}"' for column, _ in old_columns if column != 'id')
+    total = conn.execute('SELECT COUNT(*) FROM ordens_servico_legado').fetchone()[0]
+    kept = conn.execute(f'''
+        INSERT INTO ordens_servico ({copied})
+        SELECT {copied} FROM ordens_servico_legado
+        WHERE rowid IN (SELECT MAX(rowid) FROM ordens_servico_legado
+                        WHERE protocolo IS NOT NULL AND protocolo != '' GROUP BY protocolo)
+        ORDER BY rowid
+    ''').rowcount
+    conn.execute('DROP TABLE ordens_servico_legado')
+    logger.info(f"'ordens_servico' recriada com id e protocolo único: {kept} de {total} linhas mantidas")
+
+
+def _migration_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL,
+            created_at TEXT
+        )
+    ''')
+    conn.execute(OS_BASE_TABLE_SQL)
+    # Databases from before the migrations may have the table written by to_sql()
+    columns = [col[1] for col in conn.execute('PRAGMA table_info(ordens_servico)')]
+    if 'id' not in columns or not _has_unique_protocolo(conn):
+        _rebuild_legacy_os_table(conn)
+
+
+def _migration_observacao(conn):
+    _add_column_if_missing(conn, 'ordens_servico', 'observacao', 'TEXT')
+
+
+def _migration_relatorio_os_columns(conn):
+    for column in ['descricao', 'telefone', 'data', 'hora']:
+        _add_column_if_missing(conn, 'ordens_servico', column, 'TEXT')
+
+
+def _migration_content_hash(conn):
+    _add_column_if_missing(conn, 'ordens_servico', 'content_hash', 'TEXT')
+
+
+def _migration_filter_indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordens_servico_status ON ordens_servico(status)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordens_servico_zona ON ordens_servico(zona)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordens_servico_responsavel ON ordens_servico(responsavel)')
+
+
+def _migration_search_index(conn):
+    # External-content FTS5 table over 'ordens_servico', kept in sync by triggers.
+    # remove_diacritics makes "rua tertuliano" match "Rua Tertulianó" and vice versa.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ordens_servico_fts USING fts5(
+            protocolo, nome, endereco, observacao,
+            content='ordens_servico', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS ordens_servico_fts_ai AFTER INSERT ON ordens_servico BEGIN
+            INSERT INTO ordens_servico_fts(rowid, protocolo, nome, endereco, observacao)
+            VALUES (new.id, new.protocolo, new.nome, new.endereco, new.observacao);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS ordens_servico_fts_ad AFTER DELETE ON ordens_servico BEGIN
+            INSERT INTO ordens_servico_fts(ordens_servico_fts, rowid, protocolo, nome, endereco, observacao)
+            VALUES ('delete', old.id, old.protocolo, old.nome, old.endereco, old.observacao);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS ordens_servico_fts_au
+        AFTER UPDATE OF protocolo, nome, endereco, observacao ON ordens_servico BEGIN
+            INSERT INTO ordens_servico_fts(ordens_servico_fts, rowid, protocolo, nome, endereco, observacao)
+            VALUES ('delete', old.id, old.protocolo, old.nome, old.endereco, old.observacao);
+            INSERT INTO ordens_servico_fts(rowid, protocolo, nome, endereco, observacao)
+            VALUES (new.id, new.protocolo, new.nome, new.endereco, new.observacao);
+        END
+    ''')
+    # Index the rows that existed before the FTS table was created
+    conn.execute("INSERT INTO ordens_servico_fts(ordens_servico_fts) VALUES ('rebuild')")
+
+
+def rebuild_os_counters(conn):
+    """Recount 'os_contagem' from 'ordens_servico', and 'os_contagem_arquivo' from the archive if it exists.
+
+    Used after bulk loads or if the counters are ever in doubt; both are recounted in
+    the caller's transaction.
+    """
+    counters = [('os_contagem', 'ordens_servico')]
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'os_contagem_arquivo'").fetchone():
+        counters.append(('os_contagem_arquivo', 'ordens_servico_arquivo'))
+    for counter_table, os_table in counters:
+        conn.execute(f'DELETE FROM {counter_table}')
+        conn.execute(f'''
+            INSERT INTO {counter_table} (zona, status, total)
+            SELECT COALESCE(zona, ''), COALESCE(status, ''), COUNT(*) FROM {os_table} GROUP BY 1, 2
+        ''')
+
+
+def _migration_os_counters(conn):
+    # Number of OS per (zona, status), maintained by triggers so the metric cards,
+    # filter options and status/zona charts read O(#zonas) rows instead of scanning
+    # 'ordens_servico'. NULL zona/status are stored as '' (primary key columns).
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS os_contagem (
+            zona TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (zona, status)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS os_contagem_ai AFTER INSERT ON ordens_servico BEGIN
+            INSERT INTO os_contagem (zona, status, total) VALUES (COALESCE(new.zona, ''), COALESCE(new.status, ''), 1)
+            ON CONFLICT (zona, status) DO UPDATE SET total = total + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS os_contagem_ad AFTER DELETE ON ordens_servico BEGIN
+            UPDATE os_contagem SET total = total - 1
+            WHERE zona = COALESCE(old.zona, '') AND status = COALESCE(old.status, '');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS os_contagem_au AFTER UPDATE OF zona, status ON ordens_servico
+        WHEN old.zona IS NOT new.zona OR old.status IS NOT new.status BEGIN
+            UPDATE os_contagem SET total = total - 1
+            WHERE zona = COALESCE(old.zona, '') AND status = COALESCE(old.status, '');
+            INSERT INTO os_contagem (zona, status, total) VALUES (COALESCE(new.zona, ''), COALESCE(new.status, ''), 1)
+            ON CONFLICT (zona, status) DO UPDATE SET total = total + 1;
+        END
+    ''')
+    rebuild_os_counters(conn)
+
+
+def _migration_aberta_em(conn):
+    _add_column_if_missing(conn, 'ordens_servico', 'aberta_em', 'INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordens_servico_aberta_em ON ordens_servico(aberta_em)')
+    # Backfill from the text columns of earlier imports (and the legacy 'created_at', if present)
+    cols = [col[1] for col in conn.execute('PRAGMA table_info(ordens_servico);').fetchall()]
+    legacy = 'created_at' if 'created_at' in cols else 'NULL'
+    rows = conn.execute(f'SELECT id, data, hora, {legacy} FROM ordens_servico WHERE aberta_em IS NULL').fetchall()
+    updates = []
+    for os_id, data, hora, created_at in rows:
+        aberta_em = parse_data_hora(data, hora) or parse_data_hora(created_at)
+        if aberta_em is not None:
+            updates.append((aberta_em, os_id))
+    conn.executemany('UPDATE ordens_servico SET aberta_em = ? WHERE id = ?', updates)
+
+
+def _migration_os_eventos(conn):
+    # Append-only history: one row per OS creation, status change or deletion
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS os_eventos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            os_id INTEGER NOT NULL,
+            protocolo TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            status_de TEXT,
+            status_para TEXT,
+            responsavel TEXT,
+            zona TEXT,
+            usuario TEXT,
+            ocorrido_em INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_os_eventos_os_id ON os_eventos(os_id)')
+    # Existing OS start their history with a 'criada' event at their opening time
+    conn.execute('''
+        INSERT INTO os_eventos (os_id, protocolo, tipo, status_para, responsavel, zona, ocorrido_em)
+        SELECT id, protocolo, 'criada', status, responsavel, zona, COALESCE(aberta_em, ?)
+        FROM ordens_servico ORDER BY id
+    ''', (int(time.time()),))
+
+
+def _migration_sla_aggregates(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sla_checkpoint (
+            nome TEXT PRIMARY KEY,
+            ultimo_evento_id INTEGER NOT NULL
+        )
+    ''')
+    # Opening / first start / first conclusion of each OS, as seen in the events processed so far
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sla_estado_os (
+            os_id INTEGER PRIMARY KEY,
+            aberta_em INTEGER,
+            iniciada_em INTEGER,
+            concluida_em INTEGER
+        )
+    ''')
+    # Histogram of durations per metric ('inicio', 'resolucao'), dimension and key
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sla_histograma (
+            metrica TEXT NOT NULL,
+            dimensao TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            faixa INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (metrica, dimensao, chave, faixa)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _migration_duplicate_detection(conn):
+    # Normalized address and blocking keys of every OS, see ilumina.duplicates
+    _add_column_if_missing(conn, 'ordens_servico', 'endereco_normalizado', 'TEXT')
+    _add_column_if_missing(conn, 'ordens_servico', 'duplicata_de', 'TEXT')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS os_endereco_chaves (
+            zona TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            os_id INTEGER NOT NULL,
+            PRIMARY KEY (zona, chave, os_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_os_endereco_chaves_os_id ON os_endereco_chaves(os_id)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS os_endereco_chaves_ad AFTER DELETE ON ordens_servico BEGIN
+            DELETE FROM os_endereco_chaves WHERE os_id = old.id;
+        END
+    ''')
+    index_os_enderecos(conn)
+
+
+def _migration_archive(conn):
+    # Same columns as 'ordens_servico' (ids are kept), plus when the OS was archived
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ordens_servico_arquivo (
+            id INTEGER PRIMARY KEY,
+            protocolo TEXT UNIQUE NOT NULL,
+            nome TEXT,
+            endereco TEXT,
+            zona TEXT,
+            status TEXT,
+            responsavel TEXT,
+            observacao TEXT,
+            descricao TEXT,
+            telefone TEXT,
+            data TEXT,
+            hora TEXT,
+            content_hash TEXT,
+            aberta_em INTEGER,
+            endereco_normalizado TEXT,
+            duplicata_de TEXT,
+            arquivada_em INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordens_servico_arquivo_aberta_em ON ordens_servico_arquivo(aberta_em)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ordens_servico_arquivo_zona ON ordens_servico_arquivo(zona)')
+    # Archived rows never change, so only inserts and deletes are indexed/counted
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS ordens_servico_arquivo_fts USING fts5(
+            protocolo, nome, endereco, observacao,
+            content='ordens_servico_arquivo', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS ordens_servico_arquivo_fts_ai AFTER INSERT ON ordens_servico_arquivo BEGIN
+            INSERT INTO ordens_servico_arquivo_fts(rowid, protocolo, nome, endereco, observacao)
+            VALUES (new.id, new.protocolo, new.nome, new.endereco, new.observacao);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS ordens_servico_arquivo_fts_ad AFTER DELETE ON ordens_servico_arquivo BEGIN
+            INSERT INTO ordens_servico_arquivo_fts(
+                ordens_servico_arquivo_fts, rowid, protocolo, nome, endereco, observacao)
+            VALUES ('delete', old.id, old.protocolo, old.nome, old.endereco, old.observacao);
+        END
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS os_contagem_arquivo (
+            zona TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (zona, status)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS os_contagem_arquivo_ai AFTER INSERT ON ordens_servico_arquivo BEGIN
+            INSERT INTO os_contagem_arquivo (zona, status, total)
+            VALUES (COALESCE(new.zona, ''), COALESCE(new.status, ''), 1)
+            ON CONFLICT (zona, status) DO UPDATE SET total = total + 1;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS os_contagem_arquivo_ad AFTER DELETE ON ordens_servico_arquivo BEGIN
+            UPDATE os_contagem_arquivo SET total = total - 1
+            WHERE zona = COALESCE(old.zona, '') AND status = COALESCE(old.status, '');
+        END
+    ''')
+
+
+def _migration_jobs(conn):
+    # Background jobs (see ilumina.jobs): status and result survive reruns and reconnects
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            status TEXT NOT NULL,
+            usuario TEXT,
+            parametros TEXT,
+            progresso REAL NOT NULL DEFAULT 0,
+            mensagem TEXT,
+            resultado TEXT,
+            arquivo TEXT,
+            criado_em INTEGER NOT NULL,
+            iniciado_em INTEGER,
+            concluido_em INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_usuario ON jobs(usuario, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)')
+
+
+def _migration_attachments(conn):
+    # Photo attachments (see ilumina.attachments): one row per OS and stored file
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS anexos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            protocolo TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            nome_arquivo TEXT,
+            tipo TEXT,
+            tamanho INTEGER NOT NULL,
+            largura INTEGER,
+            altura INTEGER,
+            usuario TEXT,
+            criado_em INTEGER NOT NULL,
+            UNIQUE (protocolo, sha256)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_anexos_sha256 ON anexos(sha256)')
+
+
+def _migration_session_secret(conn):
+    # Key of the session tokens (see ilumina.auth), unless $ILUMINA_SESSION_SECRET is set
+    conn.execute('CREATE TABLE IF NOT EXISTS configuracao (nome TEXT PRIMARY KEY, valor TEXT NOT NULL)')
+    conn.execute("INSERT OR IGNORE INTO configuracao (nome, valor) VALUES ('segredo_sessao', ?)",
+                 (secrets.token_hex(32),))
+
+
+def _migration_session_version(conn):
+    # Signed into the session tokens (see ilumina.auth); bumping it ends the user's sessions
+    _add_column_if_missing(conn, 'users', 'sessao_versao', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def _migration_job_runners(conn):
+    # The process running each job, and the processes alive (see ilumina.jobs)
+    _add_column_if_missing(conn, 'jobs', 'executor', 'TEXT')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_runners (
+            id TEXT PRIMARY KEY,
+            pid INTEGER,
+            heartbeat_em INTEGER NOT NULL
+        )
+    ''')
+
+
+MIGRATIONS = [
+    ("tabelas 'users' e 'ordens_servico'", _migration_base_tables),
+    ("coluna 'observacao'", _migration_observacao),
+    ("colunas do relatorio_os (descricao, telefone, data, hora)", _migration_relatorio_os_columns),
+    ("coluna 'content_hash'", _migration_content_hash),
+    ("índices de status, zona e responsavel", _migration_filter_indexes),
+    ("índice de busca FTS5", _migration_search_index),
+    ("contadores por zona e status (os_contagem)", _migration_os_counters),
+    ("coluna 'aberta_em' (data/hora de abertura em epoch)", _migration_aberta_em),
+    ("histórico de eventos (os_eventos)", _migration_os_eventos),
+    ("agregados de SLA (sla_checkpoint, sla_estado_os, sla_histograma)", _migration_sla_aggregates),
+    ("endereço normalizado e chaves de duplicatas (os_endereco_chaves)", _migration_duplicate_detection),
+    ("arquivo de OS concluídas (ordens_servico_arquivo)", _migration_archive),
+    ("tarefas em segundo plano (jobs)", _migration_jobs),
+    ("anexos de fotos das OS (anexos)", _migration_attachments),
+    ("chave das sessões de login (configuracao)", _migration_session_secret),
+    ("versão das sessões de login (users.sessao_versao)", _migration_session_version),
+    ("processos executores de tarefas (jobs.executor, job_runners)", _migration_job_runners),
+]
+
+
+def run_migrations(conn):
+    """Apply the pending MIGRATIONS on conn (inside the caller's transaction). Returns their descriptions."""
+    current_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    applied = []
+    for version, (description, migrate) in enumerate(MIGRATIONS, start=1):
+        if version <= current_version:
+            continue
+        migrate(conn)
+        conn.execute(f'PRAGMA user_version = {version}')
+        applied.append(description)
+    return applied
+
+
+_setup_done = False
+_setup_lock = threading.Lock()
+
+
+# Ensure the database and default admin user exist and has the correct schema
+def setup_database():
+    with db_transaction() as conn:
+        # user_version is re-read inside the write transaction, so two processes
+        # starting at the same time can't apply the same migration twice
+        applied = run_migrations(conn)
+
+        # Add default admin user if not exists
+        if conn.execute("SELECT COUNT(*) FROM users WHERE username = 'admin'").fetchone()[0] == 0:
+            # Generate password hash for 'ilumina2025'
+            admin_password_hash = hash_password('ilumina2025')
+            # Use time.strftime for date format consistency, less dependency on pandas
+            created_at = time.strftime('%d/%m/%Y')
+            conn.execute('''INSERT INTO users (username, password, role, created_at) VALUES (?, ?, ?, ?)''',
+                         ('admin', admin_password_hash, 'Administrador', created_at))
+            logger.info("Default admin user created (user: admin, pass: ilumina2025)")
+    if applied:
+        bump_data_version() # Schema changed: cached results (e.g. PRAGMA table_info) are stale
+        for description in applied:
+            logger.info(f"Migração aplicada: {description}")
+
+
+def setup_database_once():
+    """Run setup_database() once per process; later calls (reruns, sessions, commands) return at once.
+
+    The first callers wait on a lock for the one running the migrations instead of
+    running them again. A failure is not remembered, so the next call retries.
+    """
+    global _setup_done
+    if _setup_done:
+        return
+    with _setup_lock:
+        if not _setup_done:
+            setup_database()
+            _setup_done = True
+
+
+def reset_database():
+    """Reconnect and run the setup again on the next setup_database_once(), e.g. after the file went missing."""
+    global _setup_done
+    with _setup_lock:
+        close_connection_manager()
+        _setup_done = False
@@ -0,0 +1,63 @@
+# ilumina/timeutil.py
+"""Local date/time parsing for 'aberta_em' and the SQL time buckets."""
+import functools
+from datetime import datetime, time, timedelta, timezone
+
+# 'aberta_em' is the moment an OS was opened, as Unix epoch seconds (indexed).
+# relatorio_os exports carry it as local 'Data' (dd/mm/yyyy) + 'Hora' (HH:MM:SS);
+# Pedro II (PI) is on UTC-3 all year, with no daylight saving time.
+LOCAL_UTC_OFFSET_HOURS = -3
+LOCAL_TZ = timezone(timedelta(hours=LOCAL_UTC_OFFSET_HOURS))
+# strftime() modifier that turns 'unixepoch' values into local time in SQL
+SQL_LOCAL_TIME_MODIFIER = f'{LOCAL_UTC_OFFSET_HOURS:+d} hours'
+DATE_FORMATS = ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y']
+TIME_FORMATS = ['%H:%M:%S', '%H:%M']
+# strftime() formats of the 'dia', 'semana' and 'mes' buckets (in SQL and in Python)
+TIME_BUCKET_FORMATS = {'dia': '%Y-%m-%d', 'semana': '%Y-%W', 'mes': '%Y-%m'}
+
+
+# Exports repeat the same dates (and often times) over many rows: each distinct
+# value is parsed once
+PARSE_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_local_date(data):
+    """datetime.date of '19/07/2025' (any of DATE_FORMATS), or None."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(data, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_local_time(hora):
+    """datetime.time of '07:19:02' (any of TIME_FORMATS), or None."""
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(hora, time_format).time()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_data_hora(data, hora=None):
+    """Epoch seconds for a local date ('19/07/2025') and optional time ('07:19:02'), or None if unparseable."""
+    if not data:
+        return None
+    data = data.strip()
+    # Also accept a combined value such as created_at '2025-07-19 07:19:02'
+    if hora is None and ' ' in data:
+        data, hora = data.split(' ', 1)
+    day = parse_local_date(data)
+    if day is None:
+        return None
+    parsed_time = (parse_local_time(hora.strip()) if hora else None) or time()
+    return int(datetime.combine(day, parsed_time, tzinfo=LOCAL_TZ).timestamp())
+
+
+def local_date_to_epoch(day):
+    """Epoch seconds of local midnight at the start of a datetime.date."""
+    return int(datetime(day.year, day.month, day.day, tzinfo=LOCAL_TZ).timestamp())
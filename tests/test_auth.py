@@ -0,0 +1,100 @@
+"""Session tokens, their revocation, login rate limiting and transparent rehashing (ilumina.auth)."""
+import time
+
+import pytest
+
+from ilumina import auth
+from ilumina.db import configure_database, db_transaction, run_query
+from ilumina.schema import setup_database
+
+ADMIN_PASSWORD = 'ilumina2025'
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.delenv('ILUMINA_SESSION_SECRET', raising=False)
+    configure_database(str(tmp_path / 'auth.db'))
+    setup_database()
+    auth._failures.clear()
+    auth._next_attempt.clear()
+    yield
+    configure_database('database.db')
+
+
+def test_valid_token_resumes_session():
+    token = auth.create_session_token('admin')
+    assert auth.verify_session_token(token) == {'username': 'admin', 'role': 'Administrador'}
+
+
+def test_expired_token_is_rejected():
+    token = auth.create_session_token('admin', ttl=-1)
+    assert auth.verify_session_token(token) is None
+
+
+@pytest.mark.parametrize('tamper', [
+    lambda token: token[:-1] + ('0' if token[-1] != '0' else '1'), # Signature
+    lambda token: token.replace('.', '.9', 1), # Expiry pushed into the future
+    lambda token: 'b3BlcmFkb3I' + token[token.index('.'):], # Another username ('operador')
+    lambda token: 'not a token',
+])
+def test_tampered_token_is_rejected(tamper):
+    token = auth.create_session_token('admin')
+    assert auth.verify_session_token(tamper(token)) is None
+
+
+def test_token_from_before_password_change_is_rejected():
+    token = auth.create_session_token('admin')
+    with db_transaction() as conn:
+        conn.execute("UPDATE users SET password = ? WHERE username = 'admin'", (auth.hash_password('nova'),))
+        auth.end_sessions('admin', conn)
+    assert auth.verify_session_token(token) is None
+    assert auth.verify_session_token(auth.create_session_token('admin')) is not None
+
+
+def test_logout_revokes_token():
+    token = auth.create_session_token('admin')
+    auth.end_sessions('admin')
+    assert auth.verify_session_token(token) is None
+
+
+def test_sixth_failure_from_same_user_and_ip_is_refused():
+    for _ in range(auth.LOGIN_MAX_FAILURES_PER_USER_IP):
+        assert auth.authenticate('admin', 'errada', client_ip='10.0.0.1') is None
+    with pytest.raises(ValueError, match='Muitas tentativas'):
+        auth.authenticate('admin', ADMIN_PASSWORD, client_ip='10.0.0.1')
+    # Failing on purpose from one IP doesn't lock the user out elsewhere
+    assert auth.authenticate('admin', ADMIN_PASSWORD, client_ip='10.0.0.2') is not None
+
+
+def test_failures_across_ips_throttle_the_username():
+    now = time.time()
+    for i in range(auth.LOGIN_THROTTLE_AFTER_FAILURES):
+        auth.record_login_failure('admin', client_ip=f'10.0.1.{i}')
+    waits = [auth.reserve_login_turn('admin', now=now) for _ in range(10)]
+    assert waits[:2] == [0.0, auth.LOGIN_THROTTLE_INTERVAL_S]
+    assert None in waits # Past LOGIN_THROTTLE_MAX_WAIT_S attempts are refused
+    assert auth.reserve_login_turn('outro', now=now) == 0.0
+
+
+def test_unknown_user_is_refused_and_counted():
+    assert auth.authenticate('ninguem', 'x', client_ip='10.0.0.3') is None
+    assert auth._failures[('ip', '10.0.0.3')]
+
+
+def test_old_hash_parameters_are_replaced_on_login(monkeypatch):
+    with db_transaction() as conn:
+        conn.execute("UPDATE users SET password = ? WHERE username = 'admin'",
+                     (auth.generate_password_hash(ADMIN_PASSWORD, method='pbkdf2:sha256:1000'),))
+    token = auth.create_session_token('admin')
+    assert auth.authenticate('admin', ADMIN_PASSWORD) is not None
+    new_hash = run_query("SELECT password FROM users WHERE username = 'admin'")[0][0]
+    assert new_hash.startswith(auth.current_hash_prefix() + '$')
+    assert auth.verify_session_token(token) is not None # A rehash doesn't end sessions
+    assert auth.authenticate('admin', ADMIN_PASSWORD) is not None
+
+
+def test_resolve_client_ip(monkeypatch):
+    assert auth.resolve_client_ip('10.0.0.1', '1.2.3.4') == '10.0.0.1'
+    monkeypatch.setattr(auth, 'TRUSTED_PROXY_HOPS', 1)
+    assert auth.resolve_client_ip('10.0.0.1', 'forjado, 1.2.3.4') == '1.2.3.4'
+    assert auth.resolve_client_ip('10.0.0.1', None) == '10.0.0.1'
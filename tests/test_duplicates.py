@@ -0,0 +1,33 @@
+"""Address normalization and duplicate scoring (ilumina.duplicates)."""
+import pytest
+
+from ilumina.duplicates import (DUPLICATE_MIN_SIMILARITY, endereco_features, endereco_similarity,
+                                normalize_endereco)
+
+
+def similarity(endereco_a, endereco_b):
+    return endereco_similarity(endereco_features(normalize_endereco(endereco_a)),
+                               endereco_features(normalize_endereco(endereco_b)))
+
+
+def test_normalize_endereco():
+    assert normalize_endereco('R. Tertuliano Filho, nº 219') == 'rua tertuliano filho 219'
+
+
+@pytest.mark.parametrize('endereco_a, endereco_b', [
+    ('Joao Mendes', 'Travessa João Mendes 166 Cristo Rei'),
+    ('R. Tertuliano Filho, nº 219', 'Rua Tertuliamo Filho 215'), # Typo, neighbouring house
+    ('Na avenida Pedro Ivo penal', 'Av. Pedro Ivo, perto da penal'),
+    ('Comunidade Esperança', 'Povoado Esperança'), # Same single word
+])
+def test_same_place_scores_high(endereco_a, endereco_b):
+    assert similarity(endereco_a, endereco_b) >= DUPLICATE_MIN_SIMILARITY
+
+
+@pytest.mark.parametrize('endereco_a, endereco_b', [
+    # Only 'esperanca' in common (scored exactly 0.7 before)
+    ('Rua Auto Freire, 120, bairro Boa Esperança', 'Comunidade esperança interior'),
+    ('Rua Esperança 40', 'Rua Esperança Garcia 400'), # House numbers far apart
+])
+def test_different_places_score_low(endereco_a, endereco_b):
+    assert similarity(endereco_a, endereco_b) < DUPLICATE_MIN_SIMILARITY